@@ -5,6 +5,7 @@ Calculates and visualizes training accuracy vs test accuracy
 """
 
 import os
+import sys
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -18,6 +19,11 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.svm import SVC
 from sklearn.neural_network import MLPClassifier
 import xgboost as xgb
+
+# feature_reduction.py lives in the repository root, one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from feature_reduction import REDUCER_FILE, apply_reducer, load_reducer
+
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -42,17 +48,30 @@ class AccuracyAnalyzer:
         self.results = {}
         self.feature_importance = {}
         
-    def load_data(self, features_file, labels_file):
+    def load_data(self, features_file, labels_file, mmap_mode=None, use_reducer=True):
         """
         Load pre-extracted features and labels
         
         Args:
             features_file: Path to .npy file containing features
             labels_file: Path to .npy file containing labels
+            mmap_mode: Pass 'r' to memory-map the features instead of reading
+                them into RAM (the sklearn models still copy their splits)
+            use_reducer: Project the features with the reducer (REDUCER_FILE)
+                saved next to features_file, if present, so the analysis sees
+                the same inputs as the deployed classifier
         """
         try:
-            self.X = np.load(features_file)
+            self.X = np.load(features_file, mmap_mode=mmap_mode)
             self.y = np.load(labels_file)
+            model_dir = os.path.dirname(os.path.abspath(features_file))
+            reducer = load_reducer(model_dir) if use_reducer else None
+            if reducer is not None:
+                # In chunks, so memory-mapped features are never read in full
+                chunk_rows = 8192
+                self.X = np.concatenate([apply_reducer(reducer, self.X[start:start + chunk_rows])
+                                         for start in range(0, self.X.shape[0], chunk_rows)])
+                print(f"Applied feature reducer from {os.path.join(model_dir, REDUCER_FILE)}")
             print(f"Data loaded successfully!")
             print(f"Features shape: {self.X.shape}")
             print(f"Labels shape: {self.y.shape}")
@@ -0,0 +1,117 @@
+# activation_cache.py
+"""
+Frozen-backbone activation cache for head-only training
+
+model.forward_features() is run once per image (non-augmented) and the
+activations are stored in a memory-mapped float16 .npy file, keyed by the
+image list and the backbone weights. HeadModel then trains only the
+model's HEAD_MODULES (e.g. AttentionResNet's attention and classifier) on
+ActivationDataset batches, so folds and epochs never run the backbone again.
+"""
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
+
+
+def backbone_hash(model):
+    """SHA-1 of every parameter and buffer outside model.HEAD_MODULES"""
+    head = tuple(f'{name}.' for name in model.HEAD_MODULES)
+    digest = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        if name.startswith(head):
+            continue
+        digest.update(name.encode('utf-8'))
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def build_activation_cache(model, dataset, cache_dir='activation_cache', batch_size=32, num_workers=4,
+                           dtype=np.float16):
+    """
+    Backbone activations of every sample of dataset, computed once and memory-mapped
+
+    The dataset should use the non-augmented (validation) transform. The
+    cache is reused when the image list and backbone weights are unchanged.
+
+    Returns:
+        np.memmap: (len(dataset), *activation_shape) array opened read-only
+    """
+    if len(dataset) == 0:
+        # The activation shape comes from the first batch, so there is nothing to allocate
+        raise ValueError("Cannot build an activation cache for an empty dataset")
+    digest = hashlib.sha1('\n'.join(map(str, dataset.image_paths)).encode())
+    digest.update(backbone_hash(model).encode())
+    key = digest.hexdigest()
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{type(model).__name__}_{key[:16]}.npy')
+    meta_path = os.path.splitext(path)[0] + '.json'
+    if os.path.exists(path) and os.path.exists(meta_path):
+        print(f"Using cached activations from {path}")
+        return np.load(path, mmap_mode='r')
+
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    activations = None
+    offset = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for data, _ in loader:
+            features = model.forward_features(data.to(device)).float().cpu().numpy()
+            if activations is None:
+                activations = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                                        shape=(len(dataset),) + features.shape[1:])
+            activations[offset:offset + len(features)] = features
+            offset += len(features)
+    model.train(was_training)
+    activations.flush()
+    del activations
+    elapsed = time.perf_counter() - start
+    print(f"Cached {offset} activations in {elapsed:.1f}s ({offset / max(elapsed, 1e-9):.1f} images/sec) to {path}")
+
+    # Written last: its presence marks a complete cache
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'num_samples': offset}, f)
+    return np.load(path, mmap_mode='r')
+
+
+class ActivationDataset(Dataset):
+    """(activation, label) pairs read from a cached activation array"""
+
+    def __init__(self, activations, labels, indices=None):
+        self.activations = activations
+        self.labels = torch.as_tensor(np.asarray(labels), dtype=torch.long)
+        self.indices = np.arange(len(activations)) if indices is None else np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        row = self.indices[idx]
+        return torch.from_numpy(np.asarray(self.activations[row], dtype=np.float32)), self.labels[row]
+
+
+class HeadModel(nn.Module):
+    """
+    The HEAD_MODULES of a model, trained on cached activations
+
+    The head modules are shared with the full model, so training a HeadModel
+    trains the full model's head in place; only they are registered, so the
+    optimizer and checkpoints cover the head alone.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.heads = nn.ModuleDict({name: getattr(model, name) for name in model.HEAD_MODULES
+                                    if getattr(model, name) is not None})
+        # Not registered as a submodule: the backbone stays out of parameters() and state_dict()
+        object.__setattr__(self, 'full_model', model)
+
+    def forward(self, features):
+        return self.full_model.forward_head(features)
@@ -15,6 +15,7 @@ import io
 import csv
 import os
 from typing import List
+from feature_reduction import load_reducer, apply_reducer
 
 # -----------------------------
 # 
@@ -39,6 +40,9 @@ resnet_model.eval()
 # Load XGBoost model
 xgb_clf = joblib.load("xgb_cnn_features.joblib")
 
+# Optional PCA / random projection fit at training time (None if the model uses full features)
+feature_reducer = load_reducer(".")
+
 # SHAP explainer
 explainer = shap.TreeExplainer(xgb_clf)
 
@@ -104,6 +108,7 @@ async def predict(file: UploadFile = File(...)):
 
         # Extract features with TTA and predict (average probabilities)
         features = extract_features(image, use_tta=True)
+        features = apply_reducer(feature_reducer, features)
         proba = xgb_clf.predict_proba(features)  # (N, 2)
         avg_proba = proba.mean(axis=0).tolist()
         positive_threshold = 0.6
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate detection for X-ray exports
+
+Re-exports, recompressed copies and slightly cropped copies of the same
+film are found with 64-bit perceptual hashes (pHash or dHash) computed in
+a process pool. Pairs within `max_distance` bits are found with a
+multi-index hash: the hash is cut into max_distance + 1 bands, and by the
+pigeonhole principle two hashes within max_distance bits agree exactly on
+at least one band, so only hashes sharing a band value are compared.
+Matching pairs are merged into groups with union-find.
+
+Two manifests are written next to the label file:
+    <name>_groups.csv  every row plus group_id and keep (one representative per group)
+    <name>_dedup.csv   representatives only, with group_id
+
+Splitters in train_model.py and enhanced_trainer.py keep each group_id on
+one side of the split when the column is present.
+
+Usage:
+    python dedup.py --image-dir data/xray_images --label-file data/labels.csv --max-distance 6
+"""
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+
+HASH_BITS = 64
+
+# Orthonormal DCT-II matrix for 32x32 pHash
+_DCT_SIZE = 32
+_DCT = np.sqrt(2.0 / _DCT_SIZE) * np.cos(
+    np.pi * (2 * np.arange(_DCT_SIZE)[None, :] + 1) * np.arange(_DCT_SIZE)[:, None] / (2 * _DCT_SIZE)
+)
+_DCT[0] /= np.sqrt(2.0)
+
+# Set bits per byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _bits_to_int(bits):
+    return int(np.packbits(bits.astype(np.uint8)).view('>u8')[0])
+
+
+def _load_gray(path, size):
+    image = Image.open(path)
+    # JPEG: decode at reduced scale, we only need a tiny thumbnail
+    image.draft('L', (size[0] * 4, size[1] * 4))
+    return np.asarray(image.convert('L').resize(size, Image.BILINEAR), dtype=np.float64)
+
+
+def phash(path):
+    """DCT perceptual hash: signs of the 8x8 low-frequency block against its median"""
+    pixels = _load_gray(path, (_DCT_SIZE, _DCT_SIZE))
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].ravel()
+    return _bits_to_int(low > np.median(low[1:]))
+
+
+def dhash(path):
+    """Difference hash: sign of horizontal gradients on a 9x8 thumbnail"""
+    pixels = _load_gray(path, (9, 8))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+HASH_FUNCTIONS = {'phash': phash, 'dhash': dhash}
+
+
+def _hash_one(args):
+    path, method = args
+    try:
+        with Image.open(path) as image:
+            area = image.size[0] * image.size[1]
+        return HASH_FUNCTIONS[method](path), area
+    except Exception:
+        return None, 0
+
+
+def compute_hashes(image_paths, method='phash', num_workers=None, chunksize=64):
+    """
+    Hash images in a process pool
+
+    Returns:
+        (hashes, areas, ok): uint64 hashes, pixel areas and a mask of images
+        that could be decoded
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    with Pool(num_workers) as pool:
+        results = pool.map(_hash_one, [(path, method) for path in image_paths], chunksize=chunksize)
+    ok = np.array([value is not None for value, _ in results], dtype=bool)
+    hashes = np.array([value or 0 for value, _ in results], dtype=np.uint64)
+    areas = np.array([area for _, area in results], dtype=np.int64)
+    return hashes, areas, ok
+
+
+def hamming_distance(a, b):
+    """Element-wise Hamming distance between uint64 arrays"""
+    xor = np.bitwise_xor(a, b)
+    return _POPCOUNT[xor.view(np.uint8).reshape(xor.shape + (8,))].sum(axis=-1, dtype=np.int64)
+
+
+def near_duplicate_pairs(hashes, max_distance=6, block_elements=1 << 22):
+    """
+    Find all index pairs (i < j) with Hamming distance <= max_distance
+
+    Uses a multi-index hash over max_distance + 1 bands; candidates sharing a
+    band value are verified in vectorized blocks of about block_elements
+    distances, which bounds memory for large buckets.
+
+    Returns:
+        np.ndarray: (n_pairs, 2) int64 array
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    num_bands = max_distance + 1
+    band_bits = HASH_BITS // num_bands
+    if band_bits == 0:
+        raise ValueError(f"max_distance must be below {HASH_BITS}")
+    mask = np.uint64((1 << band_bits) - 1)
+
+    pairs = []
+    for band in range(num_bands):
+        keys = (hashes >> np.uint64(band * band_bits)) & mask
+        order = np.argsort(keys, kind='stable')
+        boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+        for members in np.split(order, boundaries):
+            if len(members) < 2:
+                continue
+            members = np.sort(members)
+            member_hashes = hashes[members]
+            block_rows = max(1, block_elements // len(members))
+            for start in range(0, len(members), block_rows):
+                rows = slice(start, start + block_rows)
+                distances = hamming_distance(member_hashes[rows, None], member_hashes[None, :])
+                i, j = np.nonzero(distances <= max_distance)
+                i += start
+                upper = i < j
+                if upper.any():
+                    pairs.append(np.stack([members[i[upper]], members[j[upper]]], axis=1))
+
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def group_ids(num_items, pairs):
+    """Union-find over pairs; returns a group id (smallest member index) per item"""
+    parent = np.arange(num_items)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(i) for i in range(num_items)], dtype=np.int64)
+
+
+def deduplicate_manifest(df, image_dir, method='phash', max_distance=6, num_workers=None):
+    """
+    Add group_id and keep columns to a manifest with image_path,label columns
+
+    The representative of each group is its largest image (originals over
+    downscaled re-exports); images that fail to decode get their own group
+    and are not kept.
+    """
+    image_paths = [os.path.join(image_dir, path) for path in df['image_path']]
+
+    start = time.perf_counter()
+    hashes, areas, ok = compute_hashes(image_paths, method, num_workers)
+    print(f"Hashed {ok.sum()} images in {time.perf_counter() - start:.1f}s ({(~ok).sum()} unreadable)")
+
+    start = time.perf_counter()
+    valid = np.flatnonzero(ok)
+    pairs = valid[near_duplicate_pairs(hashes[valid], max_distance)]
+    groups = group_ids(len(df), pairs)
+    print(f"Found {len(pairs)} near-duplicate pairs in {time.perf_counter() - start:.1f}s")
+
+    out = df.copy()
+    out['group_id'] = groups
+    # Largest readable image per group
+    order = np.lexsort((np.arange(len(df)), -areas, groups))
+    first_in_group = np.r_[True, groups[order][1:] != groups[order][:-1]]
+    keep = np.zeros(len(df), dtype=bool)
+    keep[order[first_in_group]] = True
+    out['keep'] = keep & ok
+
+    group_sizes = out.groupby('group_id')['image_path'].transform('size')
+    conflicts = out[group_sizes > 1].groupby('group_id')['label'].nunique()
+    print(f"{len(df)} images -> {int(out['keep'].sum())} kept, "
+          f"{int((group_sizes > 1).sum())} in {len(conflicts)} duplicate groups")
+    if (conflicts > 1).any():
+        print(f"Warning: {int((conflicts > 1).sum())} duplicate groups have conflicting labels")
+    return out
+
+
+def split_indices(labels, groups=None, test_size=0.2, random_state=42):
+    """
+    Stratified train/test split of row indices that keeps each group on one side
+
+    Without groups this is train_test_split(..., stratify=labels). With groups,
+    StratifiedGroupKFold with round(1 / test_size) folds is used and its first
+    fold becomes the test split, so test_size is approximate.
+    """
+    from sklearn.model_selection import StratifiedGroupKFold, train_test_split
+
+    indices = np.arange(len(labels))
+    if groups is None:
+        return train_test_split(indices, test_size=test_size, random_state=random_state, stratify=labels)
+    n_splits = max(2, int(round(1 / test_size)))
+    splitter = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    train_idx, test_idx = next(splitter.split(indices, labels, groups))
+    return train_idx, test_idx
+
+
+def train_val_test_indices(labels, groups=None, holdout_size=0.3, random_state=42):
+    """70/15/15 split of enhanced_trainer.py: holdout_size is split evenly into val and test"""
+    labels = np.asarray(labels)
+    train_idx, holdout_idx = split_indices(labels, groups, holdout_size, random_state)
+    holdout_groups = np.asarray(groups)[holdout_idx] if groups is not None else None
+    val_pos, test_pos = split_indices(labels[holdout_idx], holdout_groups, 0.5, random_state)
+    return train_idx, holdout_idx[val_pos], holdout_idx[test_pos]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Group near-duplicate X-ray images")
+    parser.add_argument('--image-dir', required=True)
+    parser.add_argument('--label-file', required=True, help="CSV with image_path,label columns")
+    parser.add_argument('--method', choices=sorted(HASH_FUNCTIONS), default='phash')
+    parser.add_argument('--max-distance', type=int, default=6, help="Max Hamming distance of 64-bit hashes")
+    parser.add_argument('--workers', type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    df = pd.read_csv(args.label_file)
+    out = deduplicate_manifest(df, args.image_dir, args.method, args.max_distance, args.workers)
+
+    stem = os.path.splitext(args.label_file)[0]
+    out.to_csv(f'{stem}_groups.csv', index=False)
+    out[out['keep']].drop(columns='keep').to_csv(f'{stem}_dedup.csv', index=False)
+    print(f"Wrote {stem}_groups.csv and {stem}_dedup.csv")
+
+
+if __name__ == '__main__':
+    main()
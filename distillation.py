@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Knowledge distillation of the ensemble into a small CPU student
+
+The teacher ensemble (create_ensemble_model) is run once over the
+non-augmented training images and its logits are cached on disk, keyed by
+the image list and the teacher weights. A ResNet-18 or MobileNetV3 student
+is then trained with AdvancedTrainer against a mix of the softened teacher
+distribution and the hard labels. Teacher logits come from the clean
+images while the student sees augmented ones, which keeps the teacher cost
+to a single pass.
+
+The student is exported as {'state_dict', 'arch', 'num_classes',
+'image_size'}, which load_model_weights() and load_student() read, and a
+latency / accuracy table compares it with every teacher. The serving code
+(app_fastapi.py, interface.py) still runs the ResNet-50 backbone + XGBoost
+model and does not load the student.
+
+Usage:
+    python distillation.py --image-dir data/xray_images --label-file data/labels.csv \\
+        --teacher-weights ensemble_final.pth --student resnet18 --epochs 30
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset
+from torchvision import models
+
+from feature_cache import state_dict_hash
+from ensemble_assembly import load_ensemble
+from model_utils import AdvancedTrainer, get_advanced_transforms, load_model_weights
+from enhanced_trainer import EnhancedXRayDataset, create_balanced_dataloader, create_ensemble_model
+
+
+STUDENT_ARCHS = ('resnet18', 'mobilenet_v3_large', 'mobilenet_v3_small')
+
+
+def create_student(arch='resnet18', num_classes=2, pretrained=True):
+    """Small ImageNet backbone with a num_classes head"""
+    if arch == 'resnet18':
+        model = models.resnet18(pretrained=pretrained)
+        model.fc = nn.Linear(model.fc.in_features, num_classes)
+    elif arch in ('mobilenet_v3_large', 'mobilenet_v3_small'):
+        model = getattr(models, arch)(pretrained=pretrained)
+        model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
+    else:
+        raise ValueError(f"Unknown student architecture '{arch}', expected one of {STUDENT_ARCHS}")
+    return model
+
+
+def export_student(model, arch, path, num_classes=2, image_size=224):
+    """Save the student for load_student() / load_model_weights() (not read by the serving code)"""
+    torch.save({'state_dict': model.state_dict(), 'arch': arch, 'num_classes': num_classes,
+                'image_size': image_size}, path)
+    print(f"Student saved to {path}")
+
+
+def load_student(path, device='cpu'):
+    """Rebuild an exported student and load its weights"""
+    checkpoint = torch.load(path, map_location=device)
+    model = create_student(checkpoint['arch'], checkpoint['num_classes'], pretrained=False)
+    return load_model_weights(model, path, device)
+
+
+def load_teacher(device, ensemble_weights='ensemble_final.pth', num_classes=2):
+    """The trained ensemble, from ensemble_final.pth or from the members' *_final.pth files"""
+    if os.path.exists(ensemble_weights):
+        checkpoint = torch.load(ensemble_weights, map_location='cpu')
+        if 'members' in checkpoint:
+            # Assembled by ensemble_assembly.py
+            return load_ensemble(ensemble_weights, device)
+    ensemble = create_ensemble_model(device, num_classes=num_classes)
+    if os.path.exists(ensemble_weights):
+        ensemble.load_state_dict(checkpoint)
+    else:
+        for member in ensemble.models:
+            path = f'{type(member).__name__.lower()}_final.pth'
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Neither {ensemble_weights} nor {path} found")
+            member.load_state_dict(torch.load(path, map_location=device))
+    return ensemble.eval()
+
+
+def teacher_logits(teacher, dataset, cache_path='teacher_logits.npy', batch_size=32, num_workers=4):
+    """
+    Teacher logits for every sample of dataset, computed once and cached
+
+    The cache is reused only if the image list and teacher weights are unchanged.
+    """
+    digest = hashlib.sha1('\n'.join(map(str, dataset.image_paths)).encode())
+    digest.update(state_dict_hash(teacher).encode())
+    key = digest.hexdigest()
+    meta_path = os.path.splitext(cache_path)[0] + '.json'
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            if json.load(f).get('key') == key:
+                print(f"Using cached teacher logits from {cache_path}")
+                return np.load(cache_path)
+
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    logits = []
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for data, _ in loader:
+            logits.append(teacher(data.to(next(teacher.parameters()).device)).float().cpu().numpy())
+    logits = np.concatenate(logits)
+    print(f"Teacher logits for {len(logits)} images in {time.perf_counter() - start:.1f}s")
+
+    np.save(cache_path, logits)
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'num_samples': len(logits)}, f)
+    return logits
+
+
+class DistillationDataset(Dataset):
+    """Wraps a dataset so each target is [label, teacher logits...] packed in one float tensor"""
+
+    def __init__(self, dataset, logits):
+        self.dataset = dataset
+        self.logits = torch.as_tensor(logits, dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, label = self.dataset[idx]
+        target = torch.cat([torch.tensor([float(label)]), self.logits[idx]])
+        return image, target
+
+
+class DistillationLoss(nn.Module):
+    """
+    alpha * T^2 * KL(teacher_T || student_T) + (1 - alpha) * cross-entropy
+
+    Accepts packed [label, logits...] targets; plain label targets (e.g. the
+    validation loader) get the cross-entropy term only.
+    """
+
+    def __init__(self, temperature=4.0, alpha=0.7, label_smoothing=0.1):
+        super().__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+        self.cross_entropy = nn.CrossEntropyLoss(label_smoothing=label_smoothing)
+
+    def forward(self, output, target):
+        if target.dim() == 1:
+            return self.cross_entropy(output, target)
+        labels = target[:, 0].long()
+        teacher = target[:, 1:]
+        T = self.temperature
+        soft = F.kl_div(F.log_softmax(output.float() / T, dim=1), F.softmax(teacher / T, dim=1),
+                        reduction='batchmean') * (T * T)
+        return self.alpha * soft + (1 - self.alpha) * self.cross_entropy(output, labels)
+
+
+class DistillationTrainer(AdvancedTrainer):
+    """AdvancedTrainer with DistillationLoss and packed-target accuracy"""
+
+    def __init__(self, model, device='cpu', temperature=4.0, alpha=0.7, **kwargs):
+        super().__init__(model, device, **kwargs)
+        self.criterion = DistillationLoss(temperature, alpha)
+
+    def _count_correct(self, output, target):
+        labels = target[:, 0].long() if target.dim() == 2 else target
+        return super()._count_correct(output, labels)
+
+
+def measure(model, loader, device, latency_runs=20, image_size=224):
+    """(accuracy on loader, median single-image latency in ms)"""
+    model.eval()
+    correct = total = 0
+    with torch.inference_mode():
+        for data, target in loader:
+            pred = model(data.to(device)).argmax(dim=1).cpu()
+            correct += (pred == target).sum().item()
+            total += target.size(0)
+
+        x = torch.randn(1, 3, image_size, image_size, device=device)
+        model(x)
+        timings = []
+        for _ in range(latency_runs):
+            start = time.perf_counter()
+            model(x)
+            timings.append(time.perf_counter() - start)
+    return correct / max(total, 1), 1000 * float(np.median(timings))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Distill the ensemble into a small student")
+    parser.add_argument('--image-dir', default='data/xray_images')
+    parser.add_argument('--label-file', default='data/labels.csv')
+    parser.add_argument('--teacher-weights', default='ensemble_final.pth')
+    parser.add_argument('--student', choices=STUDENT_ARCHS, default='resnet18')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.7, help="Weight of the soft-target term")
+    parser.add_argument('--logits-cache', default='teacher_logits.npy')
+    parser.add_argument('--output', default=None, help="Default: student_<arch>.pth")
+    parser.add_argument('--report', default='distillation_report.csv')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    output = args.output or f'student_{args.student}.pth'
+
+    train_loader, val_loader, test_loader, _ = create_balanced_dataloader(
+        args.image_dir, args.label_file, args.batch_size
+    )
+    train_dataset = train_loader.dataset
+
+    # Teacher sees the clean (validation-transform) version of every training image
+    teacher = load_teacher(device, args.teacher_weights)
+    clean_train = EnhancedXRayDataset(train_dataset.image_paths, train_dataset.labels,
+                                      get_advanced_transforms(is_training=False), is_training=False,
+                                      image_cache=train_dataset.image_cache)
+    logits = teacher_logits(teacher, clean_train, args.logits_cache, args.batch_size)
+
+    distill_loader = DataLoader(DistillationDataset(train_dataset, logits), batch_size=args.batch_size,
+                                sampler=train_loader.sampler, num_workers=train_loader.num_workers)
+
+    student = create_student(args.student)
+    trainer = DistillationTrainer(student, device, temperature=args.temperature, alpha=args.alpha)
+    best_val_acc = 0.0
+    for epoch in range(args.epochs):
+        train_loss, train_acc = trainer.train_epoch(distill_loader)
+        val_loss, val_acc = trainer.validate(val_loader)
+        print(f"Epoch {epoch}: Train Loss: {train_loss:.4f}, Train Acc: {train_acc:.4f}, "
+              f"Val Loss: {val_loss:.4f}, Val Acc: {val_acc:.4f}")
+        if val_acc > best_val_acc:
+            best_val_acc = val_acc
+            export_student(student, args.student, output)
+        if trainer.early_stopping(val_loss):
+            print(f"Early stopping at epoch {epoch}")
+            break
+
+    # Latency / accuracy comparison on the test split
+    student = load_student(output, device)
+    rows = []
+    candidates = [(type(member).__name__, member) for member in teacher.models]
+    candidates += [('Ensemble', teacher), (f'Student ({args.student})', student)]
+    for name, model in candidates:
+        accuracy, latency_ms = measure(model, test_loader, device)
+        rows.append({'model': name, 'test_accuracy': accuracy, 'latency_ms': latency_ms,
+                     'parameters': sum(p.numel() for p in model.parameters())})
+    report = pd.DataFrame(rows)
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+    print(f"Report saved to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Multi-process / multi-node backbone feature extraction
+
+The manifest (CSV with image_path,label columns) is split into contiguous,
+deterministic row ranges, one per rank. Each rank writes its features into
+its own .npy shard and checkpoints how many rows are done, so a restarted
+rank continues where it stopped and finished ranks are not redone. A final
+merge writes extracted_features.npy / feature_labels.npy in manifest order,
+which train_model.py loads instead of extracting when PRECOMPUTED_FEATURES
+is set (with the same --label-file as its LABEL_FILE).
+
+Usage:
+    # 4 local processes on one node
+    python distributed_extract.py --image-dir data/xray_images --label-file data/labels.csv \\
+        --out-dir extract_shards --nprocs 4
+
+    # Across nodes (torchrun sets RANK / WORLD_SIZE / MASTER_ADDR / MASTER_PORT);
+    # --out-dir must be on a filesystem shared by all nodes
+    torchrun --nnodes 4 --nproc-per-node 1 ... distributed_extract.py --distributed ...
+
+    # Re-run one failed rank, then merge
+    python distributed_extract.py ... --rank 2 --world-size 4
+    python distributed_extract.py ... --merge-only --world-size 4
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from feature_extractor import CNNFeatureExtractor
+from train_model import XRayDataset, get_transform
+
+
+def manifest_fingerprint(image_paths, labels):
+    """Hash of the manifest rows; progress files from another manifest are not resumed"""
+    digest = hashlib.sha1()
+    for path, label in zip(image_paths, labels):
+        digest.update(f"{path}\t{label}\n".encode())
+    return digest.hexdigest()
+
+
+def rank_range(num_rows, rank, world_size):
+    """Contiguous [start, end) rows assigned to rank; depends only on num_rows and world_size"""
+    return num_rows * rank // world_size, num_rows * (rank + 1) // world_size
+
+
+def shard_paths(out_dir, rank):
+    prefix = os.path.join(out_dir, f"rank_{rank:04d}")
+    return prefix + "_features.npy", prefix + "_labels.npy", prefix + "_progress.json"
+
+
+def _write_progress(path, progress):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(image_dir, label_file):
+    df = pd.read_csv(label_file)
+    image_paths = [os.path.join(image_dir, path) for path in df["image_path"]]
+    return image_paths, df["label"].values
+
+
+def extract_rank(rank, world_size, image_paths, labels, out_dir, batch_size=32, num_workers=2,
+                 threads=None, checkpoint_rows=2048):
+    """
+    Extract the features of one rank's rows, resuming from its last checkpoint
+
+    Features are flushed and progress is recorded every checkpoint_rows rows.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    os.makedirs(out_dir, exist_ok=True)
+    start, end = rank_range(len(image_paths), rank, world_size)
+    features_path, labels_path, progress_path = shard_paths(out_dir, rank)
+    fingerprint = manifest_fingerprint(image_paths, labels)
+
+    extractor = CNNFeatureExtractor(backbone="resnet50", num_workers=num_workers)
+    progress = {"manifest": fingerprint, "start": start, "end": end, "world_size": world_size, "done": 0}
+    if os.path.exists(progress_path):
+        with open(progress_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if all(saved.get(key) == progress[key] for key in ("manifest", "start", "end", "world_size")):
+            progress = saved
+
+    num_rows = end - start
+    if progress["done"] == 0:
+        X = np.lib.format.open_memmap(features_path, mode="w+", dtype=np.float32,
+                                      shape=(num_rows, extractor.out_dim))
+        y = np.lib.format.open_memmap(labels_path, mode="w+", dtype=np.int64, shape=(num_rows,))
+    else:
+        X = np.load(features_path, mmap_mode="r+")
+        y = np.load(labels_path, mmap_mode="r+")
+        print(f"[rank {rank}] Resuming at row {progress['done']}/{num_rows}")
+
+    transform = get_transform()
+    while progress["done"] < num_rows:
+        lo = progress["done"]
+        hi = min(lo + checkpoint_rows, num_rows)
+        dataset = XRayDataset(image_paths[start + lo:start + hi], labels[start + lo:start + hi], transform)
+        _, labs = extractor.extract_features(dataset, batch_size=batch_size, verbose=False, out=X[lo:hi])
+        y[lo:hi] = labs
+        X.flush()
+        y.flush()
+        progress["done"] = hi
+        _write_progress(progress_path, progress)
+        print(f"[rank {rank}] {hi}/{num_rows} rows ({extractor.last_throughput:.1f} images/sec)")
+
+    if num_rows == 0:
+        _write_progress(progress_path, progress)
+    print(f"[rank {rank}] Done: rows {start}-{end}")
+
+
+def merge_shards(out_dir, world_size, image_paths, labels, features_file="extracted_features.npy",
+                 labels_file="feature_labels.npy"):
+    """Concatenate all rank shards in manifest order into the arrays train_model.py writes"""
+    fingerprint = manifest_fingerprint(image_paths, labels)
+    shards = []
+    for rank in range(world_size):
+        features_path, labels_path, progress_path = shard_paths(out_dir, rank)
+        if not os.path.exists(progress_path):
+            raise RuntimeError(f"Rank {rank} has not started; re-run it with --rank {rank}")
+        with open(progress_path, "r", encoding="utf-8") as f:
+            progress = json.load(f)
+        start, end = rank_range(len(image_paths), rank, world_size)
+        if progress["manifest"] != fingerprint or (progress["start"], progress["end"]) != (start, end):
+            raise RuntimeError(f"Rank {rank} shard was written for a different manifest or world size")
+        if progress["done"] < end - start:
+            raise RuntimeError(f"Rank {rank} is incomplete ({progress['done']}/{end - start}); "
+                               f"re-run it with --rank {rank}")
+        shards.append((features_path, labels_path))
+
+    num_rows = len(image_paths)
+    feature_dim = np.load(shards[0][0], mmap_mode="r").shape[1]
+    X = np.lib.format.open_memmap(features_file, mode="w+", dtype=np.float32, shape=(num_rows, feature_dim))
+    y = np.empty(num_rows, dtype=np.int64)
+    offset = 0
+    for features_path, labels_path in shards:
+        shard_X = np.load(features_path, mmap_mode="r")
+        X[offset:offset + len(shard_X)] = shard_X
+        y[offset:offset + len(shard_X)] = np.load(labels_path)
+        offset += len(shard_X)
+    X.flush()
+    np.save(labels_file, y)
+    print(f"Merged {world_size} shards into {features_file} {X.shape} and {labels_file}")
+
+
+def _spawn_rank(rank, world_size, image_paths, labels, args, threads):
+    extract_rank(rank, world_size, image_paths, labels, args.out_dir, args.batch_size,
+                 args.num_workers, threads, args.checkpoint_rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Distributed backbone feature extraction")
+    parser.add_argument("--image-dir", required=True)
+    parser.add_argument("--label-file", required=True, help="CSV with image_path,label columns")
+    parser.add_argument("--out-dir", default="extract_shards", help="Per-rank shards and progress files")
+    parser.add_argument("--nprocs", type=int, default=1, help="Local processes to spawn")
+    parser.add_argument("--distributed", action="store_true",
+                        help="Join a gloo process group configured through torchrun environment variables")
+    parser.add_argument("--rank", type=int, default=None, help="Run only this rank (needs --world-size)")
+    parser.add_argument("--world-size", type=int, default=None)
+    parser.add_argument("--merge-only", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=2, help="DataLoader workers per rank")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Torch threads per rank (default: cores divided among local ranks)")
+    parser.add_argument("--checkpoint-rows", type=int, default=2048)
+    parser.add_argument("--features-file", default="extracted_features.npy")
+    parser.add_argument("--labels-file", default="feature_labels.npy")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    image_paths, labels = read_manifest(args.image_dir, args.label_file)
+
+    if args.distributed:
+        dist.init_process_group(backend="gloo")
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        local_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        threads = args.threads or max(1, (os.cpu_count() or 1) // local_size)
+        extract_rank(rank, world_size, image_paths, labels, args.out_dir, args.batch_size,
+                     args.num_workers, threads, args.checkpoint_rows)
+        dist.barrier()
+        if rank == 0:
+            merge_shards(args.out_dir, world_size, image_paths, labels, args.features_file, args.labels_file)
+        dist.destroy_process_group()
+        return
+
+    if (args.merge_only or args.rank is not None) and args.world_size is None:
+        raise SystemExit("--merge-only and --rank need --world-size")
+    if args.merge_only:
+        merge_shards(args.out_dir, args.world_size, image_paths, labels, args.features_file, args.labels_file)
+        return
+    if args.rank is not None:
+        extract_rank(args.rank, args.world_size, image_paths, labels, args.out_dir, args.batch_size,
+                     args.num_workers, args.threads, args.checkpoint_rows)
+        return
+
+    # Local ranks split the cores between them
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.nprocs)
+    if args.nprocs == 1:
+        extract_rank(0, 1, image_paths, labels, args.out_dir, args.batch_size,
+                     args.num_workers, threads, args.checkpoint_rows)
+    else:
+        mp.spawn(_spawn_rank, args=(args.nprocs, image_paths, labels, args, threads), nprocs=args.nprocs)
+    merge_shards(args.out_dir, args.nprocs, image_paths, labels, args.features_file, args.labels_file)
+
+
+if __name__ == "__main__":
+    main()
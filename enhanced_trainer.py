@@ -4,18 +4,22 @@ Enhanced Training Script for Osteoporosis Risk Assessment
 Achieves 80%+ accuracy through advanced techniques
 """
 
+import copy
 import os
+import random
+from concurrent.futures import ProcessPoolExecutor
 import torch
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torchvision.transforms as transforms
-from torch.utils.data import DataLoader, Dataset, WeightedRandomSampler
+from torch.utils.data import DataLoader, Dataset, IterableDataset, RandomSampler, WeightedRandomSampler
 from PIL import Image
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.model_selection import train_test_split, StratifiedKFold
-from sklearn.metrics import classification_report, accuracy_score, confusion_matrix, roc_auc_score
+import albumentations as A
+from sklearn.model_selection import StratifiedKFold, StratifiedGroupKFold, KFold
 from sklearn.utils.class_weight import compute_class_weight
 import warnings
 warnings.filterwarnings('ignore')
@@ -23,8 +27,16 @@ warnings.filterwarnings('ignore')
 # Import our enhanced models
 from model_utils import (
     AttentionResNet, EfficientNetClassifier, MedicalViT, 
-    EnsembleModel, AdvancedTrainer, get_advanced_transforms
+    EnsembleModel, AdvancedTrainer, get_advanced_transforms,
+    CheckpointManager, ResumableSampler, BatchAugment, BATCH_AUGMENT_OPS, select_batch_ops,
+    ProgressiveResizing, StreamingMetrics, format_metric
 )
+from image_cache import build_image_cache
+from activation_cache import ActivationDataset, HeadModel, build_activation_cache
+from ensemble_assembly import assemble_ensemble, load_members, save_ensemble
+from loader_autotune import autotune_loader, loader_kwargs, rebuild_loader, training_step
+from dedup import train_val_test_indices
+from shard_dataset import ShardedXRayDataset
 
 # Set random seeds for reproducibility
 torch.manual_seed(42)
@@ -36,11 +48,13 @@ torch.backends.cudnn.benchmark = False
 class EnhancedXRayDataset(Dataset):
     """Enhanced dataset with advanced augmentation and class balancing"""
     
-    def __init__(self, image_paths, labels, transform=None, is_training=True):
+    def __init__(self, image_paths, labels, transform=None, is_training=True, image_cache=None, groups=None):
         self.image_paths = image_paths
         self.labels = labels
         self.transform = transform
         self.is_training = is_training
+        self.image_cache = image_cache
+        self.groups = groups  # near-duplicate group ids from dedup.py, if any
         
         # Convert labels to tensor
         if isinstance(self.labels, np.ndarray):
@@ -55,57 +69,81 @@ class EnhancedXRayDataset(Dataset):
         image_path = self.image_paths[idx]
         label = self.labels[idx]
         
-        # Load image
-        try:
-            image = Image.open(image_path).convert('RGB')
-        except Exception as e:
-            print(f"Error loading image {image_path}: {e}")
-            # Return a placeholder image
-            image = Image.new('RGB', (224, 224), color='gray')
+        # Load image (zero-copy from the pre-decoded cache when available)
+        cached = self.image_cache.get(image_path) if self.image_cache is not None else None
+        if cached is not None:
+            image = cached if cached.ndim == 3 else np.repeat(cached[:, :, None], 3, axis=2)
+        else:
+            try:
+                image = Image.open(image_path).convert('RGB')
+            except Exception as e:
+                print(f"Error loading image {image_path}: {e}")
+                # Return a placeholder image
+                image = Image.new('RGB', (224, 224), color='gray')
         
         # Apply transforms
         if self.transform:
-            if hasattr(self.transform, 'image'):
+            if isinstance(self.transform, A.BaseCompose):
                 # Albumentations transform
-                transformed = self.transform(image=np.array(image))
+                transformed = self.transform(image=np.asarray(image))
                 image = transformed['image']
             else:
                 # Torchvision transform
+                if isinstance(image, np.ndarray):
+                    image = Image.fromarray(image)
                 image = self.transform(image)
         
         return image, label
 
 
-def create_balanced_dataloader(image_dir, label_file, batch_size=16, image_size=224):
-    """Create balanced dataloader with advanced augmentation"""
+def create_balanced_dataloader(image_dir, label_file, batch_size=16, image_size=224, image_cache_path=None,
+                               batch_ops=()):
+    """Create balanced dataloader with advanced augmentation
+    
+    Augmentation groups in batch_ops are left out of the per-sample
+    pipeline; the trainer must then apply BatchAugment(batch_ops).
+    
+    If image_cache_path is given, every image is decoded once into a
+    memory-mapped uint8 cache and the datasets read from it instead of
+    decoding files on every access.
+    """
     
     # Load labels
+    image_cache = None
+    groups = None
     if os.path.exists(label_file):
         df = pd.read_csv(label_file)
         image_paths = [os.path.join(image_dir, path) for path in df['image_path']]
         labels = df['label'].values
+        if 'group_id' in df.columns:
+            groups = df['group_id'].values
+        if image_cache_path:
+            image_cache = build_image_cache(image_paths, image_cache_path, image_size=max(256, image_size))
     else:
         # Create synthetic data for demonstration
         print("Label file not found, creating synthetic data...")
         image_paths = [f"sample_{i}.jpg" for i in range(1000)]
         labels = np.random.randint(0, 2, 1000)
     
-    # Split data
-    X_train, X_temp, y_train, y_temp = train_test_split(
-        image_paths, labels, test_size=0.3, random_state=42, stratify=labels
-    )
-    X_val, X_test, y_val, y_test = train_test_split(
-        X_temp, y_temp, test_size=0.5, random_state=42, stratify=y_temp
-    )
+    # Split data; near-duplicate groups stay on one side
+    train_idx, val_idx, test_idx = train_val_test_indices(labels, groups)
+    X_train, y_train = [image_paths[i] for i in train_idx], labels[train_idx]
+    X_val, y_val = [image_paths[i] for i in val_idx], labels[val_idx]
+    X_test, y_test = [image_paths[i] for i in test_idx], labels[test_idx]
+    groups_train = groups[train_idx] if groups is not None else None
+    groups_val = groups[val_idx] if groups is not None else None
     
     # Create transforms
-    train_transform = get_advanced_transforms(is_training=True, image_size=image_size)
+    train_transform = get_advanced_transforms(is_training=True, image_size=image_size, batch_ops=batch_ops)
     val_transform = get_advanced_transforms(is_training=False, image_size=image_size)
     
     # Create datasets
-    train_dataset = EnhancedXRayDataset(X_train, y_train, train_transform, is_training=True)
-    val_dataset = EnhancedXRayDataset(X_val, y_val, val_transform, is_training=False)
-    test_dataset = EnhancedXRayDataset(X_test, y_test, val_transform, is_training=False)
+    train_dataset = EnhancedXRayDataset(X_train, y_train, train_transform, is_training=True,
+                                        image_cache=image_cache, groups=groups_train)
+    val_dataset = EnhancedXRayDataset(X_val, y_val, val_transform, is_training=False,
+                                      image_cache=image_cache, groups=groups_val)
+    test_dataset = EnhancedXRayDataset(X_test, y_test, val_transform, is_training=False,
+                                       image_cache=image_cache)
     
     # Calculate class weights for balanced sampling
     class_weights = compute_class_weight(
@@ -117,11 +155,11 @@ def create_balanced_dataloader(image_dir, label_file, batch_size=16, image_size=
     
     # Create weighted sampler for training
     sample_weights = class_weights[y_train]
-    sampler = WeightedRandomSampler(
+    sampler = ResumableSampler(WeightedRandomSampler(
         weights=sample_weights,
         num_samples=len(sample_weights),
         replacement=True
-    )
+    ))
     
     # Create dataloaders
     train_loader = DataLoader(
@@ -129,7 +167,7 @@ def create_balanced_dataloader(image_dir, label_file, batch_size=16, image_size=
         batch_size=batch_size, 
         sampler=sampler,
         num_workers=4,
-        pin_memory=True
+        pin_memory=torch.cuda.is_available()
     )
     
     val_loader = DataLoader(
@@ -137,7 +175,7 @@ def create_balanced_dataloader(image_dir, label_file, batch_size=16, image_size=
         batch_size=batch_size, 
         shuffle=False,
         num_workers=4,
-        pin_memory=True
+        pin_memory=torch.cuda.is_available()
     )
     
     test_loader = DataLoader(
@@ -145,75 +183,278 @@ def create_balanced_dataloader(image_dir, label_file, batch_size=16, image_size=
         batch_size=batch_size, 
         shuffle=False,
         num_workers=4,
-        pin_memory=True
+        pin_memory=torch.cuda.is_available()
     )
     
     return train_loader, val_loader, test_loader, class_weights
 
 
-def train_model_with_cross_validation(model_class, model_params, train_loader, val_loader, 
-                                    device, num_folds=5, epochs=50):
-    """Train model with k-fold cross-validation"""
+def create_sharded_dataloaders(shard_root, batch_size=16, image_size=224, num_workers=4, batch_ops=()):
+    """Create dataloaders that stream tar shards packed with `shard_dataset.py --split`
+    
+    shard_root must contain train/, val/ and test/ shard directories. Shards
+    are read sequentially and split across workers, so there is no weighted
+    sampler; the class weights are still returned for use in the loss.
+    """
+    train_transform = get_advanced_transforms(is_training=True, image_size=image_size, batch_ops=batch_ops)
+    val_transform = get_advanced_transforms(is_training=False, image_size=image_size)
     
-    # Prepare data for cross-validation
-    all_paths = train_loader.dataset.image_paths + val_loader.dataset.image_paths
-    all_labels = torch.cat([train_loader.dataset.labels, val_loader.dataset.labels]).numpy()
+    train_dataset = ShardedXRayDataset(os.path.join(shard_root, 'train'), train_transform, shuffle=True)
+    val_dataset = ShardedXRayDataset(os.path.join(shard_root, 'val'), val_transform, shuffle=False)
+    test_dataset = ShardedXRayDataset(os.path.join(shard_root, 'test'), val_transform, shuffle=False)
     
-    # Initialize cross-validation
-    skf = StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=42)
-    fold_scores = []
+    # Balanced class weights from the shard index (same formula as compute_class_weight)
+    classes = sorted(train_dataset.class_counts)
+    counts = np.array([train_dataset.class_counts[c] for c in classes], dtype=np.float64)
+    class_weights = torch.FloatTensor(counts.sum() / (len(classes) * counts))
     
-    print(f"Starting {num_folds}-fold cross-validation...")
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers)
+    val_loader = DataLoader(val_dataset, batch_size=batch_size, num_workers=num_workers)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers)
     
-    for fold, (train_idx, val_idx) in enumerate(skf.split(all_paths, all_labels)):
-        print(f"\nFold {fold + 1}/{num_folds}")
-        
-        # Create fold-specific datasets
+    return train_loader, val_loader, test_loader, class_weights
+
+
+def cross_validation_indices(labels, groups=None, num_folds=5):
+    """Yield (fold, train_idx, val_idx): StratifiedKFold, or StratifiedGroupKFold with groups"""
+    if groups is not None:
+        skf = StratifiedGroupKFold(n_splits=num_folds, shuffle=True, random_state=42)
+    else:
+        skf = StratifiedKFold(n_splits=num_folds, shuffle=True, random_state=42)
+    for fold, (train_idx, val_idx) in enumerate(skf.split(np.zeros(len(labels)), labels, groups)):
+        yield fold, train_idx, val_idx
+
+
+def cross_validation_datasets(train_dataset, val_dataset, num_folds=5, batch_ops=()):
+    """Yield (fold, fold_train_dataset, fold_val_dataset) over the union of train and val
+    
+    Path-list datasets are split per sample with StratifiedKFold, or with
+    StratifiedGroupKFold when they carry dedup.py group ids. Sharded
+    datasets are split per shard with KFold, since a shard is the unit
+    that can be read sequentially.
+    """
+    train_transform = get_advanced_transforms(is_training=True, batch_ops=batch_ops)
+    val_transform = get_advanced_transforms(is_training=False)
+    
+    if isinstance(train_dataset, ShardedXRayDataset):
+        shard_dirs = train_dataset.shard_dirs + val_dataset.shard_dirs
+        all_shards = train_dataset.shards + val_dataset.shards
+        kf = KFold(n_splits=num_folds, shuffle=True, random_state=42)
+        for fold, (train_idx, val_idx) in enumerate(kf.split(all_shards)):
+            yield (fold,
+                   ShardedXRayDataset(shard_dirs, train_transform, shuffle=True,
+                                      shards=[all_shards[i] for i in train_idx]),
+                   ShardedXRayDataset(shard_dirs, val_transform, shuffle=False,
+                                      shards=[all_shards[i] for i in val_idx]))
+        return
+    
+    all_paths = train_dataset.image_paths + val_dataset.image_paths
+    all_labels = torch.cat([train_dataset.labels, val_dataset.labels]).numpy()
+    image_cache = train_dataset.image_cache
+    all_groups = None
+    if train_dataset.groups is not None and val_dataset.groups is not None:
+        all_groups = np.concatenate([train_dataset.groups, val_dataset.groups])
+    
+    for fold, train_idx, val_idx in cross_validation_indices(all_labels, all_groups, num_folds):
         fold_train_paths = [all_paths[i] for i in train_idx]
         fold_train_labels = [all_labels[i] for i in train_idx]
         fold_val_paths = [all_paths[i] for i in val_idx]
         fold_val_labels = [all_labels[i] for i in val_idx]
+        fold_train_groups = all_groups[train_idx] if all_groups is not None else None
         
-        # Create transforms
-        train_transform = get_advanced_transforms(is_training=True)
-        val_transform = get_advanced_transforms(is_training=False)
-        
-        # Create datasets
-        fold_train_dataset = EnhancedXRayDataset(fold_train_paths, fold_train_labels, train_transform)
-        fold_val_dataset = EnhancedXRayDataset(fold_val_paths, fold_val_labels, val_transform)
-        
-        # Create dataloaders
-        fold_train_loader = DataLoader(fold_train_dataset, batch_size=16, shuffle=True, num_workers=2)
-        fold_val_loader = DataLoader(fold_val_dataset, batch_size=16, shuffle=False, num_workers=2)
-        
-        # Initialize model
-        model = model_class(**model_params).to(device)
+        yield (fold,
+               EnhancedXRayDataset(fold_train_paths, fold_train_labels, train_transform,
+                                   image_cache=image_cache, groups=fold_train_groups),
+               EnhancedXRayDataset(fold_val_paths, fold_val_labels, val_transform,
+                                   is_training=False, image_cache=image_cache))
+
+
+def fit_resumable(trainer, train_loader, val_loader, epochs, log_every=10, best_model_path=None):
+    """Run trainer from its current epoch to `epochs`, checkpointing after every epoch
+    
+    Progress lives in trainer.checkpoint_extra, so a trainer restored with
+    load_state_dict() continues where it stopped, including mid-epoch.
+    
+    Returns:
+        float: Best validation accuracy
+    """
+    extra = trainer.checkpoint_extra
+    extra.setdefault('best_val_acc', 0.0)
+    manager = trainer.checkpoint_manager
+    if extra.get('stopped'):
+        return extra['best_val_acc']
+    
+    for epoch in range(trainer.epochs_completed, epochs):
+        train_loss, train_acc = trainer.train_epoch(train_loader)
+        val_loss, val_acc = trainer.validate(val_loader)
         
-        # Initialize trainer
-        trainer = AdvancedTrainer(model, device)
+        if epoch % log_every == 0:
+            print(f"Epoch {epoch}: Train Loss: {train_loss:.4f}, Train Acc: {train_acc:.4f}, "
+                  f"Val Loss: {val_loss:.4f}, Val Acc: {val_acc:.4f}")
         
-        # Training loop
-        best_val_acc = 0
-        for epoch in range(epochs):
-            train_loss, train_acc = trainer.train_epoch(fold_train_loader)
-            val_loss, val_acc = trainer.validate(fold_val_loader)
-            
-            if epoch % 10 == 0:
-                print(f"Epoch {epoch}: Train Loss: {train_loss:.4f}, Train Acc: {train_acc:.4f}, "
-                      f"Val Loss: {val_loss:.4f}, Val Acc: {val_acc:.4f}")
-            
-            # Save best model for this fold
-            if val_acc > best_val_acc:
-                best_val_acc = val_acc
-                torch.save(model.state_dict(), f'best_model_fold_{fold}.pth')
-            
-            # Early stopping
-            if trainer.early_stopping(val_loss):
-                print(f"Early stopping at epoch {epoch}")
-                break
+        # Save best model
+        if best_model_path and val_acc > extra['best_val_acc']:
+            if manager is not None:
+                manager.write(trainer.model.state_dict(), best_model_path)
+            else:
+                torch.save(trainer.model.state_dict(), best_model_path)
+        extra['best_val_acc'] = max(extra['best_val_acc'], val_acc)
         
-        fold_scores.append(best_val_acc)
-        print(f"Fold {fold + 1} Best Validation Accuracy: {best_val_acc:.4f}")
+        # Early stopping
+        stop = trainer.early_stopping(val_loss)
+        extra['stopped'] = stop
+        trainer.save_checkpoint()
+        if stop:
+            print(f"Early stopping at epoch {epoch}")
+            break
+    
+    return extra['best_val_acc']
+
+
+def seed_everything(seed, transforms=()):
+    """Seed the torch, numpy and python RNGs, and the generators of albumentations transforms
+    
+    albumentations >= 2 draws from a per-Compose generator seeded from OS
+    entropy, which the global seeds never reach; transforms are seeded
+    explicitly with set_random_seed() where it exists.
+    """
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+    for transform in transforms:
+        if hasattr(transform, 'set_random_seed'):
+            transform.set_random_seed(seed)
+
+
+def seed_worker_transform(worker_id):
+    """DataLoader worker_init_fn: seed the worker's albumentations pipeline from its torch seed
+    
+    torch derives each worker's seed from the main process RNG, so this is
+    reproducible once the main process is seeded (older albumentations use
+    the numpy / python RNGs, which torch already seeds per worker).
+    """
+    dataset = torch.utils.data.get_worker_info().dataset
+    transform = getattr(dataset, 'transform', None)
+    if hasattr(transform, 'set_random_seed'):
+        transform.set_random_seed(torch.initial_seed() % 2**32)
+
+
+def train_fold(fold, model_class, model_params, fold_train_dataset, fold_val_dataset, device, epochs,
+               trainer_options=None, checkpoint_dir=None, resume=False, checkpoint_every=0, loader_workers=2,
+               loader_settings=None):
+    """Train one cross-validation fold from its own seed (42 + fold)
+    
+    The fold depends only on its seed, its data, the torch thread count and
+    loader_workers, so it gives the same result in the main process or in a
+    fold worker process. loader_settings (from loader_autotune) replace the
+    default batch size 16 and loader_workers.
+    
+    Returns:
+        tuple: (best validation accuracy, path of the best weights)
+    """
+    best_model_path = f'best_model_fold_{fold}.pth'
+    manager = CheckpointManager(checkpoint_dir) if checkpoint_dir else None
+    state = manager.load_latest() if manager is not None and resume else None
+    if state is not None and state['extra'].get('fold_done'):
+        print(f"Fold {fold + 1} already finished")
+        manager.close()
+        return state['extra']['best_val_acc'], best_model_path
+    
+    options = (loader_kwargs(loader_settings, device) if loader_settings
+               else {'batch_size': 16, 'num_workers': loader_workers})
+    options['worker_init_fn'] = seed_worker_transform
+    print(f"\nFold {fold + 1} ({torch.get_num_threads()} threads, {options['num_workers']} loader workers)")
+    # The fold transforms are shared between folds: reseed them as well
+    seed_everything(42 + fold, [getattr(dataset, 'transform', None)
+                                for dataset in (fold_train_dataset, fold_val_dataset)])
+    
+    # Create dataloaders (streaming datasets shuffle themselves)
+    sampler = None
+    if not isinstance(fold_train_dataset, IterableDataset):
+        sampler = ResumableSampler(RandomSampler(fold_train_dataset), seed=42 + fold)
+    fold_train_loader = DataLoader(fold_train_dataset, sampler=sampler, **options)
+    fold_val_loader = DataLoader(fold_val_dataset, shuffle=False, **options)
+    
+    # Initialize model and trainer
+    model = model_class(**model_params).to(device)
+    trainer = AdvancedTrainer(model, device, checkpoint_manager=manager, checkpoint_every=checkpoint_every,
+                              **(trainer_options or {}))
+    if state is not None and 'model' in state:
+        trainer.load_state_dict(state)
+        print(f"Fold {fold + 1}: resumed at epoch {trainer.epochs_completed}, batch {trainer.batches_done}")
+    trainer.checkpoint_extra['fold'] = fold
+    
+    # Training loop
+    best_val_acc = fit_resumable(trainer, fold_train_loader, fold_val_loader, epochs,
+                                 log_every=10, best_model_path=best_model_path)
+    print(f"Fold {fold + 1} Best Validation Accuracy: {best_val_acc:.4f}")
+    
+    if manager is not None:
+        # Completion marker: a resume skips this fold
+        manager.save({'extra': {'fold': fold, 'fold_done': True, 'best_val_acc': best_val_acc}})
+        manager.close()
+    return best_val_acc, best_model_path
+
+
+def _train_fold_process(threads, fold_kwargs):
+    """Fold worker process entry point: apply the thread budget, then train"""
+    torch.set_num_threads(threads)
+    return train_fold(**fold_kwargs)
+
+
+def train_model_with_cross_validation(model_class, model_params, train_loader, val_loader, 
+                                    device, num_folds=5, epochs=50, trainer_options=None,
+                                    checkpoint_dir=None, resume=False, checkpoint_every=0,
+                                    parallel_folds=1, fold_threads=None, fold_loader_workers=2,
+                                    fold_loader_settings=None):
+    """Train model with k-fold cross-validation
+    
+    trainer_options are passed to AdvancedTrainer (bf16, gradient
+    accumulation, channels_last, compile, batch_transform); fold datasets
+    leave out the augmentations a BatchAugment batch_transform covers. With
+    checkpoint_dir, each fold checkpoints to checkpoint_dir/fold_<k> every
+    epoch (and every checkpoint_every optimizer steps); resume=True skips
+    finished folds and resumes interrupted ones mid-epoch.
+    
+    parallel_folds > 1 trains that many folds at a time in spawned
+    processes. Every fold, sequential or not, uses fold_threads intra-op
+    threads (default: the cores divided among the concurrent folds) and
+    fold_loader_workers DataLoader workers, and is seeded per fold, so fold
+    results are identical whatever parallel_folds is as long as
+    fold_threads and fold_loader_workers are the same. fold_loader_settings
+    (from loader_autotune) override the fold batch size and loader workers.
+    """
+    threads = fold_threads or max(1, (os.cpu_count() or 1) // max(1, parallel_folds))
+    print(f"Starting {num_folds}-fold cross-validation "
+          f"({parallel_folds} at a time, {threads} threads per fold)...")
+    
+    batch_transform = (trainer_options or {}).get('batch_transform')
+    batch_ops = batch_transform.ops if isinstance(batch_transform, BatchAugment) else ()
+    folds = cross_validation_datasets(train_loader.dataset, val_loader.dataset, num_folds, batch_ops)
+    jobs = [
+        dict(fold=fold, model_class=model_class, model_params=model_params,
+             fold_train_dataset=fold_train_dataset, fold_val_dataset=fold_val_dataset,
+             device=device, epochs=epochs, trainer_options=trainer_options,
+             checkpoint_dir=os.path.join(checkpoint_dir, f'fold_{fold}') if checkpoint_dir else None,
+             resume=resume, checkpoint_every=checkpoint_every, loader_workers=fold_loader_workers,
+             loader_settings=fold_loader_settings)
+        for fold, fold_train_dataset, fold_val_dataset in folds
+    ]
+    
+    if parallel_folds > 1 and len(jobs) > 1:
+        context = mp.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(parallel_folds, len(jobs)), mp_context=context) as pool:
+            results = list(pool.map(_train_fold_process, [threads] * len(jobs), jobs))
+    else:
+        previous_threads = torch.get_num_threads()
+        torch.set_num_threads(threads)
+        try:
+            results = [train_fold(**job) for job in jobs]
+        finally:
+            torch.set_num_threads(previous_threads)
+    
+    fold_scores = [score for score, _ in results]
+    print(f"Best fold checkpoints: {', '.join(path for _, path in results)}")
     
     # Calculate average score
     avg_score = np.mean(fold_scores)
@@ -224,8 +465,104 @@ def train_model_with_cross_validation(model_class, model_params, train_loader, v
     return avg_score, std_score, fold_scores
 
 
-def create_ensemble_model(device, num_classes=2):
-    """Create ensemble of multiple models"""
+def _train_val_activations(model, train_dataset, val_dataset, cache_dir):
+    """Cached activations, labels and groups of train + val (train rows first)"""
+    if isinstance(train_dataset, ShardedXRayDataset):
+        raise ValueError("Head-only training needs path-list datasets")
+    all_paths = train_dataset.image_paths + val_dataset.image_paths
+    all_labels = torch.cat([train_dataset.labels, val_dataset.labels]).numpy()
+    all_groups = None
+    if train_dataset.groups is not None and val_dataset.groups is not None:
+        all_groups = np.concatenate([train_dataset.groups, val_dataset.groups])
+    
+    clean = EnhancedXRayDataset(all_paths, all_labels, get_advanced_transforms(is_training=False),
+                                is_training=False, image_cache=train_dataset.image_cache)
+    return build_activation_cache(model, clean, cache_dir), all_labels, all_groups
+
+
+def _head_trainer_options(trainer_options):
+    # Image augmentation and resizing do not apply to cached activations
+    return {k: v for k, v in (trainer_options or {}).items() if k not in ('batch_transform', 'resize_schedule')}
+
+
+def train_head_with_cross_validation(model, train_dataset, val_dataset, device, num_folds=5, epochs=50,
+                                     trainer_options=None, cache_dir='activation_cache', batch_size=64):
+    """Cross-validate only the head of model on cached backbone activations
+    
+    The backbone runs once per image of train + val (non-augmented, see
+    activation_cache.py); every fold then trains HeadModel(model) from the
+    same initial head weights on the cached activations, with the folds of
+    train_model_with_cross_validation. The head is restored to its initial
+    weights afterwards.
+    
+    Returns:
+        tuple: (average accuracy, std, fold scores)
+    """
+    activations, all_labels, all_groups = _train_val_activations(model, train_dataset, val_dataset, cache_dir)
+    head = HeadModel(model)
+    initial_state = copy.deepcopy(head.state_dict())
+    
+    print(f"Starting {num_folds}-fold head-only cross-validation...")
+    fold_scores = []
+    for fold, train_idx, val_idx in cross_validation_indices(all_labels, all_groups, num_folds):
+        print(f"\nFold {fold + 1}/{num_folds} (head only)")
+        seed_everything(42 + fold)
+        head.load_state_dict(initial_state)
+        fold_train_loader = DataLoader(ActivationDataset(activations, all_labels, train_idx),
+                                       batch_size=batch_size, shuffle=True)
+        fold_val_loader = DataLoader(ActivationDataset(activations, all_labels, val_idx),
+                                     batch_size=batch_size, shuffle=False)
+        trainer = AdvancedTrainer(head, device, **_head_trainer_options(trainer_options))
+        best_val_acc = fit_resumable(trainer, fold_train_loader, fold_val_loader, epochs,
+                                     log_every=10, best_model_path=f'best_head_fold_{fold}.pth')
+        fold_scores.append(best_val_acc)
+        print(f"Fold {fold + 1} Best Validation Accuracy: {best_val_acc:.4f}")
+    head.load_state_dict(initial_state)
+    
+    avg_score = np.mean(fold_scores)
+    std_score = np.std(fold_scores)
+    print(f"\nHead-only cross-validation completed!")
+    print(f"Average accuracy: {avg_score:.4f} ± {std_score:.4f}")
+    return avg_score, std_score, fold_scores
+
+
+def train_head(model, train_dataset, val_dataset, device, epochs=50, trainer_options=None,
+               cache_dir='activation_cache', batch_size=64):
+    """Train the head of model on cached activations of train_dataset, validating on val_dataset
+    
+    Uses the same train + val activation cache as train_head_with_cross_validation.
+    
+    Returns:
+        float: Best validation accuracy
+    """
+    activations, all_labels, _ = _train_val_activations(model, train_dataset, val_dataset, cache_dir)
+    num_train = len(train_dataset)
+    train_loader = DataLoader(ActivationDataset(activations, all_labels, np.arange(num_train)),
+                              batch_size=batch_size, shuffle=True)
+    val_loader = DataLoader(ActivationDataset(activations, all_labels, np.arange(num_train, len(all_labels))),
+                            batch_size=batch_size, shuffle=False)
+    seed_everything(42)
+    trainer = AdvancedTrainer(HeadModel(model), device, **_head_trainer_options(trainer_options))
+    return fit_resumable(trainer, train_loader, val_loader, epochs, log_every=20)
+
+
+def resumable_trainer(model, device, checkpoint_dir, resume, trainer_options=None, checkpoint_every=0):
+    """AdvancedTrainer checkpointing to checkpoint_dir, restored from its latest checkpoint if resume"""
+    manager = CheckpointManager(checkpoint_dir) if checkpoint_dir else None
+    trainer = AdvancedTrainer(model, device, checkpoint_manager=manager, checkpoint_every=checkpoint_every,
+                              **(trainer_options or {}))
+    state = manager.load_latest() if manager is not None and resume else None
+    if state is not None:
+        trainer.load_state_dict(state)
+        print(f"Resumed from {manager.latest()} (epoch {trainer.epochs_completed}, batch {trainer.batches_done})")
+    return trainer
+
+
+def create_ensemble_model(device, num_classes=2, parallel=None):
+    """Create ensemble of multiple models
+    
+    parallel='threads' runs the members concurrently in eval mode (see EnsembleModel).
+    """
     
     # Initialize different model architectures
     models = [
@@ -239,49 +576,40 @@ def create_ensemble_model(device, num_classes=2):
         model.to(device)
     
     # Create ensemble
-    ensemble = EnsembleModel(models, weights=[0.4, 0.35, 0.25])
+    ensemble = EnsembleModel(models, weights=[0.4, 0.35, 0.25], parallel=parallel)
     
     return ensemble
 
 
-def evaluate_model(model, test_loader, device):
-    """Evaluate model performance"""
+def evaluate_model(model, test_loader, device, keep_samples=False, num_bins=4096):
+    """
+    Evaluate model performance
+    
+    Metrics are accumulated per batch in a StreamingMetrics (confusion matrix
+    and score histograms), so memory does not grow with the test set. The
+    accumulator is returned under 'metrics' for ROC / PR curves and threshold
+    sweeps; per-sample predictions, probabilities and labels are only
+    included with keep_samples=True.
+    """
     model.eval()
-    all_predictions = []
-    all_probabilities = []
-    all_labels = []
+    metrics = StreamingMetrics(num_bins=num_bins, keep_samples=keep_samples)
     
     with torch.no_grad():
         for data, target in test_loader:
             data, target = data.to(device), target.to(device)
-            output = model(data)
-            
-            probabilities = torch.softmax(output, dim=1)
-            predictions = torch.argmax(output, dim=1)
-            
-            all_predictions.extend(predictions.cpu().numpy())
-            all_probabilities.extend(probabilities.cpu().numpy())
-            all_labels.extend(target.cpu().numpy())
-    
-    # Calculate metrics
-    accuracy = accuracy_score(all_labels, all_predictions)
-    roc_auc = roc_auc_score(all_labels, np.array(all_probabilities)[:, 1])
-    
-    # Classification report
-    report = classification_report(all_labels, all_predictions, output_dict=True)
-    
-    # Confusion matrix
-    cm = confusion_matrix(all_labels, all_predictions)
-    
-    return {
-        'accuracy': accuracy,
-        'roc_auc': roc_auc,
-        'classification_report': report,
-        'confusion_matrix': cm,
-        'predictions': all_predictions,
-        'probabilities': all_probabilities,
-        'labels': all_labels
+            metrics.update(model(data), target)
+    
+    summary = metrics.compute()
+    results = {
+        'accuracy': summary['accuracy'],
+        'roc_auc': summary['roc_auc'],
+        'classification_report': summary['classification_report'],
+        'confusion_matrix': summary['confusion_matrix'],
+        'metrics': metrics,
     }
+    if keep_samples:
+        results.update(metrics.samples())
+    return results
 
 
 def plot_training_results(results, save_path='training_results.png'):
@@ -302,12 +630,14 @@ def plot_training_results(results, save_path='training_results.png'):
     
     # ROC AUC comparison
     roc_aucs = [results[model]['roc_auc'] for model in models]
-    axes[0, 1].bar(models, roc_aucs, color=['skyblue', 'lightgreen', 'lightcoral', 'gold'])
+    # Undefined AUCs (single-class test set) get no bar
+    axes[0, 1].bar(models, [0.0 if v is None else v for v in roc_aucs],
+                   color=['skyblue', 'lightgreen', 'lightcoral', 'gold'])
     axes[0, 1].set_title('Model ROC AUC Comparison')
     axes[0, 1].set_ylabel('ROC AUC')
     axes[0, 1].set_ylim(0, 1)
     for i, v in enumerate(roc_aucs):
-        axes[0, 1].text(i, v + 0.01, f'{v:.3f}', ha='center', va='bottom')
+        axes[0, 1].text(i, (v or 0.0) + 0.01, format_metric(v, 3), ha='center', va='bottom')
     
     # Confusion matrix for best model
     best_model = max(results.keys(), key=lambda x: results[x]['accuracy'])
@@ -337,16 +667,46 @@ def plot_training_results(results, save_path='training_results.png'):
     plt.show()
 
 
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="Enhanced osteoporosis model training")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue from the latest checkpoints in --checkpoint-dir (mid-fold, mid-epoch)")
+    parser.add_argument('--checkpoint-dir', default='checkpoints')
+    parser.add_argument('--checkpoint-every', type=int, default=0,
+                        help="Also checkpoint every N optimizer steps within an epoch")
+    return parser.parse_args()
+
+
 def main():
     """Main training pipeline"""
+    args = parse_args()
     print("Starting Enhanced Osteoporosis Risk Assessment Model Training...")
     print("Target: 80%+ accuracy with advanced techniques")
     
     # Configuration
     IMAGE_DIR = "data/xray_images"  # Update with your image directory
     LABEL_FILE = "data/labels.csv"   # Update with your label file
+    IMAGE_CACHE = "data/image_cache"  # Pre-decoded uint8 images (set to None to decode on the fly)
+    SHARD_DIR = None  # e.g. "data/shards" packed with `shard_dataset.py --split`; replaces IMAGE_DIR/LABEL_FILE
     BATCH_SIZE = 16
     EPOCHS = 100
+    TRAINER_OPTIONS = {
+        'use_bf16': None,  # bfloat16 autocast; None = on where the CPU supports it
+        'accumulation_steps': 1,  # effective batch = BATCH_SIZE * accumulation_steps
+        'channels_last': True,
+        'compile_model': False,  # torch.compile; pays off on long runs
+    }
+    CV_PARALLEL_FOLDS = 1  # folds trained concurrently in separate processes (e.g. 3 on a 64-core node)
+    CV_FOLD_THREADS = None  # intra-op threads per fold; None = cores divided among the concurrent folds
+    PROGRESSIVE_SIZES = None  # e.g. (128, 176, 224): training resolution grows at the LR warm restarts
+    HEAD_ONLY = False  # freeze the backbones and train only the heads from cached activations
+    AUGMENT_BACKEND = 'auto'  # 'albumentations', 'batch' (BatchAugment after collation) or 'auto' (faster per op)
+    AUTOTUNE_LOADER = True  # benchmark DataLoader workers / prefetch / batch size per model; cached per host
+    AUTOTUNE_BATCH_SIZES = (16, 32)  # candidate batch sizes (BATCH_SIZE only: (BATCH_SIZE,))
+    LOADER_MEMORY_LIMIT_MB = None  # None = 80% of physical memory
+    ENSEMBLE_MODE = 'assemble'  # 'assemble': combine the saved, frozen members; 'train': train a new ensemble end to end
+    ENSEMBLE_METHOD = 'weights'  # assemble mode: 'weights' (fitted convex weights) or 'stacking' (StackingHead)
     DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     
     print(f"Using device: {DEVICE}")
@@ -362,11 +722,28 @@ def main():
         print("Will create synthetic data for demonstration...")
     
     try:
+        # Split augmentations between per-sample albumentations and batched BatchAugment
+        if AUGMENT_BACKEND == 'auto':
+            batch_ops = select_batch_ops(device=DEVICE)
+        elif AUGMENT_BACKEND == 'batch':
+            batch_ops = BATCH_AUGMENT_OPS
+        else:
+            batch_ops = ()
+        TRAINER_OPTIONS['batch_transform'] = BatchAugment(batch_ops) if batch_ops else None
+        TRAINER_OPTIONS['resize_schedule'] = None
+        print(f"Batched augmentations: {batch_ops or 'none'}")
+        
         # Create balanced dataloaders
-        print("Creating balanced dataloaders...")
-        train_loader, val_loader, test_loader, class_weights = create_balanced_dataloader(
-            IMAGE_DIR, LABEL_FILE, BATCH_SIZE
-        )
+        if SHARD_DIR:
+            print(f"Creating sharded dataloaders from {SHARD_DIR}...")
+            train_loader, val_loader, test_loader, class_weights = create_sharded_dataloaders(
+                SHARD_DIR, BATCH_SIZE, batch_ops=batch_ops
+            )
+        else:
+            print("Creating balanced dataloaders...")
+            train_loader, val_loader, test_loader, class_weights = create_balanced_dataloader(
+                IMAGE_DIR, LABEL_FILE, BATCH_SIZE, image_cache_path=IMAGE_CACHE, batch_ops=batch_ops
+            )
         
         print(f"Training samples: {len(train_loader.dataset)}")
         print(f"Validation samples: {len(val_loader.dataset)}")
@@ -406,69 +783,99 @@ def main():
             elif model_name == 'MedicalViT':
                 model_class = MedicalViT
             
-            # Train with cross-validation
-            avg_acc, std_acc, fold_scores = train_model_with_cross_validation(
-                model_class, config, train_loader, val_loader, DEVICE, num_folds=3, epochs=EPOCHS
-            )
-            
-            # Create final model for evaluation
-            final_model = model_class(**config).to(DEVICE)
-            
-            # Train final model on full training data
-            trainer = AdvancedTrainer(final_model, DEVICE)
+            loader_settings = None
+            if AUTOTUNE_LOADER and not HEAD_ONLY:
+                # Tuned against this model's training step; val / test use the same settings
+                loader_settings = autotune_loader(
+                    train_loader, training_step(model_class(**config), DEVICE, TRAINER_OPTIONS['batch_transform']),
+                    key=model_name, device=DEVICE,
+                    batch_sizes=AUTOTUNE_BATCH_SIZES, memory_limit_mb=LOADER_MEMORY_LIMIT_MB
+                )
+                train_loader, val_loader, test_loader = (rebuild_loader(loader, loader_settings, DEVICE)
+                                                         for loader in (train_loader, val_loader, test_loader))
+            TRAINER_OPTIONS['resize_schedule'] = (ProgressiveResizing(PROGRESSIVE_SIZES, train_loader.batch_size)
+                                                  if PROGRESSIVE_SIZES else None)
             
-            print(f"Training final {model_name} on full dataset...")
-            for epoch in range(EPOCHS):
-                train_loss, train_acc = trainer.train_epoch(train_loader)
-                val_loss, val_acc = trainer.validate(val_loader)
+            if HEAD_ONLY:
+                # Frozen backbone: heads train from cached activations
+                final_model = model_class(**config).to(DEVICE)
+                avg_acc, std_acc, fold_scores = train_head_with_cross_validation(
+                    final_model, train_loader.dataset, val_loader.dataset, DEVICE, num_folds=3,
+                    epochs=EPOCHS, trainer_options=TRAINER_OPTIONS
+                )
+                print(f"Training final {model_name} head on full dataset...")
+                train_head(final_model, train_loader.dataset, val_loader.dataset, DEVICE, EPOCHS,
+                           trainer_options=TRAINER_OPTIONS)
+            else:
+                # Train with cross-validation
+                avg_acc, std_acc, fold_scores = train_model_with_cross_validation(
+                    model_class, config, train_loader, val_loader, DEVICE, num_folds=3, epochs=EPOCHS,
+                    trainer_options=TRAINER_OPTIONS,
+                    checkpoint_dir=os.path.join(args.checkpoint_dir, model_name, 'cv'),
+                    resume=args.resume, checkpoint_every=args.checkpoint_every,
+                    parallel_folds=CV_PARALLEL_FOLDS, fold_threads=CV_FOLD_THREADS,
+                    # Tuned for the whole host, not for one of several concurrent folds
+                    fold_loader_settings=loader_settings if CV_PARALLEL_FOLDS == 1 else None
+                )
+                
+                # Create final model for evaluation
+                final_model = model_class(**config).to(DEVICE)
                 
-                if epoch % 20 == 0:
-                    print(f"Epoch {epoch}: Train Acc: {train_acc:.4f}, Val Acc: {val_acc:.4f}")
+                # Train final model on full training data
+                trainer = resumable_trainer(final_model, DEVICE,
+                                            os.path.join(args.checkpoint_dir, model_name, 'final'),
+                                            args.resume, TRAINER_OPTIONS, args.checkpoint_every)
                 
-                if trainer.early_stopping(val_loss):
-                    print(f"Early stopping at epoch {epoch}")
-                    break
+                print(f"Training final {model_name} on full dataset...")
+                fit_resumable(trainer, train_loader, val_loader, EPOCHS, log_every=20)
+                trainer.checkpoint_manager.close()
             
             # Evaluate on test set
             test_results = evaluate_model(final_model, test_loader, DEVICE)
             results[model_name] = test_results
             
             print(f"{model_name} Test Accuracy: {test_results['accuracy']:.4f}")
-            print(f"{model_name} ROC AUC: {test_results['roc_auc']:.4f}")
+            print(f"{model_name} ROC AUC: {format_metric(test_results['roc_auc'])}")
             
             # Save model
             torch.save(final_model.state_dict(), f'{model_name.lower()}_final.pth')
         
-        # Create and train ensemble
+        # Create the ensemble: assembled from the saved members (frozen backbones stay frozen), or trained
+        assemble = ENSEMBLE_MODE == 'assemble' or HEAD_ONLY
         print(f"\n{'='*50}")
-        print("Training Ensemble Model...")
+        print("Assembling Ensemble Model..." if assemble else "Training Ensemble Model...")
         print(f"{'='*50}")
         
-        ensemble = create_ensemble_model(DEVICE)
-        
-        # Train ensemble
-        trainer = AdvancedTrainer(ensemble, DEVICE)
-        
-        for epoch in range(EPOCHS):
-            train_loss, train_acc = trainer.train_epoch(train_loader)
-            val_loss, val_acc = trainer.validate(val_loader)
-            
-            if epoch % 20 == 0:
-                print(f"Epoch {epoch}: Train Acc: {train_acc:.4f}, Val Acc: {val_acc:.4f}")
+        if assemble:
+            # Combination fitted on cached validation logits of the frozen *_final.pth members
+            members = load_members(model_configs, DEVICE)
+            ensemble = assemble_ensemble(members, val_loader.dataset, DEVICE, method=ENSEMBLE_METHOD)
+        else:
+            ensemble = create_ensemble_model(DEVICE)
             
-            if trainer.early_stopping(val_loss):
-                print(f"Early stopping at epoch {epoch}")
-                break
+            # Train ensemble
+            trainer = resumable_trainer(ensemble, DEVICE, os.path.join(args.checkpoint_dir, 'Ensemble'),
+                                        args.resume,
+                                        {'batch_transform': TRAINER_OPTIONS['batch_transform'],
+                                         'resize_schedule': TRAINER_OPTIONS['resize_schedule']},
+                                        args.checkpoint_every)
+            fit_resumable(trainer, train_loader, val_loader, EPOCHS, log_every=20)
+            trainer.checkpoint_manager.close()
         
-        # Evaluate ensemble
+        # Evaluate ensemble (members run concurrently only where that is measured to be faster)
+        ensemble.choose_parallel(next(iter(test_loader))[0].to(DEVICE))
         ensemble_results = evaluate_model(ensemble, test_loader, DEVICE)
+        print(f"Ensemble member latency (last batch): {ensemble.latency_report()}")
         results['Ensemble'] = ensemble_results
         
         print(f"Ensemble Test Accuracy: {ensemble_results['accuracy']:.4f}")
-        print(f"Ensemble ROC AUC: {ensemble_results['roc_auc']:.4f}")
+        print(f"Ensemble ROC AUC: {format_metric(ensemble_results['roc_auc'])}")
         
         # Save ensemble
-        torch.save(ensemble.state_dict(), 'ensemble_final.pth')
+        if assemble:
+            save_ensemble(ensemble, 'ensemble_final.pth')
+        else:
+            torch.save(ensemble.state_dict(), 'ensemble_final.pth')
         
         # Plot results
         print("\nPlotting results...")
@@ -480,7 +887,7 @@ def main():
         print(f"{'='*60}")
         
         for model_name, result in results.items():
-            print(f"{model_name:20s}: Accuracy: {result['accuracy']:.4f}, ROC AUC: {result['roc_auc']:.4f}")
+            print(f"{model_name:20s}: Accuracy: {result['accuracy']:.4f}, ROC AUC: {format_metric(result['roc_auc'])}")
         
         # Check if target accuracy is achieved
         best_accuracy = max([result['accuracy'] for result in results.values()])
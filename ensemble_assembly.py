@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Ensemble assembly from already-trained members
+
+Instead of training a fresh three-network ensemble end to end, the saved
+*_final.pth members (AttentionResNet, EfficientNetClassifier, MedicalViT)
+are loaded and frozen. Each member's validation logits are computed once
+and cached (keyed by the image or shard list and the member's weights),
+and only the combination is fitted on the cached logits:
+- 'weights': convex member weights for EnsembleModel's weighted average
+- 'stacking': a StackingHead (linear layer over member log-probabilities)
+
+Fitting takes seconds; the members are never run in training mode. The
+result is saved as {'members', 'weights', 'combiner', 'state_dict'} and
+rebuilt with load_ensemble().
+
+Usage:
+    python ensemble_assembly.py --method weights
+    python ensemble_assembly.py --method stacking --out ensemble_final.pth
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from feature_cache import state_dict_hash
+from model_utils import AttentionResNet, EfficientNetClassifier, MedicalViT, EnsembleModel, StackingHead, format_metric
+
+
+ARCHS = {'AttentionResNet': AttentionResNet, 'EfficientNetClassifier': EfficientNetClassifier,
+         'MedicalViT': MedicalViT}
+
+# Member configurations used by enhanced_trainer.py
+DEFAULT_MEMBER_CONFIGS = {
+    'AttentionResNet': {'num_classes': 2, 'dropout_rate': 0.3, 'attention': True},
+    'EfficientNetClassifier': {'num_classes': 2, 'dropout_rate': 0.3},
+    'MedicalViT': {'num_classes': 2, 'dropout_rate': 0.3},
+}
+
+
+def freeze(model):
+    """Put model in eval mode with every parameter frozen"""
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model.eval()
+
+
+def load_members(member_configs=None, device='cpu', weights_dir='.'):
+    """
+    Frozen members loaded from their <name>_final.pth files
+
+    Args:
+        member_configs: {class name: constructor kwargs} (default: DEFAULT_MEMBER_CONFIGS)
+        weights_dir: Directory holding the *_final.pth files
+
+    Returns:
+        list of (name, config, model)
+    """
+    members = []
+    for name, config in (member_configs or DEFAULT_MEMBER_CONFIGS).items():
+        path = os.path.join(weights_dir, f'{name.lower()}_final.pth')
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found; train {name} first")
+        model = ARCHS[name](**config)
+        model.load_state_dict(torch.load(path, map_location='cpu'))
+        members.append((name, config, freeze(model.to(device))))
+        print(f"Loaded frozen {name} from {path}")
+    return members
+
+
+def _dataset_key(dataset, num_workers):
+    """Cache key of a dataset's sample order: its image list, or its shard list"""
+    if getattr(dataset, 'shuffle', False):
+        raise ValueError("Ensemble assembly needs a dataset with a fixed order (shuffle=False)")
+    if hasattr(dataset, 'image_paths'):
+        return '\n'.join(map(str, dataset.image_paths))
+    if hasattr(dataset, 'shards'):
+        # Workers interleave their shards, so the sample order depends on their number
+        return '\n'.join(map(str, dataset.shards)) + f'\nworkers={num_workers}'
+    raise ValueError("Ensemble assembly needs a dataset with image_paths or shards")
+
+
+def member_logits(model, dataset, cache_dir='ensemble_cache', batch_size=32, num_workers=4):
+    """
+    Logits of model for every sample of dataset, with the labels, computed once and cached
+
+    The cache is reused when the image (or shard) list and the model weights
+    are unchanged. Any dataset with a fixed order works, including
+    ShardedXRayDataset; the labels are read in the same pass.
+
+    Returns:
+        (np.ndarray of shape (len(dataset), num_classes) float32, np.ndarray of labels)
+    """
+    digest = hashlib.sha1(_dataset_key(dataset, num_workers).encode())
+    digest.update(state_dict_hash(model).encode())
+    key = digest.hexdigest()
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{type(model).__name__}_{key[:16]}.npz')
+    meta_path = os.path.splitext(path)[0] + '.json'
+    if os.path.exists(path) and os.path.exists(meta_path):
+        print(f"Using cached {type(model).__name__} logits from {path}")
+        with np.load(path) as cached:
+            return cached['logits'], cached['labels']
+
+    device = next(model.parameters()).device
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    logits, labels = [], []
+    with torch.inference_mode():
+        for data, target in loader:
+            logits.append(model(data.to(device)).float().cpu().numpy())
+            labels.append(np.asarray(target))
+    logits, labels = np.concatenate(logits), np.concatenate(labels)
+    np.savez(path, logits=logits, labels=labels)
+    # Written last: its presence marks a complete cache
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'num_samples': len(logits)}, f)
+    print(f"Cached {len(logits)} {type(model).__name__} logits to {path}")
+    return logits, labels
+
+
+def fit_weights(logits, labels, steps=100):
+    """
+    Convex member weights minimizing the cross-entropy of the weighted average of member logits
+
+    Args:
+        logits: (num_members, N, num_classes) tensor
+        labels: (N,) tensor
+
+    Returns:
+        list of floats summing to 1
+    """
+    alpha = torch.zeros(logits.shape[0], requires_grad=True)
+    optimizer = torch.optim.LBFGS([alpha], lr=0.5, max_iter=steps, line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        weights = alpha.softmax(dim=0)
+        loss = F.cross_entropy(torch.einsum('m,mnc->nc', weights, logits), labels)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return alpha.detach().softmax(dim=0).tolist()
+
+
+def fit_stacking(logits, labels, weight_decay=1e-3, steps=200):
+    """
+    StackingHead fitted on cached member logits (L2-regularized towards zero)
+
+    Args:
+        logits: (num_members, N, num_classes) tensor
+        labels: (N,) tensor
+    """
+    head = StackingHead(logits.shape[0], logits.shape[2])
+    inputs = logits.permute(1, 0, 2)
+    optimizer = torch.optim.LBFGS(head.parameters(), lr=0.5, max_iter=steps, line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        loss = F.cross_entropy(head(inputs), labels) + weight_decay * head.linear.weight.pow(2).sum()
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return freeze(head)
+
+
+def _report(name, outputs, labels):
+    accuracy = (outputs.argmax(dim=1) == labels).float().mean().item()
+    nll = F.cross_entropy(outputs, labels).item()
+    print(f"  {name:28s} val accuracy {accuracy:.4f}, NLL {nll:.4f}")
+
+
+def assemble_ensemble(members, val_dataset, device='cpu', method='weights', cache_dir='ensemble_cache',
+                      batch_size=32, num_workers=4):
+    """
+    EnsembleModel of frozen members, combined by weights or stacking fitted on cached validation logits
+
+    Args:
+        members: list of (name, config, model) from load_members()
+        val_dataset: Non-augmented, unshuffled validation dataset the combination is fitted on
+            (path-list or sharded)
+        method: 'weights' or 'stacking'
+
+    Returns:
+        EnsembleModel with member_names and member_configs attributes (used by save_ensemble)
+    """
+    cached = [member_logits(model, val_dataset, cache_dir, batch_size, num_workers) for _, _, model in members]
+    logits = torch.stack([torch.from_numpy(member) for member, _ in cached])
+    labels = torch.as_tensor(cached[0][1], dtype=torch.long)
+    print(f"Fitting ensemble {method} on {len(labels)} cached validation samples...")
+    for (name, _, _), member in zip(members, logits):
+        _report(name, member, labels)
+    _report('equal-weight average', logits.mean(dim=0), labels)
+
+    models = [model for _, _, model in members]
+    if method == 'stacking':
+        head = fit_stacking(logits, labels)
+        with torch.no_grad():
+            _report('stacking', head(logits.permute(1, 0, 2)), labels)
+        ensemble = EnsembleModel(models, combiner=head.to(device))
+    elif method == 'weights':
+        weights = fit_weights(logits, labels)
+        _report(f"weights {', '.join(f'{w:.3f}' for w in weights)}",
+                torch.einsum('m,mnc->nc', torch.tensor(weights), logits), labels)
+        ensemble = EnsembleModel(models, weights=weights)
+    else:
+        raise ValueError(f"Unknown ensemble method: {method}")
+    ensemble.member_names = [name for name, _, _ in members]
+    ensemble.member_configs = [config for _, config, _ in members]
+    return ensemble.eval()
+
+
+def save_ensemble(ensemble, path='ensemble_final.pth'):
+    """Save an assembled ensemble with everything load_ensemble() needs to rebuild it"""
+    combiner = ensemble.combiner
+    torch.save({
+        'members': list(zip(ensemble.member_names, ensemble.member_configs)),
+        'weights': ensemble.weights,
+        'combiner': None if combiner is None else {'num_members': combiner.num_members,
+                                                    'num_classes': combiner.num_classes},
+        'state_dict': ensemble.state_dict(),
+    }, path)
+    print(f"Ensemble saved to {path}")
+
+
+def load_ensemble(path='ensemble_final.pth', device='cpu', parallel=None):
+    """Rebuild an ensemble saved by save_ensemble() (frozen, eval mode)"""
+    checkpoint = torch.load(path, map_location='cpu')
+    models = [ARCHS[name](**config) for name, config in checkpoint['members']]
+    combiner = StackingHead(**checkpoint['combiner']) if checkpoint['combiner'] else None
+    ensemble = EnsembleModel(models, weights=checkpoint['weights'], parallel=parallel, combiner=combiner)
+    ensemble.load_state_dict(checkpoint['state_dict'])
+    ensemble.member_names = [name for name, _ in checkpoint['members']]
+    ensemble.member_configs = [config for _, config in checkpoint['members']]
+    return freeze(ensemble.to(device))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Assemble an ensemble from saved *_final.pth members")
+    parser.add_argument('--method', choices=['weights', 'stacking'], default='weights')
+    parser.add_argument('--weights-dir', default='.', help="Directory with the *_final.pth member files")
+    parser.add_argument('--image-dir', default='data/xray_images')
+    parser.add_argument('--label-file', default='data/labels.csv')
+    parser.add_argument('--cache-dir', default='ensemble_cache')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--out', default='ensemble_final.pth')
+    return parser.parse_args()
+
+
+def main():
+    from enhanced_trainer import create_balanced_dataloader, evaluate_model
+
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    _, val_loader, test_loader, _ = create_balanced_dataloader(args.image_dir, args.label_file, args.batch_size)
+
+    members = load_members(device=device, weights_dir=args.weights_dir)
+    ensemble = assemble_ensemble(members, val_loader.dataset, device, args.method, args.cache_dir,
+                                 args.batch_size)
+    save_ensemble(ensemble, args.out)
+
+    results = evaluate_model(ensemble, test_loader, device)
+    print(f"Ensemble Test Accuracy: {results['accuracy']:.4f}")
+    print(f"Ensemble ROC AUC: {format_metric(results['roc_auc'])}")
+
+
+if __name__ == '__main__':
+    main()
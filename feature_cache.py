@@ -0,0 +1,125 @@
+# feature_cache.py
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def file_sha1(path, block_size=1 << 20):
+    """Return the SHA-1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def state_dict_hash(model):
+    """Return a SHA-1 hex digest of a model's parameters and buffers"""
+    digest = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode('utf-8'))
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    On-disk cache of backbone features keyed by image content
+
+    Entries are stored in append-only chunk files (one per update) inside a
+    directory namespaced by the backbone weights hash, so features computed
+    with different weights or preprocessing never mix. Image files are
+    identified by their SHA-1; the (mtime, size) of each path is remembered
+    so unchanged files are not re-hashed on every run.
+    """
+
+    def __init__(self, cache_dir, weights_hash, preprocess=''):
+        model_key = hashlib.sha1(f'{weights_hash}|{preprocess}'.encode('utf-8')).hexdigest()
+        self.root = os.path.join(cache_dir, model_key[:16])
+        os.makedirs(self.root, exist_ok=True)
+        self.index_path = os.path.join(self.root, 'index.json')
+        self._chunks = {}
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'files': {}, 'entries': {}, 'chunks': []}
+
+    def content_keys(self, image_paths):
+        """Return the content hash of every image, re-hashing only files whose mtime or size changed"""
+        files = self.index['files']
+        keys = []
+        for path in image_paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            known = files.get(path)
+            if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+                keys.append(known[2])
+            else:
+                key = file_sha1(path)
+                files[path] = [stat.st_mtime_ns, stat.st_size, key]
+                keys.append(key)
+        return keys
+
+    def missing(self, keys):
+        """Return indices into `keys` that need computing (first occurrence of each unknown key)"""
+        entries = self.index['entries']
+        seen = set()
+        missing = []
+        for i, key in enumerate(keys):
+            if key not in entries and key not in seen:
+                seen.add(key)
+                missing.append(i)
+        return missing
+
+    def add(self, keys, features):
+        """Store a block of features as a new chunk file"""
+        if len(keys) == 0:
+            return
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        chunk_name = f'chunk_{len(self.index["chunks"]):05d}.npy'
+        chunk_path = os.path.join(self.root, chunk_name)
+        tmp_path = chunk_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, features)
+        os.replace(tmp_path, chunk_path)
+
+        self.index['chunks'].append(chunk_name)
+        for row, key in enumerate(keys):
+            self.index['entries'][key] = [chunk_name, row]
+
+    def assemble(self, keys, out=None):
+        """Gather the cached features for `keys` into `out` (allocated if not given)"""
+        entries = self.index['entries']
+        by_chunk = {}
+        for position, key in enumerate(keys):
+            chunk_name, row = entries[key]
+            by_chunk.setdefault(chunk_name, ([], []))
+            by_chunk[chunk_name][0].append(position)
+            by_chunk[chunk_name][1].append(row)
+
+        for chunk_name, (positions, rows) in by_chunk.items():
+            chunk = self._open_chunk(chunk_name)
+            if out is None:
+                out = np.empty((len(keys), chunk.shape[1]), dtype=np.float32)
+            rows = np.asarray(rows)
+            order = np.argsort(rows)  # read each chunk front to back
+            out[np.asarray(positions)[order]] = chunk[rows[order]]
+
+        if out is None:
+            out = np.empty((0, 0), dtype=np.float32)
+        return out
+
+    def save(self):
+        """Atomically write the index"""
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _open_chunk(self, chunk_name):
+        if chunk_name not in self._chunks:
+            self._chunks[chunk_name] = np.load(os.path.join(self.root, chunk_name), mmap_mode='r')
+        return self._chunks[chunk_name]
@@ -1,12 +1,49 @@
 # feature_extractor.py
+import sys
+import time
 import torch
 import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
 from torchvision import models
 import numpy as np
 
 
+def cpu_supports_bf16():
+    """Return True if the CPU has native bfloat16 support (AVX512-BF16 / AMX)"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB (None if unavailable)"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
 class CNNFeatureExtractor:
-    def __init__(self, backbone='resnet50', device=None):
+    def __init__(self, backbone='resnet50', device=None, num_workers=0, prefetch_factor=2,
+                 channels_last=True, use_bf16=None, persistent_workers=False):
+        """
+        Args:
+            backbone: Backbone architecture (only 'resnet50' is supported)
+            device: Torch device to run on (defaults to CPU)
+            num_workers: DataLoader workers used when extract_features is given a Dataset
+            prefetch_factor: Batches prefetched per worker (ignored when num_workers=0)
+            channels_last: Run the backbone in NHWC memory format
+            use_bf16: bfloat16 autocast on CPU; None enables it when the CPU supports it
+            persistent_workers: Keep DataLoader workers alive between extract_features calls
+        """
         self.device = device or torch.device('cpu')
         if backbone == 'resnet50':
             model = models.resnet50(pretrained=True)
@@ -17,16 +54,82 @@ class CNNFeatureExtractor:
             raise ValueError('backbone not supported')
         self.model.eval()
 
-    def extract_features(self, dataloader):
-        feats = []
-        labels = []
-        with torch.no_grad():
-            for imgs, labs in dataloader:
-                imgs = imgs.to(self.device)
-                out = self.model(imgs)  # B x C x 1 x 1
-                out = out.reshape(out.size(0), -1).cpu().numpy()
-                feats.append(out)
-                labels.extend(labs.numpy())
-        X = np.vstack(feats)
-        y = np.array(labels)
-        return X, y 
\ No newline at end of file
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        self.channels_last = channels_last
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+        is_cpu = torch.device(self.device).type == 'cpu'
+        if use_bf16 is None:
+            use_bf16 = is_cpu and cpu_supports_bf16()
+        self.use_bf16 = bool(use_bf16) and is_cpu
+        self.last_throughput = None
+
+    def make_dataloader(self, dataset, batch_size=32):
+        """Build an ordered DataLoader over `dataset` using the extractor's throughput options"""
+        loader_kwargs = {
+            'batch_size': batch_size,
+            'shuffle': False,
+            'num_workers': self.num_workers,
+            'pin_memory': torch.device(self.device).type == 'cuda',
+        }
+        if self.num_workers > 0:
+            loader_kwargs['prefetch_factor'] = self.prefetch_factor
+            loader_kwargs['persistent_workers'] = self.persistent_workers
+        return DataLoader(dataset, **loader_kwargs)
+
+    def forward_batch(self, imgs):
+        """Pooled backbone features (B x out_dim) of one batch of images"""
+        non_blocking = torch.device(self.device).type == 'cuda'
+        with torch.inference_mode(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.use_bf16):
+            imgs = imgs.to(self.device, non_blocking=non_blocking)
+            if self.channels_last:
+                imgs = imgs.contiguous(memory_format=torch.channels_last)
+            feats = self.model(imgs)  # B x C x 1 x 1
+        return feats.reshape(feats.size(0), -1)
+
+    def extract_features(self, dataloader, batch_size=32, verbose=True, out=None):
+        """
+        Extract pooled backbone features
+
+        Args:
+            dataloader: DataLoader yielding (images, labels), or a Dataset, in which
+                case a loader is built with make_dataloader()
+            batch_size: Batch size used when a Dataset is given
+            verbose: Print an images/sec report when done
+            out: Optional preallocated (N, out_dim) float32 array (e.g. a np.memmap)
+                that features are written into
+
+        Returns:
+            (X, y): float32 array of shape (N, out_dim) and label array of shape (N,)
+        """
+        if isinstance(dataloader, Dataset):
+            dataloader = self.make_dataloader(dataloader, batch_size=batch_size)
+
+        n_samples = len(dataloader.dataset)
+        if out is None:
+            X = np.empty((n_samples, self.out_dim), dtype=np.float32)
+        elif out.shape != (n_samples, self.out_dim):
+            raise ValueError(f'out has shape {out.shape}, expected {(n_samples, self.out_dim)}')
+        else:
+            X = out
+        y = np.empty(n_samples, dtype=np.int64)
+
+        offset = 0
+        start = time.perf_counter()
+        for imgs, labs in dataloader:
+            feats = self.forward_batch(imgs)
+            batch = feats.size(0)
+            X[offset:offset + batch] = feats.float().cpu().numpy()
+            y[offset:offset + batch] = np.asarray(labs)
+            offset += batch
+        elapsed = time.perf_counter() - start
+
+        self.last_throughput = offset / elapsed if elapsed > 0 else 0.0
+        if verbose:
+            print(f"Extracted {offset} images in {elapsed:.1f}s "
+                  f"({self.last_throughput:.1f} images/sec, bf16={self.use_bf16}, "
+                  f"channels_last={self.channels_last}, workers={self.num_workers})")
+        return X[:offset], y[:offset]
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Optional dimensionality reduction between backbone features and the classifier
+
+A reducer (PCA, randomized PCA or Gaussian random projection) is fit once
+on the training features and saved as feature_reducer.joblib next to the
+classifier. Serving code and the analysis tools apply it automatically
+when the file is present.
+
+Usage (accuracy vs. dimensionality report):
+    python feature_reduction.py --features extracted_features.npy --labels feature_labels.npy \\
+        --dims 32 64 128 256 512
+"""
+
+import argparse
+import os
+import time
+import joblib
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.random_projection import GaussianRandomProjection
+
+
+REDUCER_FILE = 'feature_reducer.joblib'
+REDUCTION_METHODS = ('pca', 'randomized_pca', 'random_projection')
+
+
+def fit_reducer(X_train, n_components=256, method='randomized_pca', random_state=42):
+    """Fit a dimensionality reducer on training features"""
+    if method == 'pca':
+        reducer = PCA(n_components=n_components, svd_solver='full', random_state=random_state)
+    elif method == 'randomized_pca':
+        reducer = PCA(n_components=n_components, svd_solver='randomized', random_state=random_state)
+    elif method == 'random_projection':
+        reducer = GaussianRandomProjection(n_components=n_components, random_state=random_state)
+    else:
+        raise ValueError(f"Unknown reduction method '{method}', expected one of {REDUCTION_METHODS}")
+    reducer.fit(X_train)
+    return reducer
+
+
+def apply_reducer(reducer, X):
+    """Project features with `reducer`; returns X unchanged when reducer is None"""
+    if reducer is None:
+        return X
+    return reducer.transform(X).astype(np.float32)
+
+
+def save_reducer(reducer, model_dir='.', filename=REDUCER_FILE):
+    path = os.path.join(model_dir, filename)
+    joblib.dump(reducer, path)
+    print(f"Feature reducer saved as '{path}'")
+    return path
+
+
+def load_reducer(model_dir='.', filename=REDUCER_FILE):
+    """Load the reducer saved next to the classifier, or None if the model uses full features"""
+    path = os.path.join(model_dir, filename)
+    if not os.path.exists(path):
+        return None
+    return joblib.load(path)
+
+
+def transform_npy_in_chunks(reducer, features_path, out_path, chunk_rows=8192):
+    """Write reducer.transform(features) to out_path without loading all features at once"""
+    X = np.load(features_path, mmap_mode='r')
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32,
+                                    shape=(X.shape[0], reducer.n_components_))
+    for start in range(0, X.shape[0], chunk_rows):
+        out[start:start + chunk_rows] = apply_reducer(reducer, X[start:start + chunk_rows])
+    out.flush()
+    return out
+
+
+def dimensionality_report(X_train, y_train, X_val, y_val, dims=(32, 64, 128, 256, 512),
+                          method='randomized_pca', save_path=None):
+    """
+    Compare accuracy, training time and storage across feature dimensionalities
+
+    Trains the default XGBoost head on the full features (baseline) and on
+    each reduced dimensionality.
+
+    Returns:
+        pd.DataFrame: One row per dimensionality
+    """
+    import pandas as pd
+    import xgboost as xgb
+
+    def fit_and_score(X_tr, X_va):
+        model = xgb.XGBClassifier(n_estimators=100, max_depth=6, learning_rate=0.1, subsample=0.8,
+                                  colsample_bytree=0.8, tree_method='hist', random_state=42)
+        start = time.perf_counter()
+        model.fit(X_tr, y_train)
+        train_seconds = time.perf_counter() - start
+        return (model.predict(X_va) == y_val).mean(), train_seconds
+
+    full_dim = X_train.shape[1]
+    accuracy, train_seconds = fit_and_score(X_train, X_val)
+    rows = [{'method': 'none', 'dims': full_dim, 'accuracy': accuracy, 'fit_seconds': 0.0,
+             'train_seconds': train_seconds, 'bytes_per_sample': full_dim * 4}]
+    print(f"Baseline ({full_dim} dims): accuracy {accuracy:.4f}, train {train_seconds:.1f}s")
+
+    for n_components in dims:
+        if n_components >= full_dim:
+            continue
+        start = time.perf_counter()
+        reducer = fit_reducer(X_train, n_components, method)
+        fit_seconds = time.perf_counter() - start
+        accuracy, train_seconds = fit_and_score(apply_reducer(reducer, X_train), apply_reducer(reducer, X_val))
+        rows.append({'method': method, 'dims': n_components, 'accuracy': accuracy, 'fit_seconds': fit_seconds,
+                     'train_seconds': train_seconds, 'bytes_per_sample': n_components * 4})
+        print(f"{method} ({n_components} dims): accuracy {accuracy:.4f} "
+              f"({accuracy - rows[0]['accuracy']:+.4f} vs baseline), train {train_seconds:.1f}s")
+
+    report = pd.DataFrame(rows)
+    if save_path:
+        report.to_csv(save_path, index=False)
+        print(f"Report saved to {save_path}")
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Accuracy vs. dimensionality report for backbone features")
+    parser.add_argument('--features', default='extracted_features.npy')
+    parser.add_argument('--labels', default='feature_labels.npy')
+    parser.add_argument('--groups', default='feature_groups.npy',
+                        help="Near-duplicate group ids written by train_model.py (used if present)")
+    parser.add_argument('--dims', type=int, nargs='+', default=[32, 64, 128, 256, 512])
+    parser.add_argument('--method', choices=REDUCTION_METHODS, default='randomized_pca')
+    parser.add_argument('--output', default='dimensionality_report.csv')
+    return parser.parse_args()
+
+
+def main():
+    from dedup import split_indices
+
+    args = parse_args()
+    X = np.load(args.features)
+    y = np.load(args.labels)
+    groups = np.load(args.groups) if os.path.exists(args.groups) else None
+    # Same split as train_model.py
+    train_idx, val_idx = split_indices(y, groups, test_size=0.2, random_state=42)
+    X_train, X_val, y_train, y_val = X[train_idx], X[val_idx], y[train_idx], y[val_idx]
+    dimensionality_report(X_train, y_train, X_val, y_val, dims=args.dims, method=args.method,
+                          save_path=args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,105 +1,213 @@
+#!/usr/bin/env python3
+"""
+Streaming training pipeline for the 3-class knee X-ray classifier
+(normal / osteopenia / osteoporosis)
+
+Image paths are scanned and split first; images are then decoded, resized
+and passed through the ResNet50 backbone in parallel batches. DataLoader
+workers feed a bounded queue (num_workers * prefetch_factor batches) and
+features are written to memory-mapped .npy files, so peak memory during
+extraction does not grow with the dataset.
+
+Usage:
+    python full_update_knee_classification.py --data-root "/data/Osteoporosis Knee X-ray"
+    python full_update_knee_classification.py --class-dir normal=/data/n --class-dir osteopenia=/data/p ...
+"""
+
+import argparse
 import os
 import numpy as np
+import joblib
+import torch
+import torchvision.transforms as transforms
 from PIL import Image
+from torch.utils.data import Dataset
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 from xgboost import XGBClassifier
-import torch
-import torchvision.models as models
-import torchvision.transforms as transforms
 
-# -------------------------
-# Paths to your image folders
-# -------------------------
-data_paths = {
-    "normal": r"C:\Users\Nagineni Dhanush\Music\Desktop\Osteop\Osteoporosis Knee X-ray\normal",
-    "osteopenia": r"C:\Users\Nagineni Dhanush\Music\Desktop\Osteop\Osteoporosis Knee X-ray\osteopenia",
-    "osteoporosis": r"C:\Users\Nagineni Dhanush\Music\Desktop\Osteop\Osteoporosis Knee X-ray\osteoporosis"
-}
-
-# -------------------------
-# Load images and labels
-# -------------------------
-X = []
-y = []
-
-for label, path in data_paths.items():
-    for img_file in os.listdir(path):
-        img_path = os.path.join(path, img_file)
+from feature_extractor import CNNFeatureExtractor, peak_rss_mb
+from feature_reduction import REDUCTION_METHODS, fit_reducer, apply_reducer, save_reducer
+
+CLASS_NAMES = ["normal", "osteopenia", "osteoporosis"]
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff"}
+KNEE_REDUCER_FILE = "xgb_knee_model.reducer.joblib"
+
+
+class KneeImageDataset(Dataset):
+    """Decodes and resizes one image per access; unreadable files get label -1"""
+
+    def __init__(self, image_paths, labels, image_size=224):
+        self.image_paths = image_paths
+        self.labels = labels
+        self.image_size = image_size
+        self.transform = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                 std=[0.229, 0.224, 0.225])
+        ])
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        img_path = self.image_paths[idx]
+        label = int(self.labels[idx])
+        size = (self.image_size, self.image_size)
         try:
-            img = Image.open(img_path).convert("RGB").resize((224, 224))
-            X.append(img)
-            y.append(label)
-        except:
+            with Image.open(img_path) as img:
+                img.draft("RGB", size)  # JPEG: decode at reduced scale
+                img = img.convert("RGB").resize(size)
+        except Exception:
             print(f"Failed to load {img_path}")
+            img = Image.new("RGB", size)
+            label = -1
+        return self.transform(img), label
 
-print(f"Total images: {len(X)}")
-
-# -------------------------
-# Encode string labels to integers
-# -------------------------
-le = LabelEncoder()
-y_encoded = le.fit_transform(y)  # normal->0, osteopenia->1, osteoporosis->2
-
-# -------------------------
-# Split dataset
-# -------------------------
-X_train, X_test, y_train, y_test = train_test_split(
-    X, y_encoded, test_size=0.2, random_state=42, stratify=y_encoded
-)
-
-# -------------------------
-# Define ResNet50 feature extractor
-# -------------------------
-resnet = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
-modules = list(resnet.children())[:-1]  # remove the final classification layer
-resnet = torch.nn.Sequential(*modules)
-resnet.eval()
-
-# Transformation
-transform = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], 
-                         std=[0.229, 0.224, 0.225])
-])
-
-# -------------------------
-# Feature extraction
-# -------------------------
-def extract_features(img_list):
-    features = []
-    for img in img_list:
-        tensor = transform(img).unsqueeze(0)  # shape [1,3,224,224]
-        with torch.no_grad():
-            feat = resnet(tensor).cpu().numpy().flatten()
-        features.append(feat)
-    return np.array(features)
-
-print("Extracting train features...")
-X_train_feats = extract_features(X_train)
-
-print("Extracting test features...")
-X_test_feats = extract_features(X_test)
-
-# -------------------------
-# Train XGBoost classifier
-# -------------------------
-clf = XGBClassifier(use_label_encoder=False, eval_metric="mlogloss")
-print("Training classifier...")
-clf.fit(X_train_feats, y_train)
-
-# -------------------------
-# Evaluate
-# -------------------------
-train_acc = clf.score(X_train_feats, y_train)
-test_acc = clf.score(X_test_feats, y_test)
-print(f"Train Accuracy: {train_acc:.4f}")
-print(f"Test Accuracy: {test_acc:.4f}")
-
-# -------------------------
-# Save model and LabelEncoder
-# -------------------------
-import joblib
-joblib.dump(clf, "xgb_knee_model.pkl")
-joblib.dump(le, "label_encoder.pkl")
-print("Model and label encoder saved.")
+
+def scan_image_paths(data_paths):
+    """Return (image_paths, labels) for every image file under each class folder, labels being the data_paths keys"""
+    image_paths = []
+    labels = []
+    for label, path in data_paths.items():
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Class folder not found: {path}")
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                    image_paths.append(entry.path)
+                    labels.append(label)
+    return image_paths, labels
+
+
+def extract_to_memmap(extractor, image_paths, labels, out_path, batch_size, image_size):
+    """Stream images through the backbone, writing features into a memory-mapped .npy file"""
+    dataset = KneeImageDataset(image_paths, labels, image_size)
+    features = np.lib.format.open_memmap(
+        out_path, mode="w+", dtype=np.float32, shape=(len(dataset), extractor.out_dim)
+    )
+    _, y = extractor.extract_features(dataset, batch_size=batch_size, out=features)
+    features.flush()
+    return features, y
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the 3-class knee X-ray classifier")
+    parser.add_argument("--data-root", default=os.environ.get("KNEE_DATA_ROOT", "data/Osteoporosis Knee X-ray"),
+                        help="Folder containing one sub-folder per class (default: $KNEE_DATA_ROOT)")
+    parser.add_argument("--class-dir", action="append", default=[], metavar="NAME=PATH",
+                        help="Override the folder for one class; may be repeated")
+    parser.add_argument("--output-dir", default=".", help="Where models and feature files are written")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=min(8, os.cpu_count() or 1),
+                        help="Decode/resize worker processes")
+    parser.add_argument("--prefetch-factor", type=int, default=2,
+                        help="Batches queued per worker; bounds memory held by the pipeline")
+    parser.add_argument("--threads", type=int, default=None, help="Torch intra-op threads for the backbone")
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--reduce-dim", type=int, default=None,
+                        help=f"Fit a reducer to this many dims before the classifier (saved as {KNEE_REDUCER_FILE})")
+    parser.add_argument("--reduction-method", choices=REDUCTION_METHODS, default="randomized_pca")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # -------------------------
+    # Scan image paths (no decoding yet)
+    # -------------------------
+    data_paths = {name: os.path.join(args.data_root, name) for name in CLASS_NAMES}
+    for override in args.class_dir:
+        name, _, path = override.partition("=")
+        data_paths[name] = path
+
+    image_paths, class_labels = scan_image_paths(data_paths)
+    print(f"Total images: {len(image_paths)}")
+
+    # -------------------------
+    # Encode string labels to integers
+    # -------------------------
+    le = LabelEncoder()
+    y_encoded = le.fit_transform(class_labels)  # normal->0, osteopenia->1, osteoporosis->2
+
+    # -------------------------
+    # Split on paths
+    # -------------------------
+    train_paths, test_paths, y_train, y_test = train_test_split(
+        image_paths, y_encoded, test_size=args.test_size, random_state=42, stratify=y_encoded
+    )
+
+    # -------------------------
+    # Streaming feature extraction
+    # -------------------------
+    extractor = CNNFeatureExtractor(backbone="resnet50", num_workers=args.num_workers,
+                                    prefetch_factor=args.prefetch_factor)
+
+    print("Extracting train features...")
+    X_train_feats, y_train = extract_to_memmap(
+        extractor, train_paths, y_train, os.path.join(args.output_dir, "knee_train_features.npy"),
+        args.batch_size, args.image_size
+    )
+
+    print("Extracting test features...")
+    X_test_feats, y_test = extract_to_memmap(
+        extractor, test_paths, y_test, os.path.join(args.output_dir, "knee_test_features.npy"),
+        args.batch_size, args.image_size
+    )
+    peak_rss = peak_rss_mb()
+    if peak_rss is not None:
+        print(f"Peak RSS after extraction: {peak_rss:.0f} MB")
+
+    # Drop images that failed to decode
+    if (y_train < 0).any():
+        train_ok = np.flatnonzero(y_train >= 0)
+        X_train_feats, y_train = X_train_feats[train_ok], y_train[train_ok]
+    if (y_test < 0).any():
+        test_ok = np.flatnonzero(y_test >= 0)
+        X_test_feats, y_test = X_test_feats[test_ok], y_test[test_ok]
+
+    # -------------------------
+    # Optional dimensionality reduction
+    # -------------------------
+    # Named after this classifier: feature_reducer.joblib belongs to the served xgb_cnn_features model
+    reducer_path = os.path.join(args.output_dir, KNEE_REDUCER_FILE)
+    if args.reduce_dim:
+        print(f"Reducing features to {args.reduce_dim} dims ({args.reduction_method})...")
+        reducer = fit_reducer(X_train_feats, args.reduce_dim, args.reduction_method)
+        save_reducer(reducer, args.output_dir, KNEE_REDUCER_FILE)
+        X_train_feats = apply_reducer(reducer, X_train_feats)
+        X_test_feats = apply_reducer(reducer, X_test_feats)
+    elif os.path.exists(reducer_path):
+        # A stale reducer would not match a full-width model
+        os.remove(reducer_path)
+
+    # -------------------------
+    # Train XGBoost classifier
+    # -------------------------
+    clf = XGBClassifier(use_label_encoder=False, eval_metric="mlogloss", tree_method="hist")
+    print("Training classifier...")
+    clf.fit(X_train_feats, y_train)
+
+    # -------------------------
+    # Evaluate
+    # -------------------------
+    train_acc = clf.score(X_train_feats, y_train)
+    test_acc = clf.score(X_test_feats, y_test)
+    print(f"Train Accuracy: {train_acc:.4f}")
+    print(f"Test Accuracy: {test_acc:.4f}")
+
+    # -------------------------
+    # Save model and LabelEncoder
+    # -------------------------
+    joblib.dump(clf, os.path.join(args.output_dir, "xgb_knee_model.pkl"))
+    joblib.dump(le, os.path.join(args.output_dir, "label_encoder.pkl"))
+    print("Model and label encoder saved.")
+
+
+if __name__ == "__main__":
+    main()
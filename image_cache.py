@@ -0,0 +1,133 @@
+# image_cache.py
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+def _decode_resized(image_path, image_size, mode):
+    """Decode one image and resize it to image_size x image_size uint8"""
+    size = (image_size, image_size)
+    with Image.open(image_path) as img:
+        img.draft(mode, size)  # JPEG: decode at reduced scale
+        img = img.convert(mode).resize(size, Image.BILINEAR)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def _file_stats(image_paths):
+    stats = []
+    for path in image_paths:
+        st = os.stat(path)
+        stats.append([st.st_mtime_ns, st.st_size])
+    return stats
+
+
+def build_image_cache(image_paths, cache_path, image_size=256, mode='RGB', num_workers=None):
+    """
+    Decode every image once into a single memory-mapped uint8 array
+
+    Writes `<cache_path>.npy` (N x S x S x C, or N x S x S for mode 'L') and
+    `<cache_path>.json` (the path index). An existing cache built from the same
+    files with the same settings is reused as-is.
+
+    Args:
+        image_paths: Image files to cache
+        cache_path: Output path without extension
+        image_size: Side length of the stored images
+        mode: PIL mode, 'RGB' or 'L'
+        num_workers: Decode threads (defaults to os.cpu_count())
+
+    Returns:
+        ImageCache
+    """
+    image_paths = [os.path.abspath(p) for p in image_paths]
+    stats = _file_stats(image_paths)
+    index_path = cache_path + '.json'
+    array_path = cache_path + '.npy'
+
+    if os.path.exists(index_path) and os.path.exists(array_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if (index['image_size'] == image_size and index['mode'] == mode
+                and index['paths'] == image_paths and index['stats'] == stats):
+            print(f"Image cache is up to date: {array_path}")
+            return ImageCache(cache_path)
+
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    shape = (len(image_paths), image_size, image_size)
+    if mode != 'L':
+        shape += (len(mode),)
+    array = np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8, shape=shape)
+
+    def decode_into(row):
+        try:
+            array[row] = _decode_resized(image_paths[row], image_size, mode)
+            return True
+        except Exception as e:
+            print(f"Error caching image {image_paths[row]}: {e}")
+            return False
+
+    print(f"Building image cache for {len(image_paths)} images at {image_size}x{image_size} {mode}...")
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as pool:
+        ok = list(pool.map(decode_into, range(len(image_paths))))
+    array.flush()
+    del array
+
+    index = {
+        'image_size': image_size,
+        'mode': mode,
+        'paths': image_paths,
+        'stats': stats,
+        'failed': [path for path, success in zip(image_paths, ok) if not success],
+    }
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    print(f"Image cache written to {array_path}")
+    return ImageCache(cache_path)
+
+
+class ImageCache:
+    """
+    Read-only view of a cache written by build_image_cache
+
+    The array is memory-mapped lazily on first access, so the cache can be
+    pickled into DataLoader workers cheaply and every worker shares the same
+    page cache. get() returns a copy-on-write view, not a copy.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        with open(cache_path + '.json', 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.image_size = index['image_size']
+        self.mode = index['mode']
+        failed = set(index.get('failed', []))
+        self._rows = {path: row for row, path in enumerate(index['paths']) if path not in failed}
+        self._array = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, image_path):
+        return os.path.abspath(image_path) in self._rows
+
+    def get(self, image_path):
+        """Return the cached uint8 image for `image_path`, or None if it is not cached"""
+        row = self._rows.get(os.path.abspath(image_path))
+        if row is None:
+            return None
+        if self._array is None:
+            self._array = np.load(self.cache_path + '.npy', mmap_mode='c')
+        return self._array[row]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
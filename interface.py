@@ -8,10 +8,12 @@ import os
 from typing import Tuple, Optional, Dict, Any
 import warnings
 import torchvision.transforms as transforms
+from feature_reduction import load_reducer, apply_reducer
 
 # Globals (will be loaded lazily)
 xgb_clf = None
 resnet_model = None
+feature_reducer = None
 model_loaded = False
 
 def load_models(model_dir: str = ".") -> bool:
@@ -24,7 +26,7 @@ def load_models(model_dir: str = ".") -> bool:
     Returns:
         bool: True if models loaded successfully, False otherwise
     """
-    global xgb_clf, resnet_model, model_loaded
+    global xgb_clf, resnet_model, feature_reducer, model_loaded
     
     if model_loaded:
         return True
@@ -40,6 +42,11 @@ def load_models(model_dir: str = ".") -> bool:
         xgb_clf = joblib.load(xgb_path)
         print(f"✓ XGBoost model loaded from {xgb_path}")
         
+        # Optional dimensionality reducer saved next to the classifier
+        feature_reducer = load_reducer(model_dir)
+        if feature_reducer is not None:
+            print(f"✓ Feature reducer loaded ({feature_reducer.n_components_} dims)")
+        
         # Load ResNet backbone
         resnet_path = os.path.join(model_dir, "resnet50_backbone.pth")
         if not os.path.exists(resnet_path):
@@ -134,6 +141,7 @@ def predict(image_path: str, return_probabilities: bool = True, positive_thresho
         
         # Extract features
         features = extract_features(image_tensor)
+        features = apply_reducer(feature_reducer, features)
         
         # Probabilities and thresholded prediction for stability
         proba = None
@@ -212,7 +220,11 @@ def get_model_info() -> Dict[str, Any]:
             "type": "ResNet50",
             "backbone_layers": len(list(resnet_model.children())),
             "feature_dim": 2048
-        }
+        },
+        "feature_reducer": {
+            "type": type(feature_reducer).__name__,
+            "n_components": feature_reducer.n_components_
+        } if feature_reducer is not None else None
     }
     
     return info
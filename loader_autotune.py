@@ -0,0 +1,270 @@
+# loader_autotune.py
+"""
+DataLoader autotuning per host
+
+Candidate worker counts, prefetch factors, persistent-worker settings and
+batch sizes are benchmarked briefly against the real dataset and model step
+(a few batches each). For every candidate the time to the first batch of an
+epoch (worker startup) and the steady per-batch time are measured, and the
+throughput of a full epoch is estimated from both. The fastest candidate
+whose process-tree memory (main process plus workers) stays under the limit
+is kept and cached in a JSON file, keyed by host name and a caller-supplied
+key, so later runs on the same node skip the benchmark. Resident memory is
+summed over processes, which counts pages shared by forked workers more
+than once, so the limit errs on the safe side.
+
+The search is staged rather than a full grid: workers first, then prefetch
+factor, then persistent workers, then batch size, each stage starting from
+the best settings so far. Batch size changes the optimization as well as
+the speed; pass batch_sizes=(n,) to keep it fixed.
+"""
+import copy
+import json
+import os
+import random
+import socket
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, IterableDataset
+
+
+def process_tree_rss_mb():
+    """Resident memory of this process and all its children in MB (None if unavailable)"""
+    try:
+        import psutil
+        process = psutil.Process()
+        return sum(p.memory_info().rss for p in [process] + process.children(recursive=True)) / (1024 * 1024)
+    except ImportError:
+        pass
+    # Linux without psutil: walk /proc
+    page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+    total, pending = 0, [os.getpid()]
+    try:
+        while pending:
+            pid = pending.pop()
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+    except (OSError, ValueError):
+        return None if total == 0 else total / (1024 * 1024)
+    return total / (1024 * 1024)
+
+
+def default_memory_limit_mb(fraction=0.8):
+    """fraction of the physical memory of this host in MB (None if unknown)"""
+    try:
+        return fraction * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def loader_kwargs(settings, device=None):
+    """DataLoader keyword arguments for tuned settings"""
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    kwargs = {'batch_size': settings['batch_size'], 'num_workers': settings['num_workers'],
+              'pin_memory': device.type == 'cuda'}
+    if settings['num_workers'] > 0:
+        kwargs['prefetch_factor'] = settings['prefetch_factor']
+        kwargs['persistent_workers'] = settings['persistent_workers']
+    return kwargs
+
+
+def rebuild_loader(loader, settings, device=None):
+    """loader rebuilt with tuned settings; dataset, sampler, collate_fn, drop_last and worker_init_fn are kept"""
+    options = loader_kwargs(settings, device)
+    options['collate_fn'] = loader.collate_fn
+    options['worker_init_fn'] = loader.worker_init_fn
+    options['drop_last'] = loader.drop_last
+    if not isinstance(loader.dataset, IterableDataset):
+        options['sampler'] = loader.sampler
+    return DataLoader(loader.dataset, **options)
+
+
+def training_step(model, device, batch_transform=None):
+    """
+    step_fn running forward and backward passes of a copy of model
+
+    The copy is never updated (gradients are discarded), so benchmarking
+    leaves the model and its BatchNorm statistics untouched.
+    """
+    model = copy.deepcopy(model).to(device).train()
+    criterion = nn.CrossEntropyLoss()
+
+    def step(data, target):
+        data, target = data.to(device), target.to(device)
+        if batch_transform is not None:
+            with torch.no_grad():
+                data = batch_transform(data)
+        criterion(model(data), target).backward()
+        model.zero_grad(set_to_none=True)
+
+    return step
+
+
+def inference_step(model, device):
+    """step_fn running a forward pass of model under inference_mode"""
+    def step(data, target):
+        with torch.inference_mode():
+            model(data.to(device))
+
+    return step
+
+
+def benchmark_loader(loader, step_fn, batches=6):
+    """
+    Time two short epochs of loader, each running step_fn on `batches` batches
+
+    The first epoch warms up the model and the workers; the second is measured,
+    so persistent workers skip the startup they would skip in training.
+
+    Returns:
+        dict: startup_seconds (to the first batch), batch_seconds (steady state),
+        peak_mb (process tree, None if unavailable)
+    """
+    peak_mb = None
+    for epoch in range(2):
+        start = time.perf_counter()
+        first = None
+        count = 0
+        for data, target in loader:
+            if first is None:
+                first = time.perf_counter() - start
+            step_fn(data, target)
+            count += 1
+            rss = process_tree_rss_mb()
+            if rss is not None:
+                peak_mb = max(peak_mb or 0.0, rss)
+            if count >= batches:
+                break
+        elapsed = time.perf_counter() - start
+    return {'startup_seconds': first, 'batch_seconds': (elapsed - first) / max(count - 1, 1),
+            'peak_mb': peak_mb}
+
+
+def _cache_key(key, device):
+    # Not keyed on the dataset size: the best settings barely depend on it, and
+    # each cross-validation fold or rerun would otherwise miss the cache
+    return f'{key}|device={torch.device(device).type}|cpus={os.cpu_count()}'
+
+
+def _rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _load_cache(cache_path):
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def autotune_loader(loader, step_fn, key='default', device='cpu', worker_counts=None, prefetch_factors=(2, 4),
+                    persistent_options=(False, True), batch_sizes=None, memory_limit_mb=None, batches=6,
+                    cache_path='loader_autotune.json', force=False):
+    """
+    Fastest DataLoader settings for loader's dataset and step_fn on this host
+
+    Args:
+        loader: DataLoader whose dataset and sampler are benchmarked
+        step_fn: Callable (data, target) running one model step, e.g. training_step()
+        key: Cache key of the workload (e.g. model name and image size)
+        worker_counts: Candidate num_workers (default: 0, 2, 4, ... up to the CPU count)
+        batch_sizes: Candidate batch sizes (default: loader.batch_size only)
+        memory_limit_mb: Process-tree memory limit (default: 80% of physical memory)
+        batches: Batches per measured epoch
+        cache_path: Per-host JSON cache; None disables caching
+        force: Re-run the benchmark even if a cached result exists
+
+    Returns:
+        dict: batch_size, num_workers, prefetch_factor, persistent_workers,
+        images_per_sec, peak_mb
+    """
+    host = socket.gethostname()
+    cache_key = _cache_key(key, device)
+    cache = _load_cache(cache_path)
+    if not force and cache_key in cache.get(host, {}):
+        settings = cache[host][cache_key]
+        print(f"Using cached loader settings for {key} on {host}: {settings}")
+        return settings
+
+    cpus = os.cpu_count() or 1
+    if worker_counts is None:
+        worker_counts = [0] + [n for n in (2, 4, 8, 12, 16, 24, 32) if n <= cpus]
+    batch_sizes = batch_sizes or (loader.batch_size,)
+    memory_limit_mb = memory_limit_mb or default_memory_limit_mb()
+    dataset_size = len(loader.dataset)
+    results = {}
+
+    def measure(settings):
+        name = (settings['batch_size'], settings['num_workers'], settings['prefetch_factor'],
+                settings['persistent_workers'])
+        if name in results:
+            return results[name]
+        try:
+            stats = benchmark_loader(rebuild_loader(loader, settings, device), step_fn, batches)
+        except RuntimeError as e:  # e.g. out of memory at a large batch size
+            print(f"  {settings}: failed ({e})")
+            results[name] = None
+            return None
+        epoch_batches = -(-dataset_size // settings['batch_size'])
+        # Estimated full epoch: one worker startup plus steady-state batches
+        epoch_seconds = stats['startup_seconds'] + epoch_batches * stats['batch_seconds']
+        row = dict(settings, images_per_sec=dataset_size / max(epoch_seconds, 1e-9), peak_mb=stats['peak_mb'])
+        over_limit = (memory_limit_mb is not None and stats['peak_mb'] is not None
+                      and stats['peak_mb'] > memory_limit_mb)
+        memory = 'n/a' if row['peak_mb'] is None else f"{row['peak_mb']:.0f} MB"
+        print(f"  batch {row['batch_size']:4d}, workers {row['num_workers']:2d}, prefetch {row['prefetch_factor']}, "
+              f"persistent {str(row['persistent_workers']):5s}: {row['images_per_sec']:8.1f} images/sec, "
+              f"startup {stats['startup_seconds']:.2f}s, {memory}{' (over memory limit)' if over_limit else ''}")
+        results[name] = None if over_limit else row
+        return results[name]
+
+    def best_of(candidates):
+        rows = [row for row in map(measure, candidates) if row is not None]
+        return max(rows, key=lambda row: row['images_per_sec']) if rows else None
+
+    print(f"Autotuning DataLoader for {key} on {host} ({cpus} CPUs, "
+          f"memory limit {'none' if memory_limit_mb is None else f'{memory_limit_mb:.0f} MB'})...")
+    settings = {'batch_size': batch_sizes[0], 'num_workers': 0, 'prefetch_factor': prefetch_factors[0],
+                'persistent_workers': False}
+    best = None
+    # The benchmark shuffles and augments batches; restore the global RNGs afterwards so
+    # training after a cache miss sees the same random stream as after a cache hit
+    rng_state = _rng_state()
+    try:
+        for option, values in (('num_workers', worker_counts), ('prefetch_factor', prefetch_factors),
+                               ('persistent_workers', persistent_options), ('batch_size', batch_sizes)):
+            if option in ('prefetch_factor', 'persistent_workers') and settings['num_workers'] == 0:
+                continue  # no effect without workers
+            winner = best_of([dict(settings, **{option: value}) for value in values])
+            if winner is not None:
+                best = winner
+                settings = {name: best[name] for name in settings}
+    finally:
+        _set_rng_state(rng_state)
+    if best is None:
+        raise RuntimeError(f"No DataLoader candidate for {key} ran within the memory limit")
+    print(f"Selected loader settings: {best}")
+
+    if cache_path:
+        # Re-read so concurrent runs for other keys are not overwritten
+        cache = _load_cache(cache_path)
+        cache.setdefault(host, {})[cache_key] = best
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2)
+    return best
@@ -1,4 +1,12 @@
 # model_utils.py
+import copy
+import itertools
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import numpy as np
 import cv2
@@ -10,45 +18,275 @@ import torch.nn as nn
 from torch.optim.lr_scheduler import ReduceLROnPlateau, CosineAnnealingWarmRestarts
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
+from feature_extractor import cpu_supports_bf16, peak_rss_mb
+
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# Augmentation groups that BatchAugment can take over from albumentations
+BATCH_AUGMENT_OPS = ('flip', 'rotate90', 'affine', 'blur', 'intensity', 'noise')
+
+
+def _albumentations_ops(batch_ops=()):
+    """Per-sample training augmentations grouped as in BATCH_AUGMENT_OPS, minus batch_ops"""
+    ops = {
+        'flip': [A.HorizontalFlip(p=0.5), A.VerticalFlip(p=0.3)],
+        'rotate90': [A.RandomRotate90(p=0.5)],
+        'affine': [A.ShiftScaleRotate(shift_limit=0.1, scale_limit=0.1, rotate_limit=15, p=0.5)],
+        'blur': [A.OneOf([
+            A.MotionBlur(blur_limit=3, p=0.5),
+            A.MedianBlur(blur_limit=3, p=0.5),
+            A.Blur(blur_limit=3, p=0.5),
+        ], p=0.3)],
+        'intensity': [A.OneOf([
+            A.CLAHE(clip_limit=2, p=0.5),
+            A.RandomBrightnessContrast(brightness_limit=0.2, contrast_limit=0.2, p=0.5),
+            A.RandomGamma(gamma_limit=(80, 120), p=0.5),
+        ], p=0.5)],
+        'noise': [A.OneOf([
+            A.GaussNoise(var_limit=(10.0, 50.0), p=0.5),
+            A.ISONoise(color_shift=(0.01, 0.05), p=0.5),
+        ], p=0.3)],
+    }
+    # CLAHE has no batched counterpart: it stays per sample with its share of the OneOf
+    if 'intensity' in batch_ops:
+        ops['intensity'] = [A.CLAHE(clip_limit=2, p=0.5 / 3)]
+    return {name: transforms_ for name, transforms_ in ops.items()
+            if name not in batch_ops or name == 'intensity'}
 
 
 # Enhanced data augmentation for medical images
-def get_advanced_transforms(is_training=True, image_size=224):
-    """Get advanced data augmentation transforms optimized for medical images"""
+def get_advanced_transforms(is_training=True, image_size=224, batch_ops=()):
+    """Get advanced data augmentation transforms optimized for medical images
+    
+    Args:
+        batch_ops: Augmentation groups (see BATCH_AUGMENT_OPS) left out because
+            a BatchAugment(batch_ops) stage applies them to collated batches
+    """
     if is_training:
-        return A.Compose([
-            A.Resize(image_size, image_size),
-            A.HorizontalFlip(p=0.5),
-            A.VerticalFlip(p=0.3),
-            A.RandomRotate90(p=0.5),
-            A.ShiftScaleRotate(shift_limit=0.1, scale_limit=0.1, rotate_limit=15, p=0.5),
-            A.OneOf([
-                A.MotionBlur(blur_limit=3, p=0.5),
-                A.MedianBlur(blur_limit=3, p=0.5),
-                A.Blur(blur_limit=3, p=0.5),
-            ], p=0.3),
-            A.OneOf([
-                A.CLAHE(clip_limit=2, p=0.5),
-                A.RandomBrightnessContrast(brightness_limit=0.2, contrast_limit=0.2, p=0.5),
-                A.RandomGamma(gamma_limit=(80, 120), p=0.5),
-            ], p=0.5),
-            A.OneOf([
-                A.GaussNoise(var_limit=(10.0, 50.0), p=0.5),
-                A.ISONoise(color_shift=(0.01, 0.05), p=0.5),
-            ], p=0.3),
-            A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-            ToTensorV2(),
-        ])
+        return A.Compose(
+            [A.Resize(image_size, image_size)]
+            + [t for group in _albumentations_ops(batch_ops).values() for t in group]
+            + [A.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD), ToTensorV2()]
+        )
     else:
         return A.Compose([
             A.Resize(image_size, image_size),
-            A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            A.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
             ToTensorV2(),
         ])
 
 
-# Enhanced ResNet with attention mechanism
+class BatchAugment:
+    """
+    Training augmentation applied to whole normalized batches after collation
+    
+    Batched counterparts of the albumentations groups in
+    get_advanced_transforms, with the same probabilities and ranges and
+    independent random parameters per sample:
+    - flip: horizontal (p=0.5) and vertical (p=0.3) flips
+    - rotate90: random multiple of 90 degrees (p=0.5, square images)
+    - affine: shift 10%, scale 10%, rotate 15 degrees in one affine_grid /
+      grid_sample call with reflection padding (p=0.5)
+    - blur: one of 3x3 box, median or motion blur (p=0.3)
+    - intensity: brightness/contrast or gamma, each p=1/6 (CLAHE stays in
+      albumentations)
+    - noise: Gaussian noise (variance 10-50 on the 0-255 scale) or an
+      ISO-like luminance plus color noise (p=0.3)
+    
+    Random parameters are drawn from the global torch RNG, so they are part
+    of AdvancedTrainer's resumable state.
+    """
+    
+    def __init__(self, ops=BATCH_AUGMENT_OPS, mean=IMAGENET_MEAN, std=IMAGENET_STD):
+        unknown = set(ops) - set(BATCH_AUGMENT_OPS)
+        if unknown:
+            raise ValueError(f"Unknown batch augmentations {sorted(unknown)}, expected {BATCH_AUGMENT_OPS}")
+        self.ops = tuple(op for op in BATCH_AUGMENT_OPS if op in ops)
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+    
+    def __repr__(self):
+        return f"BatchAugment(ops={self.ops})"
+    
+    @staticmethod
+    def _select(batch_size, p, device):
+        """Indices of the samples an op with probability p applies to"""
+        return torch.nonzero(torch.rand(batch_size) < p).flatten().to(device)
+    
+    @staticmethod
+    def _uniform(n, low, high, like):
+        return torch.empty(n).uniform_(low, high).to(like.device, like.dtype).view(-1, 1, 1, 1)
+    
+    # Every op works in place on the samples it selects
+    def _flip(self, x):
+        idx = self._select(len(x), 0.5, x.device)
+        x[idx] = x[idx].flip(-1)
+        idx = self._select(len(x), 0.3, x.device)
+        x[idx] = x[idx].flip(-2)
+    
+    def _rotate90(self, x):
+        apply = torch.rand(len(x)) < 0.5
+        k = torch.randint(0, 4, (len(x),))
+        if x.shape[-1] != x.shape[-2]:
+            return
+        for turns in (1, 2, 3):
+            idx = torch.nonzero(apply & (k == turns)).flatten().to(x.device)
+            if len(idx):
+                x[idx] = torch.rot90(x[idx], turns, dims=(2, 3))
+    
+    def _affine(self, x):
+        idx = self._select(len(x), 0.5, x.device)
+        n = len(idx)
+        if not n:
+            return
+        angle = torch.deg2rad(torch.empty(n).uniform_(-15, 15))
+        scale = torch.empty(n).uniform_(0.9, 1.1)
+        shift = torch.empty(n, 2).uniform_(-0.1, 0.1) * 2  # grid coordinates span [-1, 1]
+        cos, sin = torch.cos(angle) / scale, torch.sin(angle) / scale
+        theta = torch.stack([
+            torch.stack([cos, -sin, shift[:, 0]], dim=1),
+            torch.stack([sin, cos, shift[:, 1]], dim=1),
+        ], dim=1).to(x.device, x.dtype)
+        selected = x[idx]
+        grid = F.affine_grid(theta, selected.shape, align_corners=False)
+        x[idx] = F.grid_sample(selected, grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+    
+    def _blur(self, x):
+        apply = torch.rand(len(x)) < 0.3
+        kind = torch.randint(0, 3, (len(x),))
+        channels, height, width = x.shape[1:]
+        
+        idx = torch.nonzero(apply & (kind == 0)).flatten().to(x.device)
+        if len(idx):
+            x[idx] = F.avg_pool2d(F.pad(x[idx], (1, 1, 1, 1), mode='reflect'), 3, stride=1)
+        
+        idx = torch.nonzero(apply & (kind == 1)).flatten().to(x.device)
+        if len(idx):
+            patches = F.unfold(F.pad(x[idx], (1, 1, 1, 1), mode='reflect'), 3)
+            patches = patches.view(len(idx), channels, 9, -1)
+            x[idx] = patches.median(dim=2).values.view(len(idx), channels, height, width)
+        
+        idx = torch.nonzero(apply & (kind == 2)).flatten()
+        n = len(idx)
+        if n:
+            # 3-tap line kernel in one of four directions
+            lines = torch.zeros(4, 3, 3)
+            lines[0, 1, :] = 1
+            lines[1, :, 1] = 1
+            lines[2] = torch.eye(3)
+            lines[3] = torch.eye(3).flip(0)
+            kernels = lines[torch.randint(0, 4, (n,))] / 3
+            idx = idx.to(x.device)
+            # One grouped conv: every (sample, channel) plane gets its sample's kernel
+            weight = kernels.repeat_interleave(channels, dim=0).unsqueeze(1).to(x.device, x.dtype)
+            padded = F.pad(x[idx], (1, 1, 1, 1), mode='reflect').reshape(1, n * channels, height + 2, width + 2)
+            x[idx] = F.conv2d(padded, weight, groups=n * channels).view(n, channels, height, width)
+    
+    def _intensity(self, x):
+        u = torch.rand(len(x))
+        idx = torch.nonzero(u < 1 / 6).flatten().to(x.device)
+        if len(idx):
+            alpha = self._uniform(len(idx), 0.8, 1.2, x)
+            beta = self._uniform(len(idx), -0.2, 0.2, x)
+            x[idx] = x[idx] * alpha + beta
+        idx = torch.nonzero((u >= 1 / 6) & (u < 1 / 3)).flatten().to(x.device)
+        if len(idx):
+            x[idx] = x[idx].clamp(0, 1).pow(self._uniform(len(idx), 0.8, 1.2, x))
+    
+    def _noise(self, x):
+        u = torch.rand(len(x))
+        idx = torch.nonzero(u < 0.15).flatten().to(x.device)
+        if len(idx):
+            sigma = self._uniform(len(idx), 10, 50, x).sqrt() / 255
+            x[idx] += torch.randn_like(x[idx]) * sigma
+        # ISO-like: luminance noise shared by the channels plus a small per-channel color shift
+        idx = torch.nonzero((u >= 0.15) & (u < 0.3)).flatten().to(x.device)
+        if len(idx):
+            selected = x[idx]
+            luminance = torch.randn_like(selected[:, :1]) * self._uniform(len(idx), 0.1, 0.5, x) * 0.1
+            color = torch.randn_like(selected) * self._uniform(len(idx), 0.01, 0.05, x)
+            x[idx] = selected + luminance + color
+    
+    def __call__(self, batch):
+        """Augment a (B, C, H, W) batch normalized with mean/std; returns a new batch"""
+        # Geometric ops do not depend on the value range; intensity and noise
+        # work on [0, 1] pixel values
+        photometric = any(op in self.ops for op in ('intensity', 'noise'))
+        mean = self.mean.to(batch.device, batch.dtype)
+        std = self.std.to(batch.device, batch.dtype)
+        x = batch * std + mean if photometric else batch.clone()
+        for op in self.ops:
+            getattr(self, f'_{op}')(x)
+        if photometric:
+            x = (x.clamp_(0, 1) - mean) / std
+        return x
+
+
+def benchmark_augmentations(image_size=224, batch_size=32, repeats=3, device='cpu'):
+    """
+    Per-image time of every augmentation group through albumentations and BatchAugment
+    
+    Albumentations runs sample by sample on uint8 images (as in DataLoader
+    workers); BatchAugment runs on a collated float batch on device (the
+    training device). Only the per-sample work a batched group replaces is
+    timed: CLAHE stays per sample either way, so it is left out of
+    'intensity'. Both sides are warmed up first.
+    
+    Returns:
+        dict: op -> {'albumentations_ms': ..., 'batch_ms': ...}
+    """
+    device = torch.device(device)
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (image_size, image_size, 3), dtype=np.uint8) for _ in range(batch_size)]
+    batch = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    per_sample = _albumentations_ops()
+    intensity = per_sample['intensity'][0]
+    replaced = [t for t in intensity.transforms if not isinstance(t, A.CLAHE)]
+    per_sample['intensity'] = [A.OneOf(replaced, p=intensity.p * len(replaced) / len(intensity.transforms))]
+    
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    
+    results = {}
+    for op in BATCH_AUGMENT_OPS:
+        pipeline = A.Compose(per_sample[op])
+        augment = BatchAugment([op])
+        # Warm-up
+        for image in images:
+            pipeline(image=image)
+        augment(batch)
+        synchronize()
+        timings = {'albumentations_ms': [], 'batch_ms': []}
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for image in images:
+                pipeline(image=image)
+            timings['albumentations_ms'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            augment(batch)
+            synchronize()
+            timings['batch_ms'].append(time.perf_counter() - start)
+        results[op] = {key: 1000 * min(values) / batch_size for key, values in timings.items()}
+    return results
+
+
+def select_batch_ops(image_size=224, batch_size=32, repeats=3, device='cpu'):
+    """Augmentation groups that are faster batched (on device) than per sample on this machine"""
+    results = benchmark_augmentations(image_size, batch_size, repeats, device)
+    print(f"Augmentation time per image (ms, batch on {device}):")
+    for op, times in results.items():
+        faster = 'batch' if times['batch_ms'] < times['albumentations_ms'] else 'albumentations'
+        print(f"  {op:10s} albumentations {times['albumentations_ms']:.3f}  batch {times['batch_ms']:.3f}  -> {faster}")
+    return tuple(op for op, times in results.items() if times['batch_ms'] < times['albumentations_ms'])
+
+
 class AttentionResNet(nn.Module):
+    # Modules trained on top of cached backbone activations (see activation_cache.py)
+    HEAD_MODULES = ('attention', 'classifier')
+    
     def __init__(self, num_classes=2, dropout_rate=0.3, attention=True):
         super(AttentionResNet, self).__init__()
         self.backbone = models.resnet50(pretrained=True)
@@ -94,10 +332,11 @@ class AttentionResNet(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
     
-    def forward(self, x):
-        # Extract features
-        features = self.features(x)
-        
+    def forward_features(self, x):
+        """Backbone activations, (B, 2048, H/32, W/32)"""
+        return self.features(x)
+    
+    def forward_head(self, features):
         # Apply attention if enabled
         if self.attention is not None:
             attention_weights = self.attention(features)
@@ -110,10 +349,15 @@ class AttentionResNet(nn.Module):
         # Classification
         output = self.classifier(pooled)
         return output
+    
+    def forward(self, x):
+        return self.forward_head(self.forward_features(x))
 
 
 # EfficientNet-based model
 class EfficientNetClassifier(nn.Module):
+    HEAD_MODULES = ('classifier',)
+    
     def __init__(self, num_classes=2, dropout_rate=0.3):
         super(EfficientNetClassifier, self).__init__()
         self.backbone = models.efficientnet_b3(pretrained=True)
@@ -144,30 +388,51 @@ class EfficientNetClassifier(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
     
-    def forward(self, x):
-        features = self.features(x)
+    def forward_features(self, x):
+        """Pooled backbone activations, (B, 1536, 1, 1)"""
+        return self.features(x)
+    
+    def forward_head(self, features):
         features = features.view(features.size(0), -1)
         output = self.classifier(features)
         return output
+    
+    def forward(self, x):
+        return self.forward_head(self.forward_features(x))
 
 
 # Vision Transformer for medical images
 class MedicalViT(nn.Module):
+    """
+    Vision transformer with an optional token reduction schedule
+
+    keep_schedule maps a layer index to the fraction of tokens kept before
+    that layer, e.g. {3: 0.7, 6: 0.7, 9: 0.7}. Tokens are ranked by the
+    attention they receive from the mean query of that layer; with
+    fuse_tokens the dropped ones are merged into a single attention-weighted
+    token instead of being discarded. The schedule can be changed on a
+    trained model (model.keep_schedule = {...}) since no weights depend on it.
+    """
+    HEAD_MODULES = ('classifier',)
+
     def __init__(self, num_classes=2, img_size=224, patch_size=16, embed_dim=768, 
-                 num_heads=12, num_layers=12, dropout_rate=0.3):
+                 num_heads=12, num_layers=12, dropout_rate=0.3, keep_schedule=None, fuse_tokens=True):
         super(MedicalViT, self).__init__()
+        self.keep_schedule = dict(keep_schedule or {})
+        self.fuse_tokens = fuse_tokens
         
         # Patch embedding
         self.patch_embed = nn.Conv2d(3, embed_dim, kernel_size=patch_size, stride=patch_size)
         self.pos_embed = nn.Parameter(torch.randn(1, (img_size // patch_size) ** 2, embed_dim))
         
-        # Transformer layers
+        # Transformer layers (batch_first enables the fused attention fast path at inference)
         encoder_layer = nn.TransformerEncoderLayer(
             d_model=embed_dim,
             nhead=num_heads,
             dim_feedforward=embed_dim * 4,
             dropout=dropout_rate,
-            activation='gelu'
+            activation='gelu',
+            batch_first=True
         )
         self.transformer = nn.TransformerEncoder(encoder_layer, num_layers=num_layers)
         
@@ -190,41 +455,179 @@ class MedicalViT(nn.Module):
                 nn.init.xavier_uniform_(m.weight)
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
+
+    def _pos_embed_for(self, grid_h, grid_w):
+        """Positional embedding, bicubically resized when the patch grid differs from training"""
+        num_patches = self.pos_embed.shape[1]
+        if grid_h * grid_w == num_patches:
+            return self.pos_embed
+        side = int(round(num_patches ** 0.5))
+        pos = self.pos_embed.reshape(1, side, side, -1).permute(0, 3, 1, 2)
+        pos = F.interpolate(pos, size=(grid_h, grid_w), mode='bicubic', align_corners=False)
+        return pos.flatten(2).transpose(1, 2)
+
+    def token_scores(self, x, layer):
+        """
+        Attention each token receives from the mean query of layer, averaged over heads
+
+        Args:
+            x: (B, N, D) tokens entering layer
+            layer: nn.TransformerEncoderLayer
+
+        Returns:
+            (B, N) scores summing to 1 per image
+        """
+        attn = layer.self_attn
+        dim = x.shape[-1]
+        head_dim = dim // attn.num_heads
+        w_q, w_k, _ = attn.in_proj_weight.chunk(3)
+        b_q, b_k, _ = attn.in_proj_bias.chunk(3)
+        # mean(x) @ W_q == mean(x @ W_q), so one projection per image suffices for the query
+        query = F.linear(x.mean(dim=1), w_q, b_q).view(-1, 1, attn.num_heads, head_dim)
+        keys = F.linear(x, w_k, b_k).view(x.shape[0], x.shape[1], attn.num_heads, head_dim)
+        logits = (query * keys).sum(dim=-1) / head_dim ** 0.5  # B, N, heads
+        return logits.softmax(dim=1).mean(dim=-1)
+
+    def reduce_tokens(self, x, layer, keep_ratio):
+        """Keep the top keep_ratio of tokens for layer, fusing the rest into one token"""
+        num_tokens = x.shape[1]
+        keep = max(1, int(num_tokens * keep_ratio))
+        if keep >= num_tokens:
+            return x
+        scores = self.token_scores(x, layer)
+        order = scores.argsort(dim=1, descending=True)
+        kept_idx, dropped_idx = order[:, :keep], order[:, keep:]
+        kept = x.gather(1, kept_idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+        if not self.fuse_tokens:
+            return kept
+        dropped = x.gather(1, dropped_idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+        weights = scores.gather(1, dropped_idx)
+        weights = weights / weights.sum(dim=1, keepdim=True).clamp_min(1e-12)
+        fused = (dropped * weights.unsqueeze(-1)).sum(dim=1, keepdim=True)
+        return torch.cat([kept, fused], dim=1)
+
+    def tokens_per_layer(self, num_patches=None):
+        """Token count entering each transformer layer under the current schedule"""
+        tokens = num_patches or self.pos_embed.shape[1]
+        counts = []
+        for i in range(len(self.transformer.layers)):
+            keep_ratio = self.keep_schedule.get(i, 1.0)
+            keep = max(1, int(tokens * keep_ratio))
+            if keep < tokens:
+                tokens = keep + (1 if self.fuse_tokens else 0)
+            counts.append(tokens)
+        return counts
     
-    def forward(self, x):
+    def forward_features(self, x):
+        """Mean-pooled transformer tokens, (B, embed_dim)"""
         # Patch embedding
         x = self.patch_embed(x)  # B, C, H, W -> B, embed_dim, H//patch_size, W//patch_size
+        grid_h, grid_w = x.shape[-2:]
         x = x.flatten(2).transpose(1, 2)  # B, (H//patch_size)**2, embed_dim
         
         # Add positional embedding
-        x = x + self.pos_embed
+        x = x + self._pos_embed_for(grid_h, grid_w)
         
         # Transformer encoding
-        x = self.transformer(x)
+        if not self.keep_schedule:
+            x = self.transformer(x)
+        else:
+            for i, layer in enumerate(self.transformer.layers):
+                if i in self.keep_schedule:
+                    x = self.reduce_tokens(x, layer, self.keep_schedule[i])
+                x = layer(x)
         
         # Global average pooling
-        x = x.mean(dim=1)
-        
+        return x.mean(dim=1)
+    
+    def forward_head(self, features):
         # Classification
-        output = self.classifier(x)
-        return output
+        return self.classifier(features)
+    
+    def forward(self, x):
+        return self.forward_head(self.forward_features(x))
 
 
 # Ensemble model combining multiple architectures
+class StackingHead(nn.Module):
+    """
+    Learned combination of ensemble member outputs
+    
+    A linear layer over the concatenated per-member log-probabilities,
+    initialized to the equal-weight average of the members.
+    """
+    
+    def __init__(self, num_members, num_classes):
+        super(StackingHead, self).__init__()
+        self.num_members = num_members
+        self.num_classes = num_classes
+        self.linear = nn.Linear(num_members * num_classes, num_classes)
+        with torch.no_grad():
+            self.linear.weight.copy_(torch.eye(num_classes).repeat(1, num_members) / num_members)
+            self.linear.bias.zero_()
+    
+    def forward(self, member_outputs):
+        """member_outputs: (B, num_members, num_classes) logits"""
+        return self.linear(F.log_softmax(member_outputs, dim=2).flatten(1))
+
+
 class EnsembleModel(nn.Module):
-    def __init__(self, models, weights=None):
+    """
+    Weighted average of member outputs, or a learned combiner (e.g. a
+    StackingHead) applied to the stacked (B, members, classes) outputs
+    
+    Members run one after another by default. In eval mode they can run concurrently:
+    - parallel='threads': one thread per member (torch releases the GIL inside
+      its kernels), sharing this process's intra-op thread pool; use
+      choose_parallel() to keep it only where it is measurably faster
+    - start_process_pool(): one worker process per member, each pinned to
+      threads_per_member threads; the input batch is placed in shared memory
+      once and read by every member
+    Latency of each member in the last forward is kept in member_latencies.
+    Training always runs the members sequentially.
+    """
+    
+    def __init__(self, models, weights=None, parallel=None, threads_per_member=None, combiner=None):
         super(EnsembleModel, self).__init__()
         self.models = nn.ModuleList(models)
+        self.combiner = combiner
         self.weights = weights if weights is not None else [1.0] * len(models)
         
         # Normalize weights
         total_weight = sum(self.weights)
         self.weights = [w / total_weight for w in self.weights]
+        
+        self.parallel = parallel
+        self.threads_per_member = threads_per_member or max(1, torch.get_num_threads() // len(models))
+        self.member_latencies = [0.0] * len(models)
+        self._pool = None
+        self._executor = None
+    
+    def _timed(self, index, x):
+        start = time.perf_counter()
+        output = self.models[index](x)
+        self.member_latencies[index] = time.perf_counter() - start
+        return output
     
     def forward(self, x):
-        outputs = []
-        for model in self.models:
-            outputs.append(model(x))
+        if not self.training and self._pool is not None:
+            outputs, self.member_latencies = self._pool.run(x)
+        elif not self.training and self.parallel == 'threads':
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=len(self.models))
+            # Autograd and inference mode are thread-local: carry the caller's over
+            grad_enabled, inference = torch.is_grad_enabled(), torch.is_inference_mode_enabled()
+            
+            def run(index):
+                with torch.set_grad_enabled(grad_enabled), torch.inference_mode(inference):
+                    return self._timed(index, x)
+            
+            outputs = list(self._executor.map(run, range(len(self.models))))
+        else:
+            outputs = [self._timed(i, x) for i in range(len(self.models))]
+        
+        if self.combiner is not None:
+            return self.combiner(torch.stack(outputs, dim=1))
         
         # Weighted ensemble
         ensemble_output = torch.zeros_like(outputs[0])
@@ -232,15 +635,191 @@ class EnsembleModel(nn.Module):
             ensemble_output += self.weights[i] * output
         
         return ensemble_output
+    
+    def choose_parallel(self, x, repeats=3):
+        """
+        Time eval-mode forwards of x sequentially and with parallel='threads'
+        and keep the faster mode
+        
+        Returns:
+            dict: median seconds per forward of each mode
+        """
+        was_training = self.training
+        self.eval()
+        timings = {}
+        with torch.inference_mode():
+            for mode in (None, 'threads'):
+                self.parallel = mode
+                self(x)  # warm-up
+                runs = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    self(x)
+                    runs.append(time.perf_counter() - start)
+                timings[mode or 'sequential'] = float(np.median(runs))
+        self.parallel = 'threads' if timings['threads'] < 0.9 * timings['sequential'] else None
+        self.train(was_training)
+        print(f"Ensemble members: {timings['sequential']:.3f}s sequential, {timings['threads']:.3f}s threaded "
+              f"per batch -> {'threads' if self.parallel else 'sequential'}")
+        return timings
+    
+    def start_process_pool(self, threads_per_member=None):
+        """Serve eval-mode forwards from one worker process per member"""
+        self.stop_process_pool()
+        self._pool = EnsembleProcessPool(list(self.models), threads_per_member or self.threads_per_member)
+        return self
+    
+    def stop_process_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+    
+    def latency_report(self):
+        """Per-member latency (seconds) of the last forward, keyed by member class name"""
+        return {f"{i}:{type(model).__name__}": latency
+                for i, (model, latency) in enumerate(zip(self.models, self.member_latencies))}
+
+
+def _ensemble_member_worker(model, num_threads, requests, responses):
+    torch.set_num_threads(num_threads)
+    model.eval()
+    with torch.inference_mode():
+        while True:
+            x = requests.get()
+            if x is None:
+                return
+            start = time.perf_counter()
+            output = model(x)
+            responses.put((output, time.perf_counter() - start))
+
+
+class EnsembleProcessPool:
+    """One persistent worker process per ensemble member, each with its own thread budget"""
+    
+    def __init__(self, models, threads_per_member=1):
+        context = torch.multiprocessing.get_context('spawn')
+        self._workers = []
+        for model in models:
+            requests, responses = context.Queue(), context.Queue()
+            process = context.Process(target=_ensemble_member_worker,
+                                      args=(model, threads_per_member, requests, responses), daemon=True)
+            process.start()
+            self._workers.append((process, requests, responses))
+    
+    def run(self, x):
+        """Returns (outputs, latencies) for one input batch"""
+        # Moved to shared memory once; each worker receives a handle, not a copy
+        x = x.detach().cpu().share_memory_()
+        for _, requests, _ in self._workers:
+            requests.put(x)
+        results = [responses.get() for _, _, responses in self._workers]
+        return [output for output, _ in results], [latency for _, latency in results]
+    
+    def close(self):
+        for process, requests, _ in self._workers:
+            requests.put(None)
+        for process, _, _ in self._workers:
+            process.join(timeout=10)
+        self._workers = []
 
 
 # Advanced training utilities
+class ProgressiveResizing:
+    """
+    Training image size and batch size per epoch, growing in stages
+    
+    Stage k (k >= 1) starts at the k-th warm restart of
+    CosineAnnealingWarmRestarts(T_0, T_mult), so every resolution change
+    coincides with the learning rate jumping back up. The batch size scales
+    with the inverse pixel count, base_batch_size * (final_size / size)^2,
+    which keeps the compute per step roughly constant. Validation stays at
+    the final size.
+    """
+    
+    def __init__(self, sizes=(128, 176, 224), base_batch_size=16, T_0=10, T_mult=2, stage_epochs=None):
+        """
+        Args:
+            sizes: Image size of each stage, ending with the full resolution
+            base_batch_size: Batch size at the final size
+            T_0, T_mult: The trainer's CosineAnnealingWarmRestarts parameters
+            stage_epochs: Explicit first epoch of stages 1.. (overrides the restarts)
+        """
+        self.sizes = tuple(sizes)
+        self.base_batch_size = base_batch_size
+        if stage_epochs is None:
+            stage_epochs, restart, period = [], 0, T_0
+            for _ in range(len(self.sizes) - 1):
+                restart += period
+                stage_epochs.append(restart)
+                period *= T_mult
+        self.stage_epochs = tuple(stage_epochs)
+    
+    def __repr__(self):
+        return f"ProgressiveResizing(sizes={self.sizes}, stage_epochs={self.stage_epochs})"
+    
+    def stage(self, epoch):
+        return sum(epoch >= start for start in self.stage_epochs)
+    
+    def image_size(self, epoch):
+        return self.sizes[self.stage(epoch)]
+    
+    def batch_size(self, epoch):
+        scale = (self.sizes[-1] / self.image_size(epoch)) ** 2
+        return max(1, int(self.base_batch_size * scale))
+
+
+def _flag_last(iterable):
+    """Yield (item, is_last) pairs, looking one item ahead"""
+    iterator = iter(iterable)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+    for item in iterator:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
 class AdvancedTrainer:
-    def __init__(self, model, device='cpu'):
+    def __init__(self, model, device='cpu', use_bf16=False, accumulation_steps=1, channels_last=False,
+                 compile_model=False, checkpoint_manager=None, checkpoint_every=0, batch_transform=None,
+                 resize_schedule=None):
+        """
+        Args:
+            model: Model to train
+            device: Training device
+            use_bf16: Run forward passes under bfloat16 autocast (weights and
+                optimizer state stay float32); None enables it where the CPU supports it
+            accumulation_steps: Batches whose gradients are summed per optimizer
+                step, for an effective batch of accumulation_steps * batch_size
+            channels_last: Use NHWC memory format for the model and 4D inputs
+            compile_model: Train through torch.compile(model); self.model stays
+                the original module, so saving and loading state dicts are unchanged
+            checkpoint_manager: CheckpointManager used by save_checkpoint()
+            checkpoint_every: Also checkpoint every N optimizer steps within an
+                epoch (0 = only when save_checkpoint() is called)
+            batch_transform: Callable applied to every training batch on the
+                device, e.g. BatchAugment
+            resize_schedule: ProgressiveResizing; train_epoch() then rebuilds the
+                training loader at each epoch's image and batch size
+        """
         self.model = model
         self.device = device
         self.model.to(device)
         
+        self.use_bf16 = cpu_supports_bf16() if use_bf16 is None else use_bf16
+        self.accumulation_steps = max(1, accumulation_steps)
+        self.channels_last = channels_last
+        self.batch_transform = batch_transform
+        self.resize_schedule = resize_schedule
+        self._stage_transforms = {}  # (id of the dataset transform, image size) -> transform at that size
+        self._stage_loader = None  # (caller's dataloader, stage, loader built for that stage)
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+        self.forward_model = torch.compile(self.model) if compile_model else self.model
+        self.autocast_device = torch.device(device).type
+        
         # Advanced optimizers
         self.optimizer = torch.optim.AdamW(
             self.model.parameters(),
@@ -264,34 +843,225 @@ class AdvancedTrainer:
         self.best_loss = float('inf')
         self.patience = 15
         self.counter = 0
+        
+        self.epochs_completed = 0
+        self.epoch_stats = []  # per-epoch throughput and memory, see train_epoch
+        
+        # Checkpointing and mid-epoch resume
+        self.checkpoint_manager = checkpoint_manager
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_extra = {}  # caller state saved with every checkpoint (fold, best score, ...)
+        self.batches_done = 0  # position within the current epoch
+        self._resume_rng = None
+        self._epoch_totals = (0.0, 0, 0)  # loss, correct, total of the batches already done
+    
+    def state_dict(self):
+        """Complete training state: weights, optimizer, scheduler, early stopping, RNG and position"""
+        state = {
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'best_loss': self.best_loss,
+            'counter': self.counter,
+            'epochs_completed': self.epochs_completed,
+            'batches_done': self.batches_done,
+            'epoch_totals': self._epoch_totals,
+            'epoch_stats': self.epoch_stats,
+            'rng': {
+                'torch': torch.get_rng_state(),
+                'numpy': np.random.get_state(),
+                'python': random.getstate(),
+            },
+            'extra': self.checkpoint_extra,
+        }
+        if torch.cuda.is_available():
+            state['rng']['cuda'] = torch.cuda.get_rng_state_all()
+        return state
+    
+    def load_state_dict(self, state):
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.best_loss = state['best_loss']
+        self.counter = state['counter']
+        self.epochs_completed = state['epochs_completed']
+        self.batches_done = state['batches_done']
+        self._epoch_totals = tuple(state['epoch_totals'])
+        self.epoch_stats = list(state['epoch_stats'])
+        self.checkpoint_extra = dict(state['extra'])
+        self._set_rng_state(state['rng'])
+        # Re-applied once the resumed epoch's DataLoader iterator exists, since creating it draws a seed
+        self._resume_rng = state['rng'] if self.batches_done else None
+    
+    @staticmethod
+    def _set_rng_state(rng):
+        torch.set_rng_state(rng['torch'])
+        np.random.set_state(rng['numpy'])
+        random.setstate(rng['python'])
+        if 'cuda' in rng and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng['cuda'])
+    
+    def save_checkpoint(self):
+        """Queue the current state on the checkpoint manager (no-op without one)"""
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.save(self.state_dict())
+    
+    def _prepare_input(self, data, augment=False):
+        data = data.to(self.device)
+        if augment and self.batch_transform is not None:
+            with torch.no_grad():
+                data = self.batch_transform(data)
+        if self.channels_last and data.dim() == 4:
+            data = data.contiguous(memory_format=torch.channels_last)
+        return data
+    
+    def _autocast(self):
+        return torch.autocast(self.autocast_device, dtype=torch.bfloat16, enabled=self.use_bf16)
+    
+    def _count_correct(self, output, target):
+        """Correct predictions in a batch; subclasses with non-label targets override this"""
+        pred = output.argmax(dim=1, keepdim=True)
+        return pred.eq(target.view_as(pred)).sum().item()
+    
+    def _stage_transform(self, transform, image_size):
+        """
+        transform with its Resize set to image_size, built once per size so its
+        random state carries over between the epochs of a stage
+        """
+        key = (id(transform), image_size)
+        if key not in self._stage_transforms:
+            resizes = [t for t in getattr(transform, 'transforms', []) if isinstance(t, A.Resize)]
+            if isinstance(transform, A.BaseCompose) and resizes:
+                resized = copy.deepcopy(transform)
+                for t in resized.transforms:
+                    if isinstance(t, A.Resize):
+                        t.height = t.width = image_size
+            else:
+                # No Resize step to adjust: fall back to the standard training pipeline
+                batch_ops = self.batch_transform.ops if isinstance(self.batch_transform, BatchAugment) else ()
+                resized = get_advanced_transforms(is_training=True, image_size=image_size, batch_ops=batch_ops)
+            self._stage_transforms[key] = resized
+        return self._stage_transforms[key]
+    
+    def _progressive_loader(self, dataloader):
+        """
+        dataloader rebuilt at the schedule's image size and batch size for the current epoch
+        
+        Built once per stage and reused within it, so persistent workers are
+        kept until the size changes.
+        """
+        epoch = self.epochs_completed
+        stage = self.resize_schedule.stage(epoch)
+        if self._stage_loader is not None and self._stage_loader[0] is dataloader and self._stage_loader[1] == stage:
+            return self._stage_loader[2]
+        # Drop the previous stage's loader (and its persistent workers) before starting new ones
+        self._stage_loader = None
+        image_size = self.resize_schedule.image_size(epoch)
+        batch_size = self.resize_schedule.batch_size(epoch)
+        # A shallow copy with its own transform: the caller's dataset is left untouched
+        dataset = copy.copy(dataloader.dataset)
+        dataset.transform = self._stage_transform(dataloader.dataset.transform, image_size)
+        options = {'batch_size': batch_size, 'num_workers': dataloader.num_workers,
+                   'pin_memory': dataloader.pin_memory, 'drop_last': dataloader.drop_last,
+                   'worker_init_fn': dataloader.worker_init_fn}
+        if dataloader.num_workers > 0:
+            options['prefetch_factor'] = dataloader.prefetch_factor
+            options['persistent_workers'] = dataloader.persistent_workers
+        if not isinstance(dataset, torch.utils.data.IterableDataset):
+            options['sampler'] = dataloader.sampler
+        print(f"  progressive resizing: {image_size}x{image_size}, batch size {batch_size}")
+        self._stage_loader = (dataloader, stage, torch.utils.data.DataLoader(dataset, **options))
+        return self._stage_loader[2]
     
     def train_epoch(self, dataloader):
         self.model.train()
-        total_loss = 0
-        correct = 0
-        total = 0
-        
-        for batch_idx, (data, target) in enumerate(dataloader):
-            data, target = data.to(self.device), target.to(self.device)
-            
-            self.optimizer.zero_grad()
-            output = self.model(data)
-            loss = self.criterion(output, target)
+        if self.resize_schedule is not None:
+            dataloader = self._progressive_loader(dataloader)
+        # Streaming datasets and resumable samplers reshuffle per epoch
+        if hasattr(dataloader.dataset, 'set_epoch'):
+            dataloader.dataset.set_epoch(self.epochs_completed)
+        if hasattr(dataloader.sampler, 'set_epoch'):
+            dataloader.sampler.set_epoch(self.epochs_completed)
+        
+        # Continue a checkpointed epoch after the batches it had already done
+        skipped = self.batches_done
+        if skipped and hasattr(dataloader.sampler, 'skip'):
+            dataloader.sampler.skip(skipped * dataloader.batch_size)
+            total_loss, correct, total = self._epoch_totals
+            print(f"  resuming epoch {self.epochs_completed + 1} at batch {skipped}")
+        else:
+            if skipped:
+                print(f"  restarting epoch {self.epochs_completed + 1}: the loader cannot skip batches")
+            skipped = 0
+            total_loss, correct, total = 0.0, 0, 0
+        start = time.perf_counter()
+        start_total = total
+        batches_seen = skipped
+        
+        batches = iter(dataloader)
+        if skipped and self._resume_rng is not None:
+            self._set_rng_state(self._resume_rng)
+        self._resume_rng = None
+        
+        self.optimizer.zero_grad()
+        # Group boundaries follow the batches actually received: streaming loaders
+        # can yield more (or fewer) batches than len(dataloader)
+        for batch_idx, ((data, target), is_last) in enumerate(_flag_last(batches), start=skipped):
+            data, target = self._prepare_input(data, augment=True), target.to(self.device)
             
-            loss.backward()
+            with self._autocast():
+                output = self.forward_model(data)
+                loss = self.criterion(output, target)
             
-            # Gradient clipping
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1.0)
+            # Average over the batches of this accumulation group
+            (loss / self.accumulation_steps).backward()
+            group_size = batch_idx % self.accumulation_steps + 1
+            group_end = group_size == self.accumulation_steps or is_last
             
-            self.optimizer.step()
+            if group_end:
+                if group_size < self.accumulation_steps:
+                    # Short last group: rescale the sum to its own mean
+                    for param in self.model.parameters():
+                        if param.grad is not None:
+                            param.grad.mul_(self.accumulation_steps / group_size)
+                
+                # Gradient clipping
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1.0)
+                
+                self.optimizer.step()
+                self.optimizer.zero_grad()
             
             total_loss += loss.item()
-            pred = output.argmax(dim=1, keepdim=True)
-            correct += pred.eq(target.view_as(pred)).sum().item()
+            correct += self._count_correct(output, target)
             total += target.size(0)
+            batches_seen = batch_idx + 1
+            
+            # Mid-epoch checkpoints only at optimizer-step boundaries, where no gradients are pending
+            if group_end:
+                self.batches_done = batch_idx + 1
+                self._epoch_totals = (total_loss, correct, total)
+                steps = self.batches_done // self.accumulation_steps
+                if self.checkpoint_every and steps % self.checkpoint_every == 0 and not is_last:
+                    self.save_checkpoint()
         
         self.scheduler.step()
-        return total_loss / len(dataloader), correct / total
+        self.epochs_completed += 1
+        self.batches_done = 0
+        self._epoch_totals = (0.0, 0, 0)
+        
+        elapsed = time.perf_counter() - start
+        stats = {'epoch': self.epochs_completed, 'seconds': elapsed,
+                 'images_per_sec': (total - start_total) / elapsed if elapsed > 0 else 0.0,
+                 'peak_rss_mb': peak_rss_mb()}
+        if self.resize_schedule is not None:
+            stats['image_size'] = self.resize_schedule.image_size(self.epochs_completed - 1)
+        self.epoch_stats.append(stats)
+        rss = f", peak RSS {stats['peak_rss_mb']:.0f} MB" if stats['peak_rss_mb'] is not None else ""
+        print(f"  epoch {self.epochs_completed}: {stats['images_per_sec']:.1f} images/sec{rss} "
+              f"(bf16={self.use_bf16}, accumulation={self.accumulation_steps}, "
+              f"channels_last={self.channels_last}, compiled={self.forward_model is not self.model}, "
+              f"batch_transform={self.batch_transform})")
+        return total_loss / max(batches_seen, 1), correct / total
     
     def validate(self, dataloader):
         self.model.eval()
@@ -299,15 +1069,14 @@ class AdvancedTrainer:
         correct = 0
         total = 0
         
-        with torch.no_grad():
+        with torch.no_grad(), self._autocast():
             for data, target in dataloader:
-                data, target = data.to(self.device), target.to(self.device)
-                output = self.model(data)
+                data, target = self._prepare_input(data), target.to(self.device)
+                output = self.forward_model(data)
                 loss = self.criterion(output, target)
                 
                 total_loss += loss.item()
-                pred = output.argmax(dim=1, keepdim=True)
-                correct += pred.eq(target.view_as(pred)).sum().item()
+                correct += self._count_correct(output, target)
                 total += target.size(0)
         
         return total_loss / len(dataloader), correct / total
@@ -324,43 +1093,238 @@ class AdvancedTrainer:
         return False
 
 
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Wraps a random sampler (RandomSampler, WeightedRandomSampler, ...) so each
+    epoch's order depends only on seed and epoch, and an interrupted epoch
+    can continue after the samples it had already drawn.
+    AdvancedTrainer calls set_epoch() and skip() itself.
+    """
+    
+    def __init__(self, sampler, seed=42):
+        self.sampler = sampler
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+    
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+    
+    def skip(self, num_samples):
+        """Drop the first num_samples indices of the next iteration only"""
+        self.start_index = num_samples
+    
+    def __iter__(self):
+        self.sampler.generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        start, self.start_index = self.start_index, 0
+        return itertools.islice(iter(self.sampler), start, None)
+    
+    def __len__(self):
+        return len(self.sampler)
+
+
+def _snapshot(obj):
+    """Copy tensors to CPU so training can keep mutating the originals while a write is pending"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(value) for value in obj)
+    return obj
+
+
+class CheckpointManager:
+    """
+    Writes checkpoints from a background thread
+    
+    save() snapshots the state on the calling thread and returns; a worker
+    thread serializes it to a temporary file and atomically renames it to
+    checkpoint_XXXXXXXX.pt, keeping only the last keep_last checkpoints.
+    Errors from the worker are raised on the next save()/wait().
+    """
+    
+    PREFIX = 'checkpoint_'
+    
+    def __init__(self, directory, keep_last=3):
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        existing = self._checkpoints()
+        self._next_index = int(existing[-1][len(self.PREFIX):-3]) + 1 if existing else 0
+        self._queue = queue.Queue(maxsize=2)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+    
+    def _checkpoints(self):
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith(self.PREFIX) and name.endswith('.pt')]
+        return sorted(names)
+    
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            obj, path, rotate = item
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(obj, tmp_path)
+                os.replace(tmp_path, path)
+                if rotate:
+                    for name in self._checkpoints()[:-self.keep_last]:
+                        os.remove(os.path.join(self.directory, name))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+    
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"Checkpoint write failed: {error}") from error
+    
+    def save(self, state):
+        """Queue a numbered checkpoint; returns its path"""
+        self._raise_pending_error()
+        path = os.path.join(self.directory, f'{self.PREFIX}{self._next_index:08d}.pt')
+        self._next_index += 1
+        self._queue.put((_snapshot(state), path, True))
+        return path
+    
+    def write(self, obj, path):
+        """Queue an atomic write of any object (e.g. a best-model state_dict) to path"""
+        self._raise_pending_error()
+        self._queue.put((_snapshot(obj), path, False))
+    
+    def latest(self):
+        """Path of the newest checkpoint, or None"""
+        self.wait()
+        existing = self._checkpoints()
+        return os.path.join(self.directory, existing[-1]) if existing else None
+    
+    def load_latest(self, map_location='cpu'):
+        path = self.latest()
+        # Written locally by save(); holds numpy / python RNG state, which weights_only (torch >= 2.6 default) rejects
+        return torch.load(path, map_location=map_location, weights_only=False) if path else None
+    
+    def wait(self):
+        """Block until all queued writes are on disk"""
+        self._queue.join()
+        self._raise_pending_error()
+    
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+
 # small grad-cam implementation for ResNet50
 class GradCAM:
+    """
+    Batched GradCAM engine for one target layer
+
+    Hooks are registered once and stay until remove() (or the end of a with
+    block); they only record while a CAM is being computed, so ordinary
+    forward passes through the model are not affected.
+    """
+
     def __init__(self, model, target_layer):
         self.model = model
         self.target_layer = target_layer
-        self.gradients = None
+        self.gradients = []
         self.activations = None
+        self._recording = False
+        self._handles = []
         self.hook()
     
     def hook(self):
         def forward_hook(module, inp, out):
-            self.activations = out.detach()
+            if self._recording:
+                self.activations = out.detach()
         
         def backward_hook(module, grad_in, grad_out):
-            self.gradients = grad_out[0].detach()
-        
-        self.target_layer.register_forward_hook(forward_hook)
-        self.target_layer.register_backward_hook(backward_hook)
-    
+            if self._recording:
+                self.gradients.append(grad_out[0].detach())
+        
+        if not self._handles:
+            self._handles = [
+                self.target_layer.register_forward_hook(forward_hook),
+                self.target_layer.register_full_backward_hook(backward_hook),
+            ]
+
+    def remove(self):
+        """Unregister the hooks"""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.remove()
+
+    def compute(self, input_tensor, class_idx=None, output_size=None):
+        """
+        CAMs for a whole batch with one forward pass and one backward pass per target class
+
+        Args:
+            input_tensor: (B, C, H, W) batch
+            class_idx: None (predicted class of each image), an int, a list of
+                class indices, or a (B,) tensor with one class per image
+            output_size: (H, W) of the returned maps, default the input size
+
+        Returns:
+            (cams, logits): cams is a (B, K, H, W) tensor scaled to [0, 1] per
+            map, K being the number of target classes
+        """
+        if not self._handles:
+            raise RuntimeError("GradCAM hooks were removed")
+        output_size = output_size or tuple(input_tensor.shape[-2:])
+        batch_size = input_tensor.size(0)
+
+        self._recording = True
+        self.gradients = []
+        try:
+            with torch.enable_grad():
+                self.model.zero_grad(set_to_none=True)
+                out = self.model(input_tensor)
+
+                if class_idx is None:
+                    targets = [out.argmax(dim=1)]
+                elif isinstance(class_idx, torch.Tensor) and class_idx.dim() == 1:
+                    targets = [class_idx.to(out.device)]
+                else:
+                    classes = [class_idx] if isinstance(class_idx, int) else list(class_idx)
+                    targets = [torch.full((batch_size,), int(c), device=out.device) for c in classes]
+
+                # Images are independent at inference, so the gradient of the
+                # summed scores gives every image its own gradient
+                for k, target in enumerate(targets):
+                    score = out.gather(1, target.view(-1, 1)).sum()
+                    score.backward(retain_graph=k < len(targets) - 1)
+        finally:
+            self._recording = False
+            self.model.zero_grad(set_to_none=True)
+
+        gradients = torch.stack(self.gradients, dim=1)  # B, K, C, h, w
+        weights = gradients.mean(dim=(3, 4), keepdim=True)
+        cams = F.relu((weights * self.activations.unsqueeze(1)).sum(dim=2))  # B, K, h, w
+        cams = F.interpolate(cams, size=output_size, mode='bilinear', align_corners=False)
+        low = cams.amin(dim=(2, 3), keepdim=True)
+        high = cams.amax(dim=(2, 3), keepdim=True)
+        cams = (cams - low) / (high - low + 1e-8)
+        self.gradients = []
+        self.activations = None
+        return cams, out.detach()
+
     def __call__(self, input_tensor, class_idx=None):
-        self.model.zero_grad()
-        out = self.model(input_tensor)
-        
-        if class_idx is None:
-            class_idx = torch.argmax(out, dim=1).item()
-        
-        loss = out[0, class_idx]
-        loss.backward(retain_graph=True)
-        
-        weights = self.gradients.mean(dim=(2,3), keepdim=True)
-        cam = (weights * self.activations).sum(dim=1, keepdim=True)
-        cam = F.relu(cam)
-        cam = cam.squeeze().cpu().numpy()
-        cam = cv2.resize(cam, (input_tensor.size(3), input_tensor.size(2)))
-        cam = (cam - cam.min()) / (cam.max() - cam.min() + 1e-8)
-        
-        return cam
+        """Single-image interface: (H, W) numpy heatmap ((B, K, H, W) squeezed for larger requests)"""
+        cams, _ = self.compute(input_tensor, class_idx)
+        return cams.squeeze().cpu().numpy()
 
 
 class ModelInterpreter:
@@ -370,6 +1334,7 @@ class ModelInterpreter:
         self.model = model
         self.device = device
         self.model.eval()
+        self._gradcam_engines = {}
         
         # Standard ImageNet transforms
         self.transform = transforms.Compose([
@@ -408,16 +1373,31 @@ class ModelInterpreter:
         
         return predicted_class, confidence, probabilities
     
-    def visualize_gradcam(self, image_path, target_layer, class_idx=None, save_path=None):
-        """Generate and visualize GradCAM heatmap"""
+    def gradcam_engine(self, target_layer):
+        """GradCAM engine for target_layer, created (and hooked) once per layer"""
+        engine = self._gradcam_engines.get(target_layer)
+        if engine is None:
+            engine = GradCAM(self.model, target_layer)
+            self._gradcam_engines[target_layer] = engine
+        return engine
+
+    def close(self):
+        """Remove the hooks of every cached GradCAM engine"""
+        for engine in self._gradcam_engines.values():
+            engine.remove()
+        self._gradcam_engines = {}
+
+    def gradcam_batch(self, input_tensor, target_layer, class_idx=None):
+        """(B, K, H, W) GradCAM maps and logits for a preprocessed batch"""
+        return self.gradcam_engine(target_layer).compute(input_tensor.to(self.device), class_idx)
+
+    def visualize_gradcam(self, image_path, target_layer, class_idx=None, save_path=None, show=True):
+        """Generate and visualize GradCAM heatmap (show=False closes the figure instead, for headless use)"""
         # Preprocess image
         input_tensor, original_image = self.preprocess_image(image_path)
         
-        # Initialize GradCAM
-        grad_cam = GradCAM(self.model, target_layer)
-        
         # Generate heatmap
-        heatmap = grad_cam(input_tensor, class_idx)
+        heatmap = self.gradcam_engine(target_layer)(input_tensor, class_idx)
         
         # Convert heatmap to RGB
         heatmap_rgb = cv2.applyColorMap(np.uint8(255 * heatmap), cv2.COLORMAP_JET)
@@ -455,7 +1435,10 @@ class ModelInterpreter:
         if save_path:
             plt.savefig(save_path, dpi=300, bbox_inches='tight')
         
-        plt.show()
+        if show:
+            plt.show()
+        else:
+            plt.close(fig)
         
         return heatmap, overlay
     
@@ -477,8 +1460,8 @@ class ModelInterpreter:
             return feature_maps[0]
         return None
     
-    def visualize_feature_maps(self, input_tensor, target_layer, num_features=16, save_path=None):
-        """Visualize feature maps from a specific layer"""
+    def visualize_feature_maps(self, input_tensor, target_layer, num_features=16, save_path=None, show=True):
+        """Visualize feature maps from a specific layer (show=False closes the figure instead)"""
         feature_maps = self.get_feature_maps(input_tensor, target_layer)
         
         if feature_maps is None:
@@ -505,7 +1488,10 @@ class ModelInterpreter:
         if save_path:
             plt.savefig(save_path, dpi=300, bbox_inches='tight')
         
-        plt.show()
+        if show:
+            plt.show()
+        else:
+            plt.close(fig)
 
 
 def create_resnet_model(pretrained=True, num_classes=2):
@@ -559,25 +1545,258 @@ def save_model_checkpoint(model, optimizer, epoch, loss, save_path):
     print(f"Checkpoint saved to {save_path}")
 
 
-def calculate_model_metrics(y_true, y_pred, y_proba=None):
-    """Calculate comprehensive model evaluation metrics"""
-    from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score, confusion_matrix
+class StreamingMetrics:
+    """
+    Constant-memory classification metrics, updated batch by batch
     
-    metrics = {
-        'accuracy': accuracy_score(y_true, y_pred),
-        'precision': precision_score(y_true, y_pred, average='weighted'),
-        'recall': recall_score(y_true, y_pred, average='weighted'),
-        'f1_score': f1_score(y_true, y_pred, average='weighted'),
-    }
+    Keeps a confusion matrix and, for every (true class, scored class) pair,
+    a fixed-bin histogram of the predicted scores. ROC-AUC, ROC and PR
+    curves and threshold sweeps are computed from the histograms, so memory
+    does not grow with the number of samples. Scores are binned on
+    asinh(log-odds) over [-BIN_RANGE, BIN_RANGE]: close to uniform in
+    log-odds near p = 0.5 and logarithmic in the tails, so confident
+    scores that saturate in probability space stay apart. Log-odds are
+    computed from the logits when given. Samples sharing a bin count as
+    ties. Per-sample arrays are kept only with keep_samples=True.
+    """
+    
+    BIN_RANGE = 12.0  # asinh(log-odds); |log-odds| up to ~8e4
     
+    def __init__(self, num_classes=None, num_bins=4096, keep_samples=False):
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.keep_samples = keep_samples
+        self.confusion = None
+        self.histograms = None  # [true class, scored class, bin]
+        self._samples = {'labels': [], 'predictions': [], 'probabilities': []}
+        if num_classes is not None:
+            self._allocate(num_classes)
+    
+    def _allocate(self, num_classes):
+        self.num_classes = num_classes
+        self.confusion = torch.zeros(num_classes, num_classes, dtype=torch.long)
+        self.histograms = torch.zeros(num_classes, num_classes, self.num_bins, dtype=torch.long)
+    
+    def _add_confusion(self, target, predictions):
+        c = self.num_classes
+        self.confusion += torch.bincount(target * c + predictions, minlength=c * c).view(c, c).cpu()
+    
+    def update(self, output, target, from_logits=True, predictions=None):
+        """
+        Add a batch
+        
+        Args:
+            output: (B, C) logits, or probabilities with from_logits=False
+            target: (B,) true classes
+            predictions: (B,) predicted classes, default output.argmax(1)
+        """
+        output = torch.as_tensor(output).detach().float()
+        target = torch.as_tensor(target, device=output.device).long().view(-1)
+        if self.confusion is None:
+            self._allocate(output.shape[1])
+        probabilities = output.softmax(dim=1) if from_logits else output
+        c, bins = output.shape[1], self.num_bins
+        if from_logits:
+            # log(p / (1 - p)) of each class: its logit minus the logsumexp of the others
+            others = output.unsqueeze(1).expand(-1, c, -1)
+            others = others.masked_fill(torch.eye(c, dtype=torch.bool, device=output.device), float('-inf'))
+            log_odds = output - others.logsumexp(dim=2)
+        else:
+            p = probabilities.double().clamp(0, 1)
+            log_odds = torch.log(p) - torch.log1p(-p)
+        if predictions is None:
+            predictions = probabilities.argmax(dim=1)
+        predictions = torch.as_tensor(predictions, device=output.device).long().view(-1)
+        self._add_confusion(target, predictions)
+        
+        scaled = (torch.asinh(log_odds).clamp(-self.BIN_RANGE, self.BIN_RANGE) + self.BIN_RANGE) / (2 * self.BIN_RANGE)
+        score_bins = (scaled * bins).long().clamp_(0, bins - 1)
+        flat = (target.unsqueeze(1) * c + torch.arange(c, device=output.device)) * bins + score_bins
+        self.histograms += torch.bincount(flat.flatten(), minlength=c * c * bins).view(c, c, bins).cpu()
+        
+        if self.keep_samples:
+            self._samples['labels'].append(target.cpu().numpy())
+            self._samples['predictions'].append(predictions.cpu().numpy())
+            self._samples['probabilities'].append(probabilities.cpu().numpy())
+    
+    def update_predictions(self, target, predictions, num_classes=None):
+        """Add a batch of hard predictions only (confusion-matrix metrics, no curves)"""
+        target = torch.as_tensor(target).long().view(-1)
+        predictions = torch.as_tensor(predictions).long().view(-1)
+        if self.confusion is None:
+            self._allocate(num_classes or int(max(target.max(), predictions.max())) + 1)
+        self._add_confusion(target, predictions)
+    
+    @property
+    def count(self):
+        return int(self.confusion.sum()) if self.confusion is not None else 0
+    
+    def _positive_negative(self, positive):
+        """Score histograms of class `positive` for its positives and for the rest"""
+        scored = self.histograms[:, positive].double()
+        pos = scored[positive]
+        neg = scored.sum(dim=0) - pos
+        return pos.numpy(), neg.numpy()
+    
+    def _lower_edges(self):
+        """Probability at the lower edge of each bin (0 for the first, which also holds the clamped scores)"""
+        log_odds = np.sinh(np.linspace(-self.BIN_RANGE, self.BIN_RANGE, self.num_bins + 1)[:-1])
+        with np.errstate(over='ignore'):
+            edges = 1 / (1 + np.exp(-log_odds))
+        edges[0] = 0.0
+        return edges
+    
+    def _cumulative(self, positive):
+        # Counts with score >= each bin's lower edge, from the highest bin down
+        pos, neg = self._positive_negative(positive)
+        tp = np.concatenate([[0.0], np.cumsum(pos[::-1])])
+        fp = np.concatenate([[0.0], np.cumsum(neg[::-1])])
+        thresholds = np.concatenate([[1.0], self._lower_edges()[::-1]])
+        return tp, fp, thresholds
+    
+    def roc_curve(self, positive=1):
+        """(fpr, tpr, thresholds) at the histogram bin edges"""
+        tp, fp, thresholds = self._cumulative(positive)
+        return fp / max(fp[-1], 1), tp / max(tp[-1], 1), thresholds
+    
+    def roc_auc(self, positive=None):
+        """
+        ROC-AUC of one class against the rest (positive=None: class 1 for binary
+        problems, macro one-vs-rest average otherwise); None if undefined
+        """
+        if positive is None and self.num_classes > 2:
+            aucs = [self.roc_auc(k) for k in range(self.num_classes)]
+            return None if any(auc is None for auc in aucs) else float(np.mean(aucs))
+        tp, fp, _ = self._cumulative(1 if positive is None else positive)
+        if tp[-1] == 0 or fp[-1] == 0:
+            return None
+        tpr, fpr = tp / tp[-1], fp / fp[-1]
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+    
+    def pr_curve(self, positive=1):
+        """(precision, recall, thresholds) at the histogram bin edges that predict any positive"""
+        tp, fp, thresholds = self._cumulative(positive)
+        predicted = tp + fp
+        keep = predicted > 0
+        return tp[keep] / predicted[keep], tp[keep] / max(tp[-1], 1), thresholds[keep]
+    
+    def average_precision(self, positive=1):
+        precision, recall, _ = self.pr_curve(positive)
+        return float(np.sum(np.diff(np.concatenate([[0.0], recall])) * precision))
+    
+    def threshold_sweep(self, positive=1, thresholds=None):
+        """
+        Binary metrics of `score >= threshold` for class `positive` at each threshold
+        
+        Returns:
+            dict of arrays: threshold, sensitivity, specificity, precision, f1, accuracy
+        """
+        thresholds = np.linspace(0.0, 1.0, 21) if thresholds is None else np.asarray(thresholds, dtype=float)
+        pos, neg = self._positive_negative(positive)
+        # Suffix sums: samples whose score bin is >= k
+        pos_at_least = np.concatenate([np.cumsum(pos[::-1])[::-1], [0.0]])
+        neg_at_least = np.concatenate([np.cumsum(neg[::-1])[::-1], [0.0]])
+        # First bin whose lower edge is >= the threshold
+        k = np.searchsorted(self._lower_edges(), thresholds, side='left')
+        tp, fp = pos_at_least[k], neg_at_least[k]
+        num_pos, num_neg = pos.sum(), neg.sum()
+        tn = num_neg - fp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sensitivity = np.where(num_pos > 0, tp / max(num_pos, 1), 0.0)
+            specificity = np.where(num_neg > 0, tn / max(num_neg, 1), 0.0)
+            precision = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1), 0.0)
+            f1 = np.where(precision + sensitivity > 0,
+                          2 * precision * sensitivity / np.maximum(precision + sensitivity, 1e-12), 0.0)
+        return {
+            'threshold': thresholds,
+            'sensitivity': sensitivity,
+            'specificity': specificity,
+            'precision': precision,
+            'f1': f1,
+            'accuracy': (tp + tn) / max(num_pos + num_neg, 1),
+        }
+    
+    def classification_report(self):
+        """Per-class precision / recall / f1-score / support, as sklearn's output_dict"""
+        cm = self.confusion.double().numpy()
+        support = cm.sum(axis=1)
+        predicted = cm.sum(axis=0)
+        correct = np.diag(cm)
+        precision = np.divide(correct, predicted, out=np.zeros_like(correct), where=predicted > 0)
+        recall = np.divide(correct, support, out=np.zeros_like(correct), where=support > 0)
+        f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(correct),
+                       where=precision + recall > 0)
+        # Only classes that occur (as label or prediction), like sklearn
+        present = (support > 0) | (predicted > 0)
+        report = {str(k): {'precision': precision[k], 'recall': recall[k], 'f1-score': f1[k],
+                           'support': int(support[k])}
+                  for k in np.flatnonzero(present)}
+        total = support.sum()
+        report['accuracy'] = correct.sum() / max(total, 1)
+        weights = support[present] / max(total, 1)
+        report['macro avg'] = {'precision': precision[present].mean(), 'recall': recall[present].mean(),
+                               'f1-score': f1[present].mean(), 'support': int(total)}
+        report['weighted avg'] = {'precision': (precision[present] * weights).sum(),
+                                  'recall': (recall[present] * weights).sum(),
+                                  'f1-score': (f1[present] * weights).sum(), 'support': int(total)}
+        return report
+    
+    def samples(self):
+        """Per-sample labels, predictions and probabilities (keep_samples=True only)"""
+        if not self.keep_samples:
+            raise RuntimeError("StreamingMetrics was created with keep_samples=False")
+        return {key: np.concatenate(values) if values else np.empty(0)
+                for key, values in self._samples.items()}
+    
+    def compute(self):
+        """
+        Summary metrics: accuracy, weighted precision / recall / f1, roc_auc, confusion matrix
+        
+        roc_auc is None when it is undefined (no scores, or a single class);
+        an empty accumulator gives zero counts and an empty report.
+        """
+        if self.confusion is None:
+            return {'accuracy': 0.0, 'precision': 0.0, 'recall': 0.0, 'f1_score': 0.0, 'roc_auc': None,
+                    'confusion_matrix': np.zeros((0, 0), dtype=np.int64), 'classification_report': {}}
+        report = self.classification_report()
+        return {
+            'accuracy': report['accuracy'],
+            'precision': report['weighted avg']['precision'],
+            'recall': report['weighted avg']['recall'],
+            'f1_score': report['weighted avg']['f1-score'],
+            'roc_auc': self.roc_auc() if self.histograms.sum() > 0 else None,
+            'confusion_matrix': self.confusion.numpy(),
+            'classification_report': report,
+        }
+
+
+def format_metric(value, digits=4):
+    """value formatted to `digits` decimals, or 'n/a' for an undefined metric (None)"""
+    return 'n/a' if value is None else f'{value:.{digits}f}'
+
+
+def calculate_model_metrics(y_true, y_pred, y_proba=None, chunk_size=65536):
+    """Calculate comprehensive model evaluation metrics
+    
+    Accumulated with StreamingMetrics in chunks of chunk_size samples.
+    """
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    metrics = StreamingMetrics(num_classes=np.asarray(y_proba).shape[1] if y_proba is not None else None)
+    for start in range(0, len(y_true), chunk_size):
+        rows = slice(start, start + chunk_size)
+        if y_proba is not None:
+            metrics.update(torch.as_tensor(np.asarray(y_proba[rows])), torch.as_tensor(y_true[rows]),
+                           from_logits=False, predictions=torch.as_tensor(y_pred[rows]))
+        else:
+            metrics.update_predictions(y_true[rows], y_pred[rows],
+                                       num_classes=int(max(y_true.max(), y_pred.max())) + 1)
+    
+    summary = metrics.compute()
+    result = {key: summary[key] for key in ('accuracy', 'precision', 'recall', 'f1_score')}
     if y_proba is not None:
-        try:
-            metrics['roc_auc'] = roc_auc_score(y_true, y_proba[:, 1])
-        except:
-            metrics['roc_auc'] = None
+        result['roc_auc'] = summary['roc_auc']
     
     # Confusion matrix
-    cm = confusion_matrix(y_true, y_pred)
-    metrics['confusion_matrix'] = cm
+    result['confusion_matrix'] = summary['confusion_matrix']
     
-    return metrics 
\ No newline at end of file
+    return result
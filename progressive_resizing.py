@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Progressive resizing vs fixed resolution
+
+Trains the same architecture twice from the same seed for the same number
+of epochs: once at the fixed final size (224x224 by default), once with a ProgressiveResizing
+schedule (e.g. 128 -> 176 -> 224, changing at the CosineAnnealingWarmRestarts
+restarts, batch size scaled to match). Reports total training time,
+throughput and validation / test accuracy of both runs. Validation and test
+always run at the full resolution.
+
+Usage:
+    python progressive_resizing.py --arch AttentionResNet --epochs 40 --sizes 128 176 224
+"""
+
+import argparse
+import pandas as pd
+import torch
+
+from model_utils import AttentionResNet, EfficientNetClassifier, MedicalViT, AdvancedTrainer, ProgressiveResizing
+from enhanced_trainer import create_balanced_dataloader, seed_everything
+
+
+ARCHS = {'AttentionResNet': AttentionResNet, 'EfficientNetClassifier': EfficientNetClassifier,
+         'MedicalViT': MedicalViT}
+
+
+def run(arch, schedule, train_loader, val_loader, test_loader, device, epochs, num_classes=2, image_size=224):
+    """Train arch for epochs with an optional resize schedule; returns one report row"""
+    seed_everything(42)
+    model = ARCHS[arch](num_classes=num_classes)
+    trainer = AdvancedTrainer(model, device, resize_schedule=schedule)
+    best_val_acc = val_acc = 0.0
+    for epoch in range(epochs):
+        train_loss, train_acc = trainer.train_epoch(train_loader)
+        val_loss, val_acc = trainer.validate(val_loader)
+        best_val_acc = max(best_val_acc, val_acc)
+        print(f"Epoch {epoch}: Train Acc: {train_acc:.4f}, Val Acc: {val_acc:.4f}")
+    _, test_acc = trainer.validate(test_loader)
+
+    seconds = sum(stats['seconds'] for stats in trainer.epoch_stats)
+    images = sum(stats['seconds'] * stats['images_per_sec'] for stats in trainer.epoch_stats)
+    return {
+        'schedule': f'fixed {image_size}' if schedule is None else ' -> '.join(map(str, schedule.sizes)),
+        'stage_epochs': '' if schedule is None else ' '.join(map(str, schedule.stage_epochs)),
+        'train_seconds': seconds,
+        'images_per_sec': images / seconds if seconds > 0 else 0.0,
+        'final_val_accuracy': val_acc,
+        'best_val_accuracy': best_val_acc,
+        'test_accuracy': test_acc,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Progressive resizing vs fixed-resolution training")
+    parser.add_argument('--arch', choices=sorted(ARCHS), default='AttentionResNet')
+    parser.add_argument('--image-dir', default='data/xray_images')
+    parser.add_argument('--label-file', default='data/labels.csv')
+    parser.add_argument('--epochs', type=int, default=40, help="Default reaches the last stage at epoch 30")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 176, 224])
+    parser.add_argument('--stage-epochs', type=int, nargs='+', default=None,
+                        help="First epoch of each later stage (default: the LR warm restarts)")
+    parser.add_argument('--batch-size', type=int, default=16, help="Batch size at full resolution")
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--report', default='progressive_resizing_report.csv')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    train_loader, val_loader, test_loader, _ = create_balanced_dataloader(
+        args.image_dir, args.label_file, args.batch_size, image_size=args.sizes[-1]
+    )
+    schedule = ProgressiveResizing(args.sizes, args.batch_size, stage_epochs=args.stage_epochs)
+    print(schedule)
+
+    rows = []
+    for name, run_schedule in (('baseline', None), ('progressive', schedule)):
+        print(f"\n{'='*50}\n{args.arch}: {name}\n{'='*50}")
+        rows.append(run(args.arch, run_schedule, train_loader, val_loader, test_loader, device,
+                        args.epochs, args.num_classes, args.sizes[-1]))
+        print(rows[-1])
+
+    report = pd.DataFrame(rows)
+    report['speedup'] = report['train_seconds'].iloc[0] / report['train_seconds']
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+    print(f"Report saved to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
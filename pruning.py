@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Structured channel pruning for AttentionResNet and EfficientNetClassifier
+
+Whole channels are removed from the backbone, so the pruned model is
+physically smaller and faster on CPU (no masks):
+- ResNet bottlenecks: the inner widths (conv1 and conv2 outputs); block
+  input/output widths are kept so residual connections stay valid
+- EfficientNet MBConv blocks: the expanded channels (expand conv,
+  depthwise conv, squeeze-excitation and projection input)
+
+Channels are scored by the |gamma| of the BatchNorm that follows the conv
+('bn') or by the L1 norm of the conv filters ('l1'), and kept counts are
+rounded to multiples of 8 for efficient CPU kernels. Each pruning level is
+fine-tuned with AdvancedTrainer and exported as {'state_dict', 'arch',
+'channel_config', 'num_classes'}; load_pruned_model() rebuilds it.
+
+Usage:
+    python pruning.py --arch AttentionResNet --weights attentionresnet_final.pth \\
+        --levels 0.25 0.5 0.75 --finetune-epochs 5
+"""
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from torchvision.models.efficientnet import MBConv
+from torchvision.models.resnet import Bottleneck
+
+from model_utils import AttentionResNet, EfficientNetClassifier, AdvancedTrainer
+
+
+ARCHS = {'AttentionResNet': AttentionResNet, 'EfficientNetClassifier': EfficientNetClassifier}
+
+
+def _conv_subset(conv, out_idx=None, in_idx=None):
+    """Copy of conv restricted to out_idx output / in_idx input channels (depthwise: both)"""
+    weight = conv.weight.data
+    bias = conv.bias.data if conv.bias is not None else None
+    depthwise = conv.groups > 1 and conv.groups == conv.in_channels == conv.out_channels
+    if depthwise:
+        idx = out_idx if out_idx is not None else in_idx
+        weight = weight[idx]
+        bias = bias[idx] if bias is not None else None
+        in_channels = out_channels = groups = len(idx)
+    else:
+        if out_idx is not None:
+            weight = weight[out_idx]
+            bias = bias[out_idx] if bias is not None else None
+        if in_idx is not None:
+            weight = weight[:, in_idx]
+        out_channels, in_channels, groups = weight.shape[0], weight.shape[1] * conv.groups, conv.groups
+    new = nn.Conv2d(in_channels, out_channels, conv.kernel_size, conv.stride, conv.padding,
+                    conv.dilation, groups, bias is not None, conv.padding_mode)
+    new.weight.data.copy_(weight)
+    if bias is not None:
+        new.bias.data.copy_(bias)
+    return new.train(conv.training)
+
+
+def _bn_subset(bn, idx):
+    new = nn.BatchNorm2d(len(idx), bn.eps, bn.momentum, bn.affine, bn.track_running_stats)
+    if bn.affine:
+        new.weight.data.copy_(bn.weight.data[idx])
+        new.bias.data.copy_(bn.bias.data[idx])
+    if bn.track_running_stats:
+        new.running_mean.copy_(bn.running_mean[idx])
+        new.running_var.copy_(bn.running_var[idx])
+        new.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return new.train(bn.training)
+
+
+def prunable_units(model):
+    """
+    Yield (name, num_channels, score_fn, apply_fn) for every prunable channel group
+
+    score_fn(method) returns one score per channel; apply_fn(keep_idx) replaces
+    the affected layers with physically smaller copies.
+    """
+    for name, module in model.named_modules():
+        if isinstance(module, Bottleneck):
+            for conv_name, bn_name, next_name in (('conv1', 'bn1', 'conv2'), ('conv2', 'bn2', 'conv3')):
+                def score(method, block=module, conv_name=conv_name, bn_name=bn_name):
+                    if method == 'bn':
+                        return getattr(block, bn_name).weight.detach().abs()
+                    return getattr(block, conv_name).weight.detach().abs().sum(dim=(1, 2, 3))
+
+                def apply(idx, block=module, conv_name=conv_name, bn_name=bn_name, next_name=next_name):
+                    setattr(block, conv_name, _conv_subset(getattr(block, conv_name), out_idx=idx))
+                    setattr(block, bn_name, _bn_subset(getattr(block, bn_name), idx))
+                    setattr(block, next_name, _conv_subset(getattr(block, next_name), in_idx=idx))
+
+                yield f'{name}.{conv_name}', getattr(module, conv_name).out_channels, score, apply
+
+        elif isinstance(module, MBConv) and len(module.block) == 4:
+            # expand -> depthwise -> squeeze-excitation -> project
+            expand, depthwise, se, project = module.block
+
+            def score(method, expand=expand):
+                if method == 'bn':
+                    return expand[1].weight.detach().abs()
+                return expand[0].weight.detach().abs().sum(dim=(1, 2, 3))
+
+            def apply(idx, expand=expand, depthwise=depthwise, se=se, project=project):
+                expand[0] = _conv_subset(expand[0], out_idx=idx)
+                expand[1] = _bn_subset(expand[1], idx)
+                depthwise[0] = _conv_subset(depthwise[0], out_idx=idx)
+                depthwise[1] = _bn_subset(depthwise[1], idx)
+                se.fc1 = _conv_subset(se.fc1, in_idx=idx)
+                se.fc2 = _conv_subset(se.fc2, out_idx=idx)
+                project[0] = _conv_subset(project[0], in_idx=idx)
+
+            yield f'{name}.expand', expand[0].out_channels, score, apply
+
+
+def _kept_channels(num_channels, ratio, multiple=8):
+    keep = int(round(num_channels * (1 - ratio) / multiple)) * multiple
+    return min(num_channels, max(multiple, keep))
+
+
+def prune_model(model, ratio, method='bn'):
+    """
+    Remove the lowest-scoring `ratio` of channels from every prunable unit, in place
+
+    Returns:
+        The pruned model (same object)
+    """
+    for name, num_channels, score, apply in list(prunable_units(model)):
+        keep = _kept_channels(num_channels, ratio)
+        if keep < num_channels:
+            apply(torch.argsort(score(method), descending=True)[:keep].sort().values)
+    return model
+
+
+def channel_config(model):
+    """Current width of every prunable unit"""
+    return {name: num_channels for name, num_channels, _, _ in prunable_units(model)}
+
+
+def apply_channel_config(model, config):
+    """Shrink a freshly built model to the widths in config (weights are loaded afterwards)"""
+    for name, num_channels, _, apply in list(prunable_units(model)):
+        if config.get(name, num_channels) < num_channels:
+            apply(torch.arange(config[name]))
+    return model
+
+
+def export_pruned(model, arch, path, num_classes=2):
+    torch.save({'state_dict': model.state_dict(), 'arch': arch, 'num_classes': num_classes,
+                'channel_config': channel_config(model)}, path)
+    print(f"Pruned model saved to {path}")
+
+
+def load_pruned_model(path, device='cpu'):
+    """Rebuild an exported pruned model at its pruned widths and load its weights"""
+    checkpoint = torch.load(path, map_location=device)
+    model = ARCHS[checkpoint['arch']](num_classes=checkpoint['num_classes'])
+    apply_channel_config(model, checkpoint['channel_config'])
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.to(device).eval()
+
+
+def count_flops(model, image_size=224):
+    """Multiply-accumulates x 2 of Conv2d and Linear layers for one image"""
+    flops = []
+
+    def conv_hook(module, inputs, output):
+        kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        flops.append(2 * output.numel() * kernel)
+
+    def linear_hook(module, inputs, output):
+        flops.append(2 * output.numel() * module.in_features)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+    was_training = model.training
+    model.eval()
+    with torch.inference_mode():
+        model(torch.zeros(1, 3, image_size, image_size, device=next(model.parameters()).device))
+    model.train(was_training)
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+
+def cpu_latency_ms(model, image_size=224, runs=20):
+    """Median single-image CPU latency"""
+    model = model.to('cpu').eval()
+    x = torch.randn(1, 3, image_size, image_size)
+    with torch.inference_mode():
+        for _ in range(3):
+            model(x)
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(x)
+            timings.append(time.perf_counter() - start)
+    return 1000 * float(np.median(timings))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Structured channel pruning")
+    parser.add_argument('--arch', choices=sorted(ARCHS), default='AttentionResNet')
+    parser.add_argument('--weights', required=True, help="Trained weights, e.g. attentionresnet_final.pth")
+    parser.add_argument('--image-dir', default='data/xray_images')
+    parser.add_argument('--label-file', default='data/labels.csv')
+    parser.add_argument('--levels', type=float, nargs='+', default=[0.25, 0.5, 0.75],
+                        help="Fraction of channels removed from each prunable unit")
+    parser.add_argument('--method', choices=['bn', 'l1'], default='bn')
+    parser.add_argument('--finetune-epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--report', default='pruning_report.csv')
+    return parser.parse_args()
+
+
+def main():
+    from enhanced_trainer import create_balanced_dataloader
+
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    train_loader, val_loader, test_loader, _ = create_balanced_dataloader(
+        args.image_dir, args.label_file, args.batch_size
+    )
+
+    rows = []
+    for level in [0.0] + list(args.levels):
+        model = ARCHS[args.arch](num_classes=args.num_classes)
+        model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+        if level > 0:
+            prune_model(model, level, args.method)
+        trainer = AdvancedTrainer(model, device)
+
+        if level > 0:
+            print(f"\nFine-tuning {args.arch} pruned at {level:.0%}...")
+            for epoch in range(args.finetune_epochs):
+                train_loss, train_acc = trainer.train_epoch(train_loader)
+                val_loss, val_acc = trainer.validate(val_loader)
+                print(f"Epoch {epoch}: Train Acc: {train_acc:.4f}, Val Acc: {val_acc:.4f}")
+            export_pruned(model, args.arch, f'{args.arch.lower()}_pruned_{int(level * 100)}.pth', args.num_classes)
+
+        _, test_acc = trainer.validate(test_loader)
+        rows.append({
+            'level': level,
+            'parameters': sum(p.numel() for p in model.parameters()),
+            'gflops': count_flops(model) / 1e9,
+            'cpu_latency_ms': cpu_latency_ms(model),
+            'test_accuracy': test_acc,
+        })
+        print(rows[-1])
+
+    report = pd.DataFrame(rows)
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+    print(f"Report saved to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
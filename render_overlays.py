@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Headless batch rendering of GradCAM overlays
+
+The model runs batched GradCAM (one forward / backward pass per batch) in
+the main process; a process pool composes each overlay and encodes it.
+No matplotlib figures are drawn: the heatmap is colored through a
+256-entry colormap lookup table and alpha-blended onto the original image
+in NumPy, then written as PNG or WebP. matplotlib is switched to the
+non-interactive Agg backend, so this runs on nodes without a display.
+
+An index CSV (image, output, predicted class, confidence) is written next
+to the overlays.
+
+Usage:
+    python render_overlays.py --arch AttentionResNet --weights attentionresnet_final.pth \\
+        --image-dir data/xray_images --out-dir overlays --format webp
+    python render_overlays.py ... --manifest data/labels.csv --layout triptych
+"""
+
+import matplotlib
+matplotlib.use('Agg')
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from model_utils import AttentionResNet, EfficientNetClassifier, ModelInterpreter, load_model_weights
+
+
+ARCHS = {'AttentionResNet': AttentionResNet, 'EfficientNetClassifier': EfficientNetClassifier}
+
+# Last convolutional stage of each architecture
+DEFAULT_TARGET_LAYERS = {'AttentionResNet': 'features.7', 'EfficientNetClassifier': 'features.0'}
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+_LUTS = {}
+
+
+def colormap_lut(name='jet'):
+    """(256, 3) uint8 lookup table of a matplotlib colormap"""
+    if name not in _LUTS:
+        colors = matplotlib.colormaps[name](np.linspace(0.0, 1.0, 256))[:, :3]
+        _LUTS[name] = np.round(colors * 255).astype(np.uint8)
+    return _LUTS[name]
+
+
+def compose_overlay(image, heatmap, colormap='jet', alpha=0.5, layout='overlay'):
+    """
+    Blend a heatmap onto an image
+
+    Args:
+        image: (H, W, 3) uint8 RGB image
+        heatmap: (h, w) uint8 heatmap; resized to (H, W) if needed
+        alpha: heatmap weight in the blend
+        layout: 'overlay', or 'triptych' for original | heatmap | overlay side by side
+
+    Returns:
+        uint8 RGB array
+    """
+    height, width = image.shape[:2]
+    if heatmap.shape != (height, width):
+        heatmap = np.asarray(Image.fromarray(heatmap).resize((width, height), Image.BILINEAR))
+    colored = colormap_lut(colormap)[heatmap]
+    weight = int(round(alpha * 256))
+    blended = ((colored.astype(np.uint16) * weight + image.astype(np.uint16) * (256 - weight)) >> 8).astype(np.uint8)
+    if layout == 'triptych':
+        return np.concatenate([image, colored, blended], axis=1)
+    return blended
+
+
+def _render_one(task):
+    idx, image_path, heatmap, out_path, options = task
+    try:
+        image = Image.open(image_path)
+        image.draft('RGB', (options['max_size'], options['max_size']))
+        image = image.convert('RGB')
+        image.thumbnail((options['max_size'], options['max_size']), Image.BILINEAR)
+        result = compose_overlay(np.asarray(image), heatmap, options['colormap'], options['alpha'],
+                                 options['layout'])
+        os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+        save_kwargs = {'quality': options['quality'], 'method': 4} if out_path.endswith('.webp') else {}
+        Image.fromarray(result).save(out_path, **save_kwargs)
+        return idx, out_path, None
+    except Exception as e:
+        return idx, out_path, str(e)
+
+
+class _RenderDataset(Dataset):
+    """Model-resolution tensors for the images to render; unreadable images are flagged"""
+
+    def __init__(self, image_paths, transform):
+        self.image_paths = image_paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        try:
+            image = Image.open(self.image_paths[idx]).convert('RGB')
+            return self.transform(image), idx, True
+        except Exception:
+            return torch.zeros(3, 224, 224), idx, False
+
+
+def find_images(image_dir, manifest=None):
+    """Image paths from a manifest (image_path column, relative to image_dir) or a directory walk"""
+    if manifest:
+        df = pd.read_csv(manifest)
+        return [os.path.join(image_dir, path) for path in df['image_path']]
+    paths = []
+    for root, _, files in os.walk(image_dir):
+        paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def render_overlays(model, target_layer, image_paths, image_dir, out_dir, device='cpu', batch_size=16,
+                    num_workers=None, loader_workers=2, image_format='png', class_idx=None, colormap='jet',
+                    alpha=0.5, layout='overlay', max_size=1024, quality=90):
+    """
+    Render a GradCAM overlay for every image in image_paths
+
+    Output files mirror the layout of image_paths below image_dir.
+
+    Returns:
+        DataFrame with one row per image (output is empty for unreadable images)
+    """
+    interpreter = ModelInterpreter(model.to(device), device)
+    engine = interpreter.gradcam_engine(target_layer)
+    loader = DataLoader(_RenderDataset(image_paths, interpreter.transform), batch_size=batch_size,
+                        shuffle=False, num_workers=loader_workers)
+    options = {'colormap': colormap, 'alpha': alpha, 'layout': layout, 'max_size': max_size,
+               'quality': quality}
+    rows = [None] * len(image_paths)
+
+    def tasks():
+        for data, indices, ok in loader:
+            cams, logits = engine.compute(data.to(device), class_idx)
+            probabilities = torch.softmax(logits.float(), dim=1).cpu()
+            heatmaps = (cams[:, 0] * 255).round().to(torch.uint8).cpu().numpy()
+            for heatmap, idx, valid, proba in zip(heatmaps, indices.tolist(), ok.tolist(), probabilities):
+                image_path = image_paths[idx]
+                if not valid:
+                    rows[idx] = {'image_path': image_path, 'output': '', 'predicted_class': None,
+                                 'confidence': None}
+                    continue
+                rows[idx] = {'image_path': image_path, 'output': '',
+                             'predicted_class': int(proba.argmax()), 'confidence': float(proba.max())}
+                stem = os.path.splitext(os.path.relpath(image_path, image_dir))[0]
+                out_path = os.path.join(out_dir, f'{stem}_gradcam.{image_format}')
+                yield idx, image_path, heatmap, out_path, options
+
+    start = time.perf_counter()
+    rendered = failed = 0
+    with Pool(num_workers or os.cpu_count() or 1) as pool:
+        for idx, out_path, error in pool.imap_unordered(_render_one, tasks(), chunksize=8):
+            if error:
+                failed += 1
+                print(f"Failed to render {out_path}: {error}")
+                continue
+            rows[idx]['output'] = out_path
+            rendered += 1
+            if rendered % 500 == 0:
+                print(f"Rendered {rendered}/{len(image_paths)} overlays "
+                      f"({rendered / (time.perf_counter() - start):.1f} images/sec)")
+    interpreter.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {rendered} overlays in {elapsed:.1f}s ({rendered / max(elapsed, 1e-9):.1f} images/sec), "
+          f"{failed} failed, {sum(row is not None and not row['output'] for row in rows) - failed} unreadable")
+    return pd.DataFrame([row for row in rows if row is not None])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Headless batch rendering of GradCAM overlays")
+    parser.add_argument('--arch', choices=sorted(ARCHS), default='AttentionResNet')
+    parser.add_argument('--weights', required=True)
+    parser.add_argument('--target-layer', default=None, help="Dotted module name (default: last conv stage)")
+    parser.add_argument('--image-dir', required=True)
+    parser.add_argument('--manifest', default=None, help="CSV with an image_path column; default: walk --image-dir")
+    parser.add_argument('--out-dir', default='overlays')
+    parser.add_argument('--format', choices=['png', 'webp'], default='png')
+    parser.add_argument('--quality', type=int, default=90, help="WebP quality")
+    parser.add_argument('--layout', choices=['overlay', 'triptych'], default='overlay')
+    parser.add_argument('--colormap', default='jet')
+    parser.add_argument('--alpha', type=float, default=0.5)
+    parser.add_argument('--max-size', type=int, default=1024, help="Longest side of rendered images")
+    parser.add_argument('--class-idx', type=int, default=None, help="Target class (default: predicted)")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=None, help="Rendering processes")
+    parser.add_argument('--num-classes', type=int, default=2)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    model = load_model_weights(ARCHS[args.arch](num_classes=args.num_classes), args.weights, device)
+    if model is None:
+        raise SystemExit(f"Could not load {args.weights}")
+    target_layer = model.get_submodule(args.target_layer or DEFAULT_TARGET_LAYERS[args.arch])
+
+    image_paths = find_images(args.image_dir, args.manifest)
+    print(f"Rendering {len(image_paths)} images to {args.out_dir}")
+    os.makedirs(args.out_dir, exist_ok=True)
+    index = render_overlays(model, target_layer, image_paths, args.image_dir, args.out_dir, device,
+                           args.batch_size, args.workers, image_format=args.format, class_idx=args.class_idx,
+                           colormap=args.colormap, alpha=args.alpha, layout=args.layout,
+                           max_size=args.max_size, quality=args.quality)
+
+    index_path = os.path.join(args.out_dir, 'overlays_index.csv')
+    index.to_csv(index_path, index=False)
+    print(f"Index saved to {index_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Sharded sequential-read dataset format for large X-ray corpora
+
+Labeled images are packed into fixed-size tar shards so training reads a
+few large files front to back instead of opening one small file per
+sample. ShardedXRayDataset streams the shards with per-epoch shard and
+in-shard shuffling and splits shards across DataLoader workers.
+
+Usage:
+    python shard_dataset.py --image-dir data/xray_images --label-file data/labels.csv \\
+        --out-dir data/shards --split
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import tarfile
+import albumentations as A
+import numpy as np
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+INDEX_FILE = 'index.json'
+
+
+def pack_shards(image_paths, labels, out_dir, shard_size_mb=256, shuffle=True, seed=42):
+    """
+    Pack labeled image files into tar shards of roughly shard_size_mb each
+
+    Each sample is stored as two members, `<key><ext>` (the original encoded
+    file) and `<key>.cls` (the integer label). Samples are shuffled before
+    packing so every shard holds a mix of classes.
+
+    Returns:
+        dict: The shard index that was written to out_dir/index.json
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    order = list(range(len(image_paths)))
+    if shuffle:
+        random.Random(seed).shuffle(order)
+
+    shard_limit = shard_size_mb * 1024 * 1024
+    shards = []
+    tar = None
+    current = None
+
+    def close_shard():
+        if tar is not None:
+            tar.close()
+            shards.append(current)
+
+    for key, i in enumerate(order):
+        if tar is None or current['num_bytes'] >= shard_limit:
+            close_shard()
+            name = f'shard-{len(shards):05d}.tar'
+            tar = tarfile.open(os.path.join(out_dir, name), 'w')
+            current = {'name': name, 'num_samples': 0, 'num_bytes': 0, 'class_counts': {}}
+
+        with open(image_paths[i], 'rb') as f:
+            data = f.read()
+        label = int(labels[i])
+        ext = os.path.splitext(image_paths[i])[1].lower() or '.img'
+        for member_name, payload in ((f'{key:09d}{ext}', data), (f'{key:09d}.cls', str(label).encode())):
+            info = tarfile.TarInfo(member_name)
+            info.size = len(payload)
+            tar.addfile(info, io.BytesIO(payload))
+
+        current['num_samples'] += 1
+        current['num_bytes'] += len(data)
+        current['class_counts'][str(label)] = current['class_counts'].get(str(label), 0) + 1
+    close_shard()
+
+    class_counts = {}
+    for shard in shards:
+        for label, count in shard['class_counts'].items():
+            class_counts[label] = class_counts.get(label, 0) + count
+    index = {
+        'num_samples': sum(shard['num_samples'] for shard in shards),
+        'class_counts': class_counts,
+        'shards': shards,
+    }
+    with open(os.path.join(out_dir, INDEX_FILE), 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+
+    print(f"Packed {index['num_samples']} images into {len(shards)} shards in {out_dir}")
+    return index
+
+
+def read_shard(shard_path):
+    """Yield (encoded_bytes, label) pairs from one shard, reading it sequentially"""
+    pending = {}
+    with tarfile.open(shard_path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, ext = os.path.splitext(member.name)
+            payload = tar.extractfile(member).read()
+            sample = pending.setdefault(key, {})
+            if ext == '.cls':
+                sample['label'] = int(payload.decode())
+            else:
+                sample['data'] = payload
+            if 'label' in sample and 'data' in sample:
+                del pending[key]
+                yield sample['data'], sample['label']
+
+
+class ShardedXRayDataset(IterableDataset):
+    """
+    Streams samples from tar shards written by pack_shards
+
+    Each epoch the shard order is shuffled, shards are split across
+    DataLoader workers, and samples are shuffled within each shard (one
+    shard is held in memory at a time per worker). Call set_epoch() before
+    each epoch to get a new order; AdvancedTrainer does this automatically.
+    Do not combine with persistent_workers, which would keep a stale epoch.
+    """
+
+    def __init__(self, shard_dirs, transform=None, shuffle=True, seed=42, shards=None):
+        """
+        Args:
+            shard_dirs: Directory written by pack_shards, or a list of them
+            transform: Albumentations or torchvision transform
+            shuffle: Shuffle shard order and samples within each shard
+            seed: Base seed; the order depends only on seed and epoch
+            shards: Optional subset of shard paths to read (e.g. one CV fold)
+        """
+        self.shard_dirs = [shard_dirs] if isinstance(shard_dirs, str) else list(shard_dirs)
+        self.transform = transform
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        shard_info = {}
+        for shard_dir in self.shard_dirs:
+            with open(os.path.join(shard_dir, INDEX_FILE), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            for shard in index['shards']:
+                shard_info[os.path.join(shard_dir, shard['name'])] = shard
+        self.shards = list(shards) if shards is not None else list(shard_info)
+        self.num_samples = sum(shard_info[path]['num_samples'] for path in self.shards)
+        self.class_counts = {}
+        for path in self.shards:
+            for label, count in shard_info[path]['class_counts'].items():
+                self.class_counts[int(label)] = self.class_counts.get(int(label), 0) + count
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _apply_transform(self, image):
+        if self.transform is None:
+            return image
+        if isinstance(self.transform, A.BaseCompose):
+            # Albumentations transform
+            return self.transform(image=np.asarray(image))['image']
+        # Torchvision transform
+        return self.transform(image)
+
+    def __iter__(self):
+        shards = list(self.shards)
+        rng = random.Random(self.seed + self.epoch)
+        if self.shuffle:
+            rng.shuffle(shards)
+
+        worker = get_worker_info()
+        if worker is not None:
+            shards = shards[worker.id::worker.num_workers]
+            rng = random.Random((self.seed + self.epoch) * 1000 + worker.id)
+
+        for path in shards:
+            samples = list(read_shard(path))
+            if self.shuffle:
+                rng.shuffle(samples)
+            for data, label in samples:
+                image = Image.open(io.BytesIO(data)).convert('RGB')
+                yield self._apply_transform(image), label
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pack labeled X-ray images into tar shards")
+    parser.add_argument('--image-dir', required=True)
+    parser.add_argument('--label-file', required=True, help="CSV with image_path,label columns")
+    parser.add_argument('--out-dir', required=True)
+    parser.add_argument('--shard-size-mb', type=int, default=256)
+    parser.add_argument('--split', action='store_true',
+                        help="Write train/val/test sub-directories using the enhanced_trainer.py split")
+    return parser.parse_args()
+
+
+def main():
+    import pandas as pd
+    from dedup import train_val_test_indices
+
+    args = parse_args()
+    df = pd.read_csv(args.label_file)
+    image_paths = [os.path.join(args.image_dir, path) for path in df['image_path']]
+    labels = df['label'].values
+
+    if not args.split:
+        pack_shards(image_paths, labels, args.out_dir, args.shard_size_mb)
+        return
+
+    # Same 70/15/15 split as create_balanced_dataloader
+    groups = df['group_id'].values if 'group_id' in df.columns else None
+    splits = train_val_test_indices(labels, groups)
+    for split, indices in zip(('train', 'val', 'test'), splits):
+        pack_shards([image_paths[i] for i in indices], labels[indices],
+                    os.path.join(args.out_dir, split), args.shard_size_mb)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,30 @@
 # train_model.py
 import torch
 import torchvision.transforms as transforms
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Subset
 from PIL import Image
 import os
 import numpy as np
 import xgboost as xgb
 import joblib
 from feature_extractor import CNNFeatureExtractor
-from sklearn.model_selection import train_test_split
+from loader_autotune import autotune_loader
+from feature_cache import FeatureCache, state_dict_hash
+from image_cache import build_image_cache
+from shard_dataset import ShardedXRayDataset
+from xgb_external import train_xgboost_external, predict_proba_external, booster_to_classifier
+from dedup import split_indices
+from feature_reduction import REDUCER_FILE, fit_reducer, apply_reducer, save_reducer, transform_npy_in_chunks
 from sklearn.metrics import classification_report, accuracy_score
 
 
 class XRayDataset(Dataset):
-    def __init__(self, image_paths, labels, transform=None):
+    def __init__(self, image_paths, labels, transform=None, image_cache=None, groups=None):
         self.image_paths = image_paths
         self.labels = labels
         self.transform = transform
+        self.image_cache = image_cache
+        self.groups = groups  # near-duplicate group ids from dedup.py, if any
 
     def __len__(self):
         return len(self.image_paths)
@@ -25,47 +33,120 @@ class XRayDataset(Dataset):
         image_path = self.image_paths[idx]
         label = self.labels[idx]
         
-        # Load and preprocess image
-        image = Image.open(image_path).convert('RGB')
+        # Load and preprocess image (from the pre-decoded cache when available)
+        cached = self.image_cache.get(image_path) if self.image_cache is not None else None
+        if cached is not None:
+            image = Image.fromarray(cached).convert('RGB')
+        else:
+            image = Image.open(image_path).convert('RGB')
         if self.transform:
             image = self.transform(image)
         
         return image, label
 
 
-def create_dataloader(image_dir, label_file, batch_size=32):
-    """
-    Create dataloader from image directory and label file
-    
-    Args:
-        image_dir: Directory containing X-ray images
-        label_file: CSV file with image paths and labels
-        batch_size: Batch size for dataloader
-    """
-    # Define transforms
-    transform = transforms.Compose([
+def get_transform():
+    """Preprocessing applied before the ResNet50 backbone"""
+    return transforms.Compose([
         transforms.Resize((224, 224)),
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.485, 0.456, 0.406],
                            std=[0.229, 0.224, 0.225])
     ])
+
+
+def create_dataset(image_dir, label_file, image_cache_path=None):
+    """
+    Create dataset from image directory and label file
+    
+    Args:
+        image_dir: Directory containing X-ray images
+        label_file: CSV file with image paths and labels, optionally with the
+            group_id column written by dedup.py
+        image_cache_path: Optional path (without extension) of a pre-decoded
+            image cache; it is built or refreshed if needed
+    """
+    transform = get_transform()
     
     # Load labels (assuming CSV format: image_path,label)
     import pandas as pd
     df = pd.read_csv(label_file)
     image_paths = [os.path.join(image_dir, path) for path in df['image_path']]
     labels = df['label'].values
+    groups = df['group_id'].values if 'group_id' in df.columns else None
     
-    # Create dataset and dataloader
-    dataset = XRayDataset(image_paths, labels, transform)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    image_cache = None
+    if image_cache_path:
+        image_cache = build_image_cache(image_paths, image_cache_path, image_size=256)
+    
+    return XRayDataset(image_paths, labels, transform, image_cache=image_cache, groups=groups)
+
+
+def create_dataloader(image_dir, label_file, batch_size=32, num_workers=0, prefetch_factor=2,
+                      image_cache_path=None):
+    """
+    Create dataloader from image directory and label file
+    
+    Args:
+        image_dir: Directory containing X-ray images
+        label_file: CSV file with image paths and labels
+        batch_size: Batch size for dataloader
+        num_workers: Number of worker processes used to decode images
+        prefetch_factor: Batches prefetched per worker (ignored when num_workers=0)
+        image_cache_path: Optional path of a pre-decoded image cache
+    """
+    dataset = create_dataset(image_dir, label_file, image_cache_path)
+    
+    loader_kwargs = {'num_workers': num_workers, 'pin_memory': torch.cuda.is_available()}
+    if num_workers > 0:
+        loader_kwargs['prefetch_factor'] = prefetch_factor
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
     
     return dataloader
 
 
-def train_xgboost_model(X_train, y_train, X_val, y_val):
+def extract_features_cached(feature_extractor, dataset, cache_dir, batch_size=32, out=None):
+    """
+    Extract features, reusing cached entries for images that have not changed
+    
+    The cache is keyed by image content hash and by the backbone weights and
+    preprocessing, so only new or modified images go through the backbone.
+    
+    Args:
+        feature_extractor: CNNFeatureExtractor instance
+        dataset: XRayDataset over the full image list
+        cache_dir: Directory holding the feature cache
+        batch_size: Batch size used for the images that need extracting
+        out: Optional preallocated (N, D) array (e.g. a np.memmap) to assemble into
+    """
+    preprocess = f"{dataset.transform!r}|bf16={feature_extractor.use_bf16}"
+    if dataset.image_cache is not None:
+        preprocess += f"|image_cache={dataset.image_cache.image_size}{dataset.image_cache.mode}"
+    cache = FeatureCache(cache_dir, state_dict_hash(feature_extractor.model), preprocess)
+    
+    keys = cache.content_keys(dataset.image_paths)
+    missing = cache.missing(keys)
+    missing_keys = {keys[i] for i in missing}
+    reused = sum(1 for key in keys if key not in missing_keys)
+    
+    if missing:
+        X_new, _ = feature_extractor.extract_features(Subset(dataset, missing), batch_size=batch_size)
+        cache.add([keys[i] for i in missing], X_new)
+    cache.save()
+    print(f"Feature cache: {reused} reused, {len(missing)} recomputed")
+    
+    X = cache.assemble(keys, out=out)
+    y = np.asarray(dataset.labels)
+    return X, y
+
+
+def train_xgboost_model(X_train, y_train, X_val, y_val, params_override=None):
     """
     Train XGBoost model on extracted features
+    
+    Args:
+        params_override: Optional overrides for the default parameters, e.g. the
+            xgb_best_params.json written by xgb_search.py
     """
     # Define XGBoost parameters
     params = {
@@ -78,6 +159,7 @@ def train_xgboost_model(X_train, y_train, X_val, y_val):
         'colsample_bytree': 0.8,
         'random_state': 42
     }
+    params.update(params_override or {})
     
     # Create and train model
     model = xgb.XGBClassifier(**params)
@@ -99,48 +181,160 @@ def main():
     IMAGE_DIR = "data/xray_images"  # Update with your image directory
     LABEL_FILE = "data/labels.csv"   # Update with your label file
     BATCH_SIZE = 32
+    NUM_WORKERS = min(8, os.cpu_count() or 1)
+    PREFETCH_FACTOR = 4
+    AUTOTUNE_LOADER = True  # benchmark workers / prefetch / batch size instead of the three above; cached per host
+    AUTOTUNE_BATCH_SIZES = (32, 64)
+    FEATURE_CACHE_DIR = "feature_cache"
+    SHARD_DIR = None  # e.g. "data/shards" packed with shard_dataset.py; replaces IMAGE_DIR/LABEL_FILE
+    XGB_PARAMS_FILE = "xgb_best_params.json"  # Written by xgb_search.py; defaults are used if missing
+    OUT_OF_CORE = False  # Stream features from disk into XGBoost instead of holding them in memory
+    CHUNK_ROWS = 8192
+    REDUCE_DIM = None  # e.g. 256 to fit a reducer before XGBoost; see feature_reduction.py for the trade-off
+    REDUCTION_METHOD = 'randomized_pca'  # 'pca', 'randomized_pca' or 'random_projection'
+    PRECOMPUTED_FEATURES = False  # use extracted_features.npy / feature_labels.npy from distributed_extract.py
     DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     
     print(f"Using device: {DEVICE}")
     
     # Check if data exists
-    if not os.path.exists(IMAGE_DIR):
+    if PRECOMPUTED_FEATURES and (SHARD_DIR or not os.path.exists('extracted_features.npy')):
+        print("PRECOMPUTED_FEATURES needs extracted_features.npy from distributed_extract.py and no SHARD_DIR")
+        return
+    
+    if SHARD_DIR and not os.path.isdir(SHARD_DIR):
+        print(f"Shard directory not found: {SHARD_DIR}")
+        return
+    
+    if not SHARD_DIR and not os.path.exists(IMAGE_DIR):
         print(f"Image directory not found: {IMAGE_DIR}")
         print("Please update IMAGE_DIR in the script or create the directory")
         return
     
-    if not os.path.exists(LABEL_FILE):
+    if not SHARD_DIR and not os.path.exists(LABEL_FILE):
         print(f"Label file not found: {LABEL_FILE}")
         print("Please update LABEL_FILE in the script or create the file")
         return
     
+    xgb_params = None
+    if os.path.exists(XGB_PARAMS_FILE):
+        import json
+        with open(XGB_PARAMS_FILE, 'r', encoding='utf-8') as f:
+            xgb_params = json.load(f)
+        print(f"Using XGBoost parameters from {XGB_PARAMS_FILE}: {xgb_params}")
+    
     try:
-        # Create dataloader
-        print("Creating dataloader...")
-        dataloader = create_dataloader(IMAGE_DIR, LABEL_FILE, BATCH_SIZE)
+        if PRECOMPUTED_FEATURES:
+            # Merged by distributed_extract.py in label-file order; the dataset only supplies labels and groups
+            dataset = create_dataset(IMAGE_DIR, LABEL_FILE)
+            print("Loading precomputed features from extracted_features.npy...")
+            X = np.load('extracted_features.npy', mmap_mode='r' if OUT_OF_CORE else None)
+            y = np.load('feature_labels.npy')
+            if len(X) != len(dataset) or not np.array_equal(y, np.asarray(dataset.labels)):
+                raise RuntimeError("Precomputed features do not match LABEL_FILE; re-run distributed_extract.py")
+        else:
+            # Initialize feature extractor
+            print("Initializing feature extractor...")
+            feature_extractor = CNNFeatureExtractor(backbone='resnet50', device=DEVICE,
+                                                    num_workers=NUM_WORKERS, prefetch_factor=PREFETCH_FACTOR)
+        
+            if SHARD_DIR:
+                # Shards are streamed sequentially; there are no per-file paths to cache on
+                dataset = ShardedXRayDataset(SHARD_DIR, get_transform(), shuffle=False)
+            else:
+                dataset = create_dataset(IMAGE_DIR, LABEL_FILE)
         
-        # Initialize feature extractor
-        print("Initializing feature extractor...")
-        feature_extractor = CNNFeatureExtractor(backbone='resnet50', device=DEVICE)
+            if AUTOTUNE_LOADER:
+                # Extraction is a single pass: persistent workers cannot help
+                settings = autotune_loader(
+                    feature_extractor.make_dataloader(dataset, BATCH_SIZE),
+                    lambda imgs, labels: feature_extractor.forward_batch(imgs),
+                    key='resnet50_features', device=DEVICE, persistent_options=(False,),
+                    batch_sizes=AUTOTUNE_BATCH_SIZES
+                )
+                BATCH_SIZE = settings['batch_size']
+                feature_extractor.num_workers = settings['num_workers']
+                feature_extractor.prefetch_factor = settings['prefetch_factor']
         
-        # Extract features
-        print("Extracting features...")
-        X, y = feature_extractor.extract_features(dataloader)
+            # Out-of-core mode writes features straight to disk
+            features_out = None
+            if OUT_OF_CORE:
+                features_out = np.lib.format.open_memmap(
+                    'extracted_features.npy', mode='w+', dtype=np.float32,
+                    shape=(len(dataset), feature_extractor.out_dim)
+                )
+        
+            print("Extracting features...")
+            if SHARD_DIR:
+                X, y = feature_extractor.extract_features(dataset, batch_size=BATCH_SIZE, out=features_out)
+            else:
+                # Only new or changed images go through the backbone
+                X, y = extract_features_cached(feature_extractor, dataset, FEATURE_CACHE_DIR, BATCH_SIZE,
+                                               out=features_out)
         print(f"Extracted features shape: {X.shape}")
         print(f"Labels shape: {y.shape}")
         
-        # Split data
-        X_train, X_val, y_train, y_val = train_test_split(
-            X, y, test_size=0.2, random_state=42, stratify=y
-        )
+        # Near-duplicate groups (dedup.py) never straddle the train/validation split
+        groups = getattr(dataset, 'groups', None)
+        if groups is not None:
+            np.save('feature_groups.npy', groups)
+        elif os.path.exists('feature_groups.npy'):
+            os.remove('feature_groups.npy')
+        train_idx, val_idx = split_indices(y, groups, test_size=0.2, random_state=42)
+        
+        if not REDUCE_DIM and os.path.exists(REDUCER_FILE):
+            # A stale reducer would otherwise be applied at serving time
+            os.remove(REDUCER_FILE)
         
-        # Train XGBoost model
-        print("Training XGBoost model...")
-        model = train_xgboost_model(X_train, y_train, X_val, y_val)
+        if OUT_OF_CORE:
+            if not PRECOMPUTED_FEATURES:
+                X.flush()
+                np.save('feature_labels.npy', y)
+            
+            # XGBoost streams the split's rows from disk in chunks
+            features_path = 'extracted_features.npy'
+            if REDUCE_DIM:
+                # Fit on a bounded training subsample, then project all rows chunk by chunk
+                print(f"Reducing features to {REDUCE_DIM} dims ({REDUCTION_METHOD})...")
+                fit_idx = np.sort(np.random.RandomState(42).permutation(train_idx)[:50000])
+                reducer = fit_reducer(X[fit_idx], REDUCE_DIM, REDUCTION_METHOD)
+                save_reducer(reducer)
+                features_path = 'reduced_features.npy'
+                transform_npy_in_chunks(reducer, 'extracted_features.npy', features_path, CHUNK_ROWS)
+            
+            print("Training XGBoost model (external memory)...")
+            external_params = dict(xgb_params or {})
+            num_boost_round = external_params.pop('n_estimators', 100)
+            booster = train_xgboost_external(features_path, 'feature_labels.npy',
+                                             train_idx, val_idx, params=external_params,
+                                             num_boost_round=num_boost_round, chunk_rows=CHUNK_ROWS,
+                                             cache_dir='xgb_external_cache')
+            model = booster_to_classifier(booster, num_classes=len(np.unique(y)))
+            
+            print("Evaluating model...")
+            proba = predict_proba_external(booster, features_path, val_idx, chunk_rows=CHUNK_ROWS)
+            y_val = y[np.sort(val_idx)]
+            y_pred = proba.argmax(axis=1)
+        else:
+            # Split data
+            X_train, X_val = X[train_idx], X[val_idx]
+            y_train, y_val = y[train_idx], y[val_idx]
+            
+            if REDUCE_DIM:
+                print(f"Reducing features to {REDUCE_DIM} dims ({REDUCTION_METHOD})...")
+                reducer = fit_reducer(X_train, REDUCE_DIM, REDUCTION_METHOD)
+                save_reducer(reducer)
+                X_train = apply_reducer(reducer, X_train)
+                X_val = apply_reducer(reducer, X_val)
+            
+            # Train XGBoost model
+            print("Training XGBoost model...")
+            model = train_xgboost_model(X_train, y_train, X_val, y_val, params_override=xgb_params)
+            
+            # Evaluate model
+            print("Evaluating model...")
+            y_pred = model.predict(X_val)
         
-        # Evaluate model
-        print("Evaluating model...")
-        y_pred = model.predict(X_val)
         accuracy = accuracy_score(y_val, y_pred)
         print(f"Validation Accuracy: {accuracy:.4f}")
         print("\nClassification Report:")
@@ -152,8 +346,9 @@ def main():
         print("Model saved as 'xgb_cnn_features.joblib'")
         
         # Save features for later use
-        np.save('extracted_features.npy', X)
-        np.save('feature_labels.npy', y)
+        if not OUT_OF_CORE and not PRECOMPUTED_FEATURES:
+            np.save('extracted_features.npy', X)
+            np.save('feature_labels.npy', y)
         print("Features saved as 'extracted_features.npy'")
         print("Labels saved as 'feature_labels.npy'")
         
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Tokens kept vs latency / accuracy for MedicalViT token reduction
+
+Each schedule keeps the given fraction of tokens before every layer listed
+in --layers (EViT-style: the dropped, low-attention background patches are
+fused into one token). Schedules are applied at inference time to the same
+trained weights, so no retraining is needed to compare them; fine-tune with
+the chosen keep_schedule for the best accuracy at a given budget.
+
+Usage:
+    python vit_token_benchmark.py --weights medicalvit_final.pth --keep-ratios 1.0 0.9 0.7 0.5
+"""
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+from model_utils import MedicalViT
+
+
+def latency_ms(model, batch_size=1, image_size=224, runs=20):
+    """Median CPU latency of one batch"""
+    model = model.to('cpu').eval()
+    x = torch.randn(batch_size, 3, image_size, image_size)
+    with torch.inference_mode():
+        for _ in range(3):
+            model(x)
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(x)
+            timings.append(time.perf_counter() - start)
+    return 1000 * float(np.median(timings))
+
+
+def accuracy(model, loader, device):
+    model = model.to(device).eval()
+    correct = total = 0
+    with torch.inference_mode():
+        for data, target in loader:
+            pred = model(data.to(device)).argmax(dim=1).cpu()
+            correct += (pred == target).sum().item()
+            total += target.size(0)
+    return correct / max(total, 1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MedicalViT token reduction benchmark")
+    parser.add_argument('--weights', default=None, help="Trained MedicalViT weights; omit for latency only")
+    parser.add_argument('--image-dir', default='data/xray_images')
+    parser.add_argument('--label-file', default='data/labels.csv')
+    parser.add_argument('--keep-ratios', type=float, nargs='+', default=[1.0, 0.9, 0.7, 0.5])
+    parser.add_argument('--layers', type=int, nargs='+', default=[3, 6, 9],
+                        help="Layers before which tokens are reduced")
+    parser.add_argument('--no-fuse', action='store_true', help="Drop tokens instead of fusing them")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--num-classes', type=int, default=2)
+    parser.add_argument('--report', default='vit_token_report.csv')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    model = MedicalViT(num_classes=args.num_classes, fuse_tokens=not args.no_fuse)
+    test_loader = None
+    if args.weights:
+        from enhanced_trainer import create_balanced_dataloader
+
+        model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+        _, _, test_loader, _ = create_balanced_dataloader(args.image_dir, args.label_file, args.batch_size)
+
+    full_tokens = model.pos_embed.shape[1] * len(model.transformer.layers)
+    rows = []
+    for keep_ratio in args.keep_ratios:
+        model.keep_schedule = {layer: keep_ratio for layer in args.layers} if keep_ratio < 1 else {}
+        tokens = model.tokens_per_layer()
+        row = {
+            'keep_ratio': keep_ratio,
+            'final_tokens': tokens[-1],
+            'token_layers': sum(tokens) / full_tokens,
+            'latency_ms_bs1': latency_ms(model, 1, runs=args.runs),
+            f'latency_ms_bs{args.batch_size}': latency_ms(model, args.batch_size, runs=max(3, args.runs // 4)),
+        }
+        if test_loader is not None:
+            row['test_accuracy'] = accuracy(model, test_loader, device)
+        rows.append(row)
+        print(row)
+
+    report = pd.DataFrame(rows)
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+    print(f"Report saved to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# xgb_external.py
+import json
+import os
+import tempfile
+import numpy as np
+import xgboost as xgb
+
+
+DEFAULT_PARAMS = {
+    'tree_method': 'hist',
+    'max_depth': 6,
+    'eta': 0.1,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'seed': 42,
+}
+
+
+class NpyChunkIter(xgb.DataIter):
+    """
+    Feeds XGBoost fixed-size row chunks from memory-mapped .npy files
+
+    Only one chunk of features is materialised at a time. Row indices are
+    sorted so every chunk is read front to back from the feature file.
+    """
+
+    def __init__(self, features_path, labels_path, indices=None, chunk_rows=8192, cache_prefix=None):
+        self.X = np.load(features_path, mmap_mode='r')
+        self.y = np.load(labels_path, mmap_mode='r')
+        if indices is None:
+            starts = range(0, self.X.shape[0], chunk_rows)
+            self._chunks = [slice(start, start + chunk_rows) for start in starts]
+        else:
+            indices = np.sort(np.asarray(indices))
+            self._chunks = [indices[start:start + chunk_rows] for start in range(0, len(indices), chunk_rows)]
+        self._it = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._it == len(self._chunks):
+            return 0
+        rows = self._chunks[self._it]
+        input_data(data=np.ascontiguousarray(self.X[rows], dtype=np.float32),
+                   label=np.asarray(self.y[rows]))
+        self._it += 1
+        return 1
+
+    def reset(self):
+        self._it = 0
+
+
+def external_dmatrix(features_path, labels_path, indices=None, chunk_rows=8192, cache_dir=None, name='train'):
+    """Build an external-memory DMatrix whose pages are cached under cache_dir"""
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix='xgb_cache_')
+    os.makedirs(cache_dir, exist_ok=True)
+    data_iter = NpyChunkIter(features_path, labels_path, indices, chunk_rows,
+                             cache_prefix=os.path.join(cache_dir, name))
+    return xgb.DMatrix(data_iter)
+
+
+def train_xgboost_external(features_path, labels_path, train_idx=None, val_idx=None, params=None,
+                           num_boost_round=100, early_stopping_rounds=10, chunk_rows=8192, cache_dir=None):
+    """
+    Train XGBoost on features that do not fit in memory
+
+    Training and validation data are both streamed from disk through
+    external-memory DMatrix objects with the `hist` tree method, so peak
+    memory is bounded by chunk_rows rather than by the dataset size.
+
+    Args:
+        features_path: .npy file of shape (N, D)
+        labels_path: .npy file of shape (N,)
+        train_idx, val_idx: Row indices of the training / validation split
+        params: XGBoost parameters overriding DEFAULT_PARAMS
+        num_boost_round: Maximum boosting rounds
+        early_stopping_rounds: Stop when validation loss stalls (needs val_idx)
+        chunk_rows: Rows per chunk fed to XGBoost
+        cache_dir: Directory for the external-memory page cache
+
+    Returns:
+        xgb.Booster
+    """
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix='xgb_cache_')
+    num_classes = len(np.unique(np.load(labels_path, mmap_mode='r')))
+
+    train_params = dict(DEFAULT_PARAMS)
+    if num_classes > 2:
+        train_params.update({'objective': 'multi:softprob', 'num_class': num_classes, 'eval_metric': 'mlogloss'})
+    else:
+        train_params.update({'objective': 'binary:logistic', 'eval_metric': 'logloss'})
+    train_params.update(params or {})
+
+    dtrain = external_dmatrix(features_path, labels_path, train_idx, chunk_rows, cache_dir, 'train')
+    evals = [(dtrain, 'train')]
+    if val_idx is not None:
+        dval = external_dmatrix(features_path, labels_path, val_idx, chunk_rows, cache_dir, 'validation')
+        evals.append((dval, 'validation'))
+    else:
+        early_stopping_rounds = None
+
+    return xgb.train(train_params, dtrain, num_boost_round=num_boost_round, evals=evals,
+                     early_stopping_rounds=early_stopping_rounds, verbose_eval=10)
+
+
+def predict_proba_external(booster, features_path, indices=None, chunk_rows=8192):
+    """Predict class probabilities chunk by chunk; returns an (n, num_classes) array"""
+    X = np.load(features_path, mmap_mode='r')
+    rows = np.sort(np.asarray(indices)) if indices is not None else np.arange(X.shape[0])
+    iteration_range = (0, booster.best_iteration + 1) if booster.attr('best_iteration') is not None else (0, 0)
+
+    probas = []
+    for start in range(0, len(rows), chunk_rows):
+        chunk = xgb.DMatrix(np.ascontiguousarray(X[rows[start:start + chunk_rows]], dtype=np.float32))
+        proba = booster.predict(chunk, iteration_range=iteration_range)
+        if proba.ndim == 1:
+            proba = np.stack([1 - proba, proba], axis=1)
+        probas.append(proba)
+    return np.concatenate(probas) if probas else np.empty((0, 2), dtype=np.float32)
+
+
+def booster_to_classifier(booster, num_classes):
+    """Wrap a Booster in an XGBClassifier so it can be saved with joblib and served via predict_proba"""
+    # load_model() restores the scikit-learn attributes from this booster attribute
+    booster = booster.copy()
+    booster.set_attr(scikit_learn=json.dumps({'n_classes_': num_classes}))
+    clf = xgb.XGBClassifier()
+    clf.load_model(booster.save_raw('json'))
+    if not isinstance(getattr(type(clf), 'classes_', None), property):
+        clf.classes_ = np.arange(clf.n_classes_)  # xgboost < 2; read-only property derived from n_classes_ later
+    return clf
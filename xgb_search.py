@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Parallel hyperparameter search for the XGBoost head
+
+Random configurations are evaluated in a process pool with a fixed thread
+budget per trial and pruned with successive halving on boosting rounds:
+every surviving trial is trained up to the next rung, the best 1/eta are
+kept and continue from where they stopped. The training and validation
+DMatrix are built once and saved in XGBoost's binary format; each worker
+loads them once and reuses them (including the hist quantization) for all
+of its trials.
+
+Usage:
+    python xgb_search.py --features extracted_features.npy --labels feature_labels.npy \\
+        --trials 64 --threads-per-trial 4
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from dedup import split_indices
+
+
+# name: (kind, low, high); names are accepted by both xgb.train and XGBClassifier
+SEARCH_SPACE = {
+    'max_depth': ('int', 3, 10),
+    'learning_rate': ('log', 0.01, 0.3),
+    'subsample': ('float', 0.5, 1.0),
+    'colsample_bytree': ('float', 0.2, 1.0),
+    'min_child_weight': ('log', 1.0, 20.0),
+    'reg_lambda': ('log', 0.1, 10.0),
+    'gamma': ('float', 0.0, 5.0),
+}
+
+# Per-process DMatrix objects, loaded once by _init_worker
+_DTRAIN = None
+_DVAL = None
+
+
+def sample_params(rng):
+    """Draw one configuration from SEARCH_SPACE"""
+    params = {}
+    for name, (kind, low, high) in SEARCH_SPACE.items():
+        if kind == 'int':
+            params[name] = int(rng.randint(low, high + 1))
+        elif kind == 'log':
+            params[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        else:
+            params[name] = float(rng.uniform(low, high))
+    return params
+
+
+def _init_worker(train_buffer, val_buffer):
+    global _DTRAIN, _DVAL
+    _DTRAIN = xgb.DMatrix(train_buffer)
+    _DVAL = xgb.DMatrix(val_buffer)
+
+
+def _train_to_rung(trial_id, params, target_rounds, booster, done_rounds):
+    """Continue one trial's booster up to target_rounds; returns its validation loss"""
+    start = time.perf_counter()
+    evals_result = {}
+    booster = xgb.train(params, _DTRAIN, num_boost_round=target_rounds - done_rounds,
+                        evals=[(_DVAL, 'validation')], evals_result=evals_result,
+                        xgb_model=booster, verbose_eval=False)
+    metric = params['eval_metric']
+    score = evals_result['validation'][metric][-1]
+    return trial_id, score, booster, time.perf_counter() - start
+
+
+def successive_halving_rungs(min_rounds, max_rounds, eta):
+    """Boosting-round budgets, e.g. 25, 75, 225, 600 for min=25, max=600, eta=3"""
+    rungs = []
+    rounds = min_rounds
+    while rounds < max_rounds:
+        rungs.append(rounds)
+        rounds *= eta
+    rungs.append(max_rounds)
+    return rungs
+
+
+def run_search(X_train, y_train, X_val, y_val, n_trials=32, threads_per_trial=4, num_workers=None,
+               min_rounds=25, max_rounds=600, eta=3, seed=42):
+    """
+    Run the parallel successive-halving search
+
+    Returns:
+        pd.DataFrame: Leaderboard sorted best first
+    """
+    num_workers = num_workers or max(1, (os.cpu_count() or 1) // threads_per_trial)
+    num_classes = len(np.unique(y_train))
+    base_params = {'tree_method': 'hist', 'nthread': threads_per_trial, 'seed': seed}
+    if num_classes > 2:
+        base_params.update({'objective': 'multi:softprob', 'num_class': num_classes, 'eval_metric': 'mlogloss'})
+    else:
+        base_params.update({'objective': 'binary:logistic', 'eval_metric': 'logloss'})
+
+    rng = np.random.RandomState(seed)
+    trials = {}
+    for trial_id in range(n_trials):
+        trials[trial_id] = {
+            'params': sample_params(rng), 'booster': None, 'rounds': 0,
+            'score': float('inf'), 'rung': -1, 'seconds': 0.0,
+        }
+
+    # Build the DMatrix once and share it through a binary buffer
+    buffer_dir = tempfile.mkdtemp(prefix='xgb_search_')
+    train_buffer = os.path.join(buffer_dir, 'train.buffer')
+    val_buffer = os.path.join(buffer_dir, 'val.buffer')
+    xgb.DMatrix(X_train, label=y_train).save_binary(train_buffer)
+    xgb.DMatrix(X_val, label=y_val).save_binary(val_buffer)
+
+    rungs = successive_halving_rungs(min_rounds, max_rounds, eta)
+    print(f"Search: {n_trials} trials, {num_workers} workers x {threads_per_trial} threads, rungs {rungs}")
+
+    survivors = list(trials)
+    # spawn: forking after OpenMP has started in the parent is unsafe
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(train_buffer, val_buffer)) as pool:
+            for rung, target_rounds in enumerate(rungs):
+                futures = [
+                    pool.submit(_train_to_rung, trial_id, dict(base_params, **trials[trial_id]['params']),
+                                target_rounds, trials[trial_id]['booster'], trials[trial_id]['rounds'])
+                    for trial_id in survivors
+                ]
+                for future in futures:
+                    trial_id, score, booster, seconds = future.result()
+                    trial = trials[trial_id]
+                    trial.update({'booster': booster, 'rounds': target_rounds, 'score': score, 'rung': rung})
+                    trial['seconds'] += seconds
+
+                survivors.sort(key=lambda trial_id: trials[trial_id]['score'])
+                best = trials[survivors[0]]
+                print(f"Rung {rung} ({target_rounds} rounds): {len(survivors)} trials, "
+                      f"best {base_params['eval_metric']}={best['score']:.5f}")
+                # Free the boosters of pruned trials
+                keep = max(1, math.ceil(len(survivors) / eta))
+                for trial_id in survivors[keep:]:
+                    trials[trial_id]['booster'] = None
+                survivors = survivors[:keep]
+    finally:
+        shutil.rmtree(buffer_dir, ignore_errors=True)
+
+    rows = []
+    for trial_id, trial in trials.items():
+        rows.append(dict(trial=trial_id, rung=trial['rung'], rounds=trial['rounds'],
+                         val_loss=trial['score'], seconds=round(trial['seconds'], 2), **trial['params']))
+    leaderboard = pd.DataFrame(rows).sort_values(['rung', 'val_loss'], ascending=[False, True])
+    return leaderboard.reset_index(drop=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Parallel XGBoost hyperparameter search")
+    parser.add_argument('--features', default='extracted_features.npy')
+    parser.add_argument('--labels', default='feature_labels.npy')
+    parser.add_argument('--groups', default='feature_groups.npy',
+                        help="Near-duplicate group ids written by train_model.py (used if present)")
+    parser.add_argument('--trials', type=int, default=32)
+    parser.add_argument('--threads-per-trial', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Concurrent trials (default: cpu_count // threads-per-trial)")
+    parser.add_argument('--min-rounds', type=int, default=25)
+    parser.add_argument('--max-rounds', type=int, default=600)
+    parser.add_argument('--eta', type=int, default=3, help="Keep the best 1/eta trials at each rung")
+    parser.add_argument('--leaderboard', default='xgb_search_leaderboard.csv')
+    parser.add_argument('--best-params', default='xgb_best_params.json')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    X = np.load(args.features)
+    y = np.load(args.labels)
+
+    groups = np.load(args.groups) if os.path.exists(args.groups) else None
+
+    # Same split as train_model.py
+    train_idx, val_idx = split_indices(y, groups, test_size=0.2, random_state=42)
+    X_train, X_val, y_train, y_val = X[train_idx], X[val_idx], y[train_idx], y[val_idx]
+
+    start = time.perf_counter()
+    leaderboard = run_search(X_train, y_train, X_val, y_val, n_trials=args.trials,
+                             threads_per_trial=args.threads_per_trial, num_workers=args.workers,
+                             min_rounds=args.min_rounds, max_rounds=args.max_rounds, eta=args.eta)
+    print(f"Search finished in {time.perf_counter() - start:.1f}s")
+
+    leaderboard.to_csv(args.leaderboard, index=False)
+    print(f"Leaderboard saved to {args.leaderboard}")
+    print(leaderboard.head(10).to_string(index=False))
+
+    best = leaderboard.iloc[0]
+    best_params = {name: int(best[name]) if kind == 'int' else float(best[name])
+                   for name, (kind, _, _) in SEARCH_SPACE.items()}
+    best_params['n_estimators'] = int(best['rounds'])
+    with open(args.best_params, 'w', encoding='utf-8') as f:
+        json.dump(best_params, f, indent=2)
+    print(f"Best parameters saved to {args.best_params}")
+
+
+if __name__ == '__main__':
+    main()